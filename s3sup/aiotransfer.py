@@ -0,0 +1,247 @@
+"""
+Optional asyncio based transport, for pushes made up of tens of thousands of
+small files. All requests are issued from a single event loop sharing one
+connection pool, avoiding the per-request overhead of boto3 resources and
+threads.
+
+Requires aiobotocore, installed with: pip install s3sup[asyncio]
+"""
+import asyncio
+import concurrent.futures
+
+import click
+
+try:
+    import aiobotocore.config
+    import aiobotocore.session
+except ImportError:
+    aiobotocore = None
+
+import s3sup.catalogue
+import s3sup.retry
+import s3sup.transfer
+
+
+DEFAULT_CONCURRENCY = 500
+
+# Files larger than this are read in a worker thread and handed to the
+# threaded boto3 operations rather than being held in memory on the loop.
+INLINE_MAX_BYTES = 8 * s3sup.transfer.MB
+
+
+def available():
+    return aiobotocore is not None
+
+
+def create_client_factory(region_name=None, endpoint_url=None,
+                          max_pool_connections=DEFAULT_CONCURRENCY):
+    """
+    Returns a callable creating an async context manager for an aiobotocore
+    S3 client. Raises a click.UsageError if aiobotocore is not installed.
+    """
+    if not available():
+        raise click.UsageError(
+            'The asyncio transport requires aiobotocore.\n -> Install it '
+            'using: pip install s3sup[asyncio]\n -> Or remove "transport" '
+            'from the [transfer] section of s3sup.toml.')
+    client_args = {
+        'config': aiobotocore.config.AioConfig(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': 0})}
+    if region_name is not None:
+        client_args['region_name'] = region_name
+    if endpoint_url is not None:
+        client_args['endpoint_url'] = endpoint_url
+
+    def factory():
+        session = aiobotocore.session.get_session()
+        return session.create_client('s3', **client_args)
+    return factory
+
+
+class AsyncS3Operations:
+    """
+    asyncio equivalent of s3sup.transfer.S3Operations. Large uploads and
+    copies are passed to fallback_operation, run in a thread from
+    fallback_pool, which also reads files to upload.
+    """
+
+    def __init__(self, client, bucket_name, fallback_operation=None,
+                 fallback_pool=None, retrier=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.fallback_operation = fallback_operation
+        self.fallback_pool = fallback_pool
+        if retrier is None:
+            retrier = s3sup.retry.Retrier(
+                limiter=s3sup.retry.AdaptiveRateLimiter())
+        self.retrier = retrier
+
+    async def _request(self, method, key, **kwargs):
+        return await self.retrier.call_async(
+            s3sup.retry.key_prefix(key), getattr(self.client, method),
+            Bucket=self.bucket_name, Key=key, **kwargs)
+
+    async def __call__(self, cr, fp):
+        if (cr != s3sup.catalogue.ChangeReason.DELETED and
+                self.fallback_operation is not None and
+                fp.size() > INLINE_MAX_BYTES):
+            # Multipart uploads and copies are left to the threaded operation.
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                self.fallback_pool, self.fallback_operation, cr, fp)
+        elif cr in (s3sup.catalogue.ChangeReason.NEW_FILE,
+                    s3sup.catalogue.ChangeReason.CONTENT_CHANGED,
+                    s3sup.catalogue.ChangeReason.MOVED):
+            if isinstance(fp, s3sup.transfer.ServerSideCopy):
+                await self.copy(fp)
+            else:
+                await self.put(fp)
+        elif cr == s3sup.catalogue.ChangeReason.ATTRIBUTES_CHANGED:
+            await self.copy_attributes(fp)
+        elif cr == s3sup.catalogue.ChangeReason.DELETED:
+            await self.delete(fp)
+        else:
+            raise Exception('Unknown ChangeReason: {0}'.format(cr))
+
+    async def put(self, fp):
+        # Reading and hashing block, so are kept off the event loop.
+        body, checksum = await asyncio.get_running_loop().run_in_executor(
+            self.fallback_pool, s3sup.transfer.read_verified, fp)
+        resp = await self._request(
+            'put_object', fp.s3_path(), Body=body, ChecksumSHA256=checksum,
+            **fp.attributes_as_boto_args())
+        fp.etag = resp.get('ETag')
+
+    async def copy_attributes(self, fp):
+        await self._copy(fp.s3_path(), fp)
+
+    async def copy(self, fp):
+        await self._copy(fp.source_key, fp)
+
+    async def _copy(self, source_key, fp):
+        resp = await self._request(
+            'copy_object', fp.s3_path(),
+            CopySource={'Bucket': self.bucket_name, 'Key': source_key},
+            MetadataDirective='REPLACE',
+            TaggingDirective='REPLACE',
+            **fp.attributes_as_boto_args())
+        fp.etag = resp.get('CopyObjectResult', {}).get('ETag')
+
+    async def delete(self, fp):
+        await self._request('delete_object', fp.s3_path())
+
+    async def delete_batch(self, fps):
+        resp = await self.retrier.call_async(
+            s3sup.retry.key_prefix(fps[0].s3_path()),
+            self.client.delete_objects,
+            Bucket=self.bucket_name,
+            Delete={
+                'Objects': [{'Key': fp.s3_path()} for fp in fps],
+                'Quiet': True})
+        return [(e['Key'], e.get('Code'), e.get('Message'))
+                for e in resp.get('Errors', [])]
+
+
+class AsyncExecutor:
+    """
+    Same contract as s3sup.transfer.Executor, but running every operation on
+    one event loop. Phases still complete one after another, and both the
+    concurrency and in-flight byte limits are applied in the same way.
+    """
+
+    def __init__(self, client_factory, bucket_name,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 max_inflight_bytes=(
+                     s3sup.transfer.DEFAULT_MAX_INFLIGHT_MB *
+                     s3sup.transfer.MB),
+                 inflight_bytes=s3sup.transfer.transfer_size,
+                 fallback_operation=None, fallback_concurrency=None,
+                 metrics=None, retrier=None):
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+        self.client_factory = client_factory
+        self.bucket_name = bucket_name
+        self.concurrency = concurrency
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = inflight_bytes
+        self.fallback_operation = fallback_operation
+        # Threads for the fallback operation and reading files. Far fewer
+        # than the operations run at the same time, which would otherwise
+        # bring back the per-thread cost this transport avoids.
+        if fallback_concurrency is None:
+            fallback_concurrency = min(
+                concurrency, s3sup.transfer.DEFAULT_CONCURRENCY)
+        self.fallback_concurrency = fallback_concurrency
+        self.metrics = metrics
+        self.retrier = retrier
+
+    def run(self, phases, on_done=None, dependencies=None):
+        loop = asyncio.new_event_loop()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.fallback_concurrency) as pool:
+                return loop.run_until_complete(
+                    self._run(phases, on_done, pool, dependencies))
+        finally:
+            loop.close()
+
+    async def _run(self, phases, on_done, pool, dependencies):
+        failures = []
+        async with self.client_factory() as client:
+            if self.metrics is not None:
+                self.metrics.register(client)
+            operation = AsyncS3Operations(
+                client, self.bucket_name,
+                fallback_operation=self.fallback_operation,
+                fallback_pool=pool, retrier=self.retrier)
+            for phase in phases:
+                failures += await self._run_phase(
+                    operation, phase, on_done, dependencies)
+        return failures
+
+    async def _run_phase(self, operation, phase, on_done, dependencies):
+        inflight = {}
+        inflight_bytes = 0
+        failures = []
+
+        async def _wait_for_one():
+            nonlocal inflight_bytes
+            done, _ = await asyncio.wait(
+                inflight, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                items, nbytes = inflight.pop(t)
+                inflight_bytes -= nbytes
+                if t.exception() is not None:
+                    for pending in inflight:
+                        pending.cancel()
+                    if len(inflight) > 0:
+                        await asyncio.wait(inflight)
+                    raise t.exception()
+                failures.extend(
+                    s3sup.transfer.unit_failures(items, t.result()))
+                tracker.done(items)
+                if on_done is not None:
+                    for item in items:
+                        on_done(item)
+
+        tracker = s3sup.transfer.DependencyTracker(
+            s3sup.transfer.work_units(operation, phase, self.inflight_bytes),
+            dependencies)
+        while len(tracker) > 0:
+            unit = tracker.next_unit(force=len(inflight) == 0)
+            if unit is None:
+                await _wait_for_one()
+                continue
+            fn, args, items, nbytes = unit
+            while len(inflight) > 0 and (
+                    len(inflight) >= self.concurrency or
+                    inflight_bytes + nbytes > self.max_inflight_bytes):
+                await _wait_for_one()
+            t = asyncio.ensure_future(fn(*args))
+            inflight[t] = (items, nbytes)
+            inflight_bytes += nbytes
+
+        while len(inflight) > 0:
+            await _wait_for_one()
+        return failures
@@ -1,15 +1,23 @@
 import csv
+import io
+import os
+import posixpath
 import contextlib
 import gzip
 import sqlite3
 import shutil
+import struct
 import tempfile
 import enum
 import collections
-import copy
 import click
 import inflect
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class ChangeReason(enum.Enum):
     NEW_FILE = 1
@@ -18,6 +26,7 @@ class ChangeReason(enum.Enum):
     DELETED = 4
     DELETED_PROTECTED = 5
     NO_CHANGE = 6
+    MOVED = 7
 
 
 CR_STYLE = collections.namedtuple(
@@ -32,89 +41,546 @@ CR_STYLES = {
     ChangeReason['DELETED']: CR_STYLE('red', '-', 'delete', 'deleted'),
     ChangeReason['DELETED_PROTECTED']: CR_STYLE(
         'green', '^', 'deleteprotected', 'deleted but protected'),
-    ChangeReason['NO_CHANGE']: CR_STYLE('green', '^', 'unchanged', 'unchanged')
+    ChangeReason['NO_CHANGE']: CR_STYLE(
+        'green', '^', 'unchanged', 'unchanged'),
+    ChangeReason['MOVED']: CR_STYLE('magenta', '>', 'moved', 'moved')
 }
 
-MAX_DB_SCHEMA_VERSION = 2
+MAX_DB_SCHEMA_VERSION = 3
+
+COMPRESSIONS = ('gzip', 'zstd')
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _zstd():
+    if zstandard is None:
+        raise click.UsageError(
+            'zstd compressed catalogues require zstandard, install using: '
+            'pip3 install s3sup[zstd]')
+    return zstandard
 
 
 @contextlib.contextmanager
-def load_gzipped_sqlite(path):
-    with tempfile.NamedTemporaryFile() as out_f:
-        with gzip.open(path, 'rb') as in_f:
-            shutil.copyfileobj(in_f, out_f)
-        c = sqlite3.connect(out_f.name)
-        c.row_factory = sqlite3.Row
-        yield c
-        c.close()
+def _open(source, mode):
+    """
+    File object for source, either a path or an already open file object,
+    which is left open.
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, mode) as f:
+            yield f
+    else:
+        yield source
+
+
+def _decompress(source):
+    """Bytes of a gzip or zstd compressed file, or readable file object"""
+    out = io.BytesIO()
+    with _open(source, 'rb') as f:
+        head = f.read(len(ZSTD_MAGIC))
+        f = _Prefixed(head, f)
+        if head == ZSTD_MAGIC:
+            with _zstd().ZstdDecompressor().stream_reader(f) as r:
+                shutil.copyfileobj(r, out)
+        else:
+            with gzip.GzipFile(fileobj=f, mode='rb') as r:
+                shutil.copyfileobj(r, out)
+    return out.getvalue()
+
+
+class _Prefixed(io.RawIOBase):
+    """
+    Readable file object of bytes already read from f, followed by the rest
+    of f. Lets the compression format be sniffed from a stream that cannot
+    seek, such as an S3 response body.
+    """
+
+    def __init__(self, prefix, f):
+        self._prefix = prefix
+        self._f = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self._prefix) > 0:
+            n = min(len(b), len(self._prefix))
+            b[:n] = self._prefix[:n]
+            self._prefix = self._prefix[n:]
+            return n
+        data = self._f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _compress(data, dest, compression='gzip', threads=1):
+    """
+    Compress data to dest, a path or writable file object. zstd can compress
+    using more than one thread.
+    """
+    with _open(dest, 'wb') as f:
+        if compression == 'zstd':
+            cctx = _zstd().ZstdCompressor(
+                level=ZSTD_LEVEL, threads=threads if threads > 1 else 0)
+            f.write(cctx.compress(data))
+        else:
+            with gzip.GzipFile(
+                    fileobj=f, mode='wb', compresslevel=GZIP_LEVEL) as w:
+                w.write(data)
+
+
+# sqlite3 can only load and save a database in memory from Python 3.11.
+_IN_MEMORY = hasattr(sqlite3.Connection, 'serialize')
+
+
+def _connect(database):
+    c = sqlite3.connect(database)
+    c.row_factory = sqlite3.Row
+    return c
 
 
 @contextlib.contextmanager
-def write_gzipped_sqlite(path):
-    with tempfile.NamedTemporaryFile() as in_f:
-        c = sqlite3.connect(in_f.name)
-        c.row_factory = sqlite3.Row
-        yield c
-        c.commit()
-        c.close()
-        with gzip.open(path, 'wb') as out_f:
-            shutil.copyfileobj(in_f, out_f)
+def load_gzipped_sqlite(source):
+    """
+    SQLite connection to a gzip or zstd compressed database, read from a path
+    or readable file object such as an S3 response body. The database is
+    decompressed into memory.
+    """
+    data = _decompress(source)
+    if _IN_MEMORY:
+        c = _connect(':memory:')
+        try:
+            c.deserialize(data)
+            yield c
+        finally:
+            c.close()
+        return
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        del data
+        c = _connect(f.name)
+        try:
+            yield c
+        finally:
+            c.close()
+
+
+@contextlib.contextmanager
+def write_gzipped_sqlite(dest, compression='gzip', threads=1):
+    """
+    SQLite connection to a new database, built in memory then compressed to
+    a path or writable file object once the block exits without error.
+    """
+    if _IN_MEMORY:
+        c = _connect(':memory:')
+        try:
+            yield c
+            c.commit()
+            data = c.serialize()
+        finally:
+            c.close()
+        _compress(data, dest, compression, threads)
+        return
+    with tempfile.NamedTemporaryFile() as f:
+        c = _connect(f.name)
+        try:
+            yield c
+            c.commit()
+        finally:
+            c.close()
+        _compress(f.read(), dest, compression, threads)
+
+
+HEX_DIGEST_LENGTH = 64
+# Packed entries: content and attributes digests, then optionally the size
+# (-1 if unknown) and ETag of the object on S3.
+DIGESTS_LENGTH = 64
+_SIZE = struct.Struct('<q')
+
+
+def _digest(h):
+    """32 byte binary form of a lowercase hex SHA-256 digest, otherwise None"""
+    if len(h) != HEX_DIGEST_LENGTH:
+        return None
+    try:
+        d = bytes.fromhex(h)
+    except ValueError:
+        return None
+    return d if d.hex() == h else None
+
+
+def _pack(content_hash, attributes_hash, size=None, etag=None):
+    """
+    Hashes of an entry as a single string of binary digests, followed by the
+    size and ETag if known, rather than a tuple of two 64 character strings.
+    Hashes in any other form are kept as a tuple of strings.
+    """
+    content_hash = str(content_hash)
+    attributes_hash = str(attributes_hash)
+    cd = _digest(content_hash)
+    ad = _digest(attributes_hash)
+    if cd is None or ad is None:
+        if size is None and etag is None:
+            return (content_hash, attributes_hash)
+        return (content_hash, attributes_hash, size, etag)
+    return _with_object(cd + ad, size, etag)
+
+
+def _with_object(digests, size, etag):
+    if size is None and etag is None:
+        return digests
+    return (digests + _SIZE.pack(-1 if size is None else size) +
+            (etag or '').encode('utf-8'))
+
+
+def _hashes(packed):
+    """Part of a packed entry identifying its content and attributes"""
+    return packed[:2] if isinstance(packed, tuple) else (
+        packed[:DIGESTS_LENGTH])
+
+
+def _content(packed):
+    """Part of a packed entry identifying its content"""
+    return packed[0] if isinstance(packed, tuple) else packed[:32]
+
+
+def _unpack(packed):
+    if isinstance(packed, tuple):
+        return packed[:2]
+    return packed[:32].hex(), packed[32:DIGESTS_LENGTH].hex()
+
+
+def _object(packed):
+    """(size, ETag) of a packed entry, each None if unknown"""
+    if isinstance(packed, tuple):
+        return tuple(packed[2:]) if len(packed) > 2 else (None, None)
+    if len(packed) == DIGESTS_LENGTH:
+        return None, None
+    size = _SIZE.unpack_from(packed, DIGESTS_LENGTH)[0]
+    etag = packed[DIGESTS_LENGTH + _SIZE.size:].decode('utf-8')
+    return (None if size < 0 else size), (etag or None)
+
+
+def _repack(packed, size, etag):
+    if _object(packed) == (size, etag):
+        return packed
+    if isinstance(packed, tuple):
+        return _pack(packed[0], packed[1], size, etag)
+    return _with_object(packed[:DIGESTS_LENGTH], size, etag)
+
+
+def _carry_object(local, remote):
+    """
+    Entry for a file whose content is unchanged: the local entry, with the
+    size and ETag of the object already on S3 filled in.
+    """
+    size, etag = _object(local)
+    r_size, r_etag = _object(remote)
+    if size is None or size == r_size:
+        if _hashes(local) == _hashes(remote):
+            return remote
+        size = r_size
+    return _repack(local, size, etag if etag is not None else r_etag)
+
+
+def _to_row(packed):
+    """(content_hash, attributes_hash, size, etag) columns of an entry"""
+    size, etag = _object(packed)
+    if isinstance(packed, tuple):
+        return packed[0], packed[1], size, etag
+    return packed[:32], packed[32:DIGESTS_LENGTH], size, etag
+
+
+def _from_row(content_hash, attributes_hash, size, etag):
+    if isinstance(content_hash, bytes) and isinstance(attributes_hash, bytes):
+        return _with_object(content_hash + attributes_hash, size, etag)
+    return _pack(_text(content_hash), _text(attributes_hash), size, etag)
+
+
+def _text(h):
+    return h.hex() if isinstance(h, bytes) else h
+
+
+def _split(path):
+    """(directory including trailing slash, file name)"""
+    i = path.rfind('/') + 1
+    return path[:i], path[i:]
 
 
 class Catalogue:
+    """
+    Content and attributes hashes of each file, by path.
+
+    Kept compact so catalogues of millions of files fit in memory: entries
+    are grouped by directory, so each directory name is stored once, and
+    hex digests are held as binary. The size and ETag of each object on S3
+    are also kept, where known.
+    """
+    __slots__ = ('_dirs', '_shared', '_preserve_deleted_files', 'meta')
 
     def __init__(self, preserve_deleted_files=False):
-        self._c = {}
+        # directory: {file name: packed hashes}
+        self._dirs = {}
+        # Directories whose entries are shared with a snapshot, so are
+        # copied before being changed.
+        self._shared = set()
         self._preserve_deleted_files = preserve_deleted_files
+        # Strings stored alongside the files, e.g. the git commit pushed.
+        self.meta = {}
 
-    def add_file(self, path: str, content_hash: str, attributes_hash: str):
-        self._c[path] = (str(content_hash), str(attributes_hash))
+    def add_file(self, path: str, content_hash: str, attributes_hash: str,
+                 size=None, etag=None):
+        self._add_packed(
+            path, _pack(content_hash, attributes_hash, size, etag))
         return self
 
+    def _own_files(self, d):
+        """Entries of directory d, copied first if shared with a snapshot"""
+        files = self._dirs[d]
+        if d in self._shared:
+            files = self._dirs[d] = dict(files)
+            self._shared.discard(d)
+        return files
+
+    def _add_packed(self, path, packed):
+        d, name = _split(path)
+        try:
+            files = self._own_files(d)
+        except KeyError:
+            files = self._dirs[d] = {}
+        files[name] = packed
+
+    def _get_packed(self, path):
+        d, name = _split(path)
+        return self._dirs[d][name]
+
+    def get(self, path: str):
+        """(content_hash, attributes_hash) for path. KeyError if not present"""
+        return _unpack(self._get_packed(path))
+
+    def get_object(self, path: str):
+        """
+        (size, ETag) of the object on S3 for path, each None if unknown.
+        KeyError if not present.
+        """
+        return _object(self._get_packed(path))
+
+    def add_from(self, catalogue, path: str):
+        """
+        Add the entry for path in catalogue, including its size and ETag.
+        KeyError if not present.
+        """
+        self._add_packed(path, catalogue._get_packed(path))
+        return self
+
+    def set_size(self, path: str, size):
+        _, etag = self.get_object(path)
+        self._add_packed(path, _repack(self._get_packed(path), size, etag))
+
+    def set_etag(self, path: str, etag):
+        size, _ = self.get_object(path)
+        self._add_packed(path, _repack(self._get_packed(path), size, etag))
+
+    def remove(self, path: str):
+        d, name = _split(path)
+        if name in self._dirs.get(d, ()):
+            files = self._own_files(d)
+            files.pop(name)
+            if len(files) == 0:
+                del self._dirs[d]
+        return self
+
+    def snapshot(self):
+        """
+        Copy of the catalogue, sharing the entries of each directory with
+        it until either catalogue changes them. Costs a little per directory
+        rather than per file, and delta() only compares directories that
+        have been changed since.
+        """
+        snap = Catalogue(preserve_deleted_files=self._preserve_deleted_files)
+        snap._dirs = dict(self._dirs)
+        snap._shared = set(self._dirs)
+        snap.meta = dict(self.meta)
+        self._shared = set(self._dirs)
+        return snap
+
+    def __len__(self):
+        return sum(len(files) for files in self._dirs.values())
+
+    def __contains__(self, path):
+        d, name = _split(path)
+        return name in self._dirs.get(d, ())
+
+    def paths(self):
+        """Every path in the catalogue, in no particular order"""
+        for d, files in self._dirs.items():
+            for name in files:
+                yield d + name
+
+    def items(self):
+        """(path, (content_hash, attributes_hash)) sorted by path"""
+        for path in sorted(self.paths()):
+            yield path, self.get(path)
+
+    def _packed_items(self):
+        for path in sorted(self.paths()):
+            yield path, self._get_packed(path)
+
     def to_dict(self):
-        return {k: self._c[k] for k in sorted(self._c.keys())}
+        return dict(self.items())
 
-    def from_csv(self, path: str):
-        with open(path, 'rt', newline='') as f:
+    def from_csv(self, source):
+        """Read a CSV catalogue from a path or binary file object"""
+        with _open(source, 'rb') as bf:
+            f = io.TextIOWrapper(bf, newline='')
             reader = csv.reader(f)
             next(reader)  # Skip CSV header
-            for path, content_hash, attributes_hash in csv.reader(f):
+            for path, content_hash, attributes_hash in reader:
                 self.add_file(path, content_hash, attributes_hash)
-
-    def from_sqlite(self, path: str):
-        with load_gzipped_sqlite(path) as c:
-            schema_version = c.execute('PRAGMA user_version').fetchone()[0]
-            if schema_version > MAX_DB_SCHEMA_VERSION:
-                raise click.ClickException((
-                    'Upgrade to latest s3sup to continue. The s3sup version'
-                    'last used to push this project to S3 was newer than the '
-                    'installed version. The newer remote catalogue format is '
-                    'not readable by older s3sup version. Catalogue schema is '
-                    'version {0}, this s3sup only supports catalogue schema '
-                    'up to version {1}.').format(
-                        schema_version, MAX_DB_SCHEMA_VERSION))
-            # Handle migrations here
+            f.detach()
+
+    def from_sqlite(self, source):
+        """Read a catalogue from a path or binary file object"""
+        with load_gzipped_sqlite(source) as c:
+            self.from_connection(c)
+
+    def from_connection(self, c):
+        """Read a catalogue from an open SQLite connection"""
+        schema_version = c.execute('PRAGMA user_version').fetchone()[0]
+        if schema_version > MAX_DB_SCHEMA_VERSION:
+            raise click.ClickException((
+                'Upgrade to latest s3sup to continue. The s3sup version'
+                'last used to push this project to S3 was newer than the '
+                'installed version. The newer remote catalogue format is '
+                'not readable by older s3sup version. Catalogue schema is '
+                'version {0}, this s3sup only supports catalogue schema '
+                'up to version {1}.').format(
+                    schema_version, MAX_DB_SCHEMA_VERSION))
+        # Handle migrations here
+        if schema_version < 3:
+            # Hex hashes, no sizes or ETags.
             for row in c.execute('SELECT * FROM files'):
-                self.add_file(
-                    row['path'], row['content_hash'], row['attributes_hash'])
-
-    def to_sqlite(self, path: str):
-        with write_gzipped_sqlite(path) as c:
-            c.execute('PRAGMA user_version = {v:d}'.format(
-                v=MAX_DB_SCHEMA_VERSION))
-            c.execute('''CREATE TABLE files (
-                path TEXT,
-                content_hash TEXT,
-                attributes_hash TEXT)''')
-            c.executemany(
-                'INSERT INTO files VALUES (?, ?, ?)',
-                [(path, ch, ah) for path, (ch, ah) in self.to_dict().items()])
-
-    def diff_dict(self, remote_catalogue):
-        lcl = self.to_dict()
-        rmt = remote_catalogue.to_dict()
-        # TODO: Not a great use of memory, see if there's a better way.
-        new_rmt = copy.deepcopy(self)
+                self.add_file(row['path'], row['content_hash'],
+                              row['attributes_hash'])
+        else:
+            for row in c.execute(
+                    'SELECT path, content_hash, attributes_hash, size, '
+                    'etag FROM files'):
+                self._add_packed(row[0], _from_row(*row[1:]))
+        has_meta = c.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'meta'").fetchone()
+        if has_meta is not None:
+            self.meta = {
+                row['key']: row['value']
+                for row in c.execute('SELECT key, value FROM meta')}
+
+    def to_sqlite(self, dest, compression='gzip', threads=1):
+        """Write the catalogue to a path or binary file object"""
+        with write_gzipped_sqlite(dest, compression, threads) as c:
+            self.to_connection(c)
+
+    def to_connection(self, c):
+        """Write the catalogue to an open connection to a new database"""
+        c.execute('PRAGMA user_version = {v:d}'.format(
+            v=MAX_DB_SCHEMA_VERSION))
+        # Hashes are 32 byte digests, or text if in any other form.
+        c.execute('''CREATE TABLE files (
+            path TEXT PRIMARY KEY,
+            content_hash BLOB,
+            attributes_hash BLOB,
+            size INTEGER,
+            etag TEXT) WITHOUT ROWID''')
+        c.executemany(
+            'INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+            ((path,) + _to_row(packed)
+             for path, packed in self._packed_items()))
+        # Ignored by older s3sup versions.
+        c.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        c.executemany(
+            'INSERT INTO meta VALUES (?, ?)', sorted(self.meta.items()))
+
+    def delta(self, old):
+        """
+        Entries of this catalogue differing from catalogue old, including
+        in size or ETag, as a Catalogue. Also returns the paths only in old.
+        """
+        changed = Catalogue()
+        for d, files in self._dirs.items():
+            old_files = old._dirs.get(d, {})
+            if files is old_files:
+                # Shared with a snapshot, so unchanged.
+                continue
+            for name, packed in files.items():
+                if old_files.get(name) != packed:
+                    changed._add_packed(d + name, packed)
+        removed = []
+        for d, old_files in old._dirs.items():
+            files = self._dirs.get(d, {})
+            if files is not old_files:
+                removed.extend(
+                    d + name for name in old_files if name not in files)
+        return changed, sorted(removed)
+
+    def iter_diff(self, remote_catalogue, new_remote=None):
+        """
+        Yield (ChangeReason, path) for every path in this local catalogue or
+        remote_catalogue, by merge-joining both a directory at a time. Only
+        the file names of one directory are sorted at once, and no entries
+        are copied or unpacked unless they differ. Moved files are yielded
+        as DELETED and NEW_FILE, see diff_dict() for pairing them up.
+
+        If given, entries the remote catalogue should hold after the changes
+        are made are added to the empty catalogue new_remote as they pass.
+        """
+        for d, in_lcl, in_rmt in _merge_join(
+                sorted(self._dirs), sorted(remote_catalogue._dirs)):
+            lcl = self._dirs[d] if in_lcl else {}
+            rmt = remote_catalogue._dirs[d] if in_rmt else {}
+            kept = {}
+            for name, in_l, in_r in _merge_join(sorted(lcl), sorted(rmt)):
+                path = d + name
+                if not in_l:
+                    if self._preserve_deleted_files:
+                        # Deleted but protected files are the only ones that
+                        # need to be maintained in remote
+                        kept[name] = rmt[name]
+                        yield ChangeReason.DELETED_PROTECTED, path
+                    else:
+                        yield ChangeReason.DELETED, path
+                    continue
+                packed = kept[name] = lcl[name]
+                if not in_r:
+                    yield ChangeReason.NEW_FILE, path
+                    continue
+                if packed == rmt[name]:
+                    yield ChangeReason.NO_CHANGE, path
+                    continue
+                if _content(packed) != _content(rmt[name]):
+                    yield ChangeReason.CONTENT_CHANGED, path
+                    continue
+                # Content already on S3, so is its size and ETag.
+                kept[name] = _carry_object(packed, rmt[name])
+                if _hashes(packed) == _hashes(rmt[name]):
+                    yield ChangeReason.NO_CHANGE, path
+                else:
+                    yield ChangeReason.ATTRIBUTES_CHANGED, path
+            if new_remote is not None and len(kept) > 0:
+                new_remote._dirs[d] = kept
+
+    def diff_dict(self, remote_catalogue, unchanged=False):
+        """
+        Changes needed to make remote_catalogue match this local catalogue,
+        and the remote catalogue once they are made. Memory used grows with
+        the number of changes. Unchanged files are only counted, unless
+        unchanged is True when they are also listed under 'unchanged'.
+        """
+        new_rmt = Catalogue(
+            preserve_deleted_files=self._preserve_deleted_files)
+        new_rmt.meta = dict(self.meta)
 
         changes = {
             'num_changes': 0,
@@ -125,33 +591,43 @@ class Catalogue:
             },
             'delete': [],
             'delete_protected': [],
-            'unchanged': []
+            'moved': [],
+            'num_unchanged': 0
         }
-
-        for path, (content_hash, attributes_hash) in rmt.items():
-            if path not in lcl:
-                if self._preserve_deleted_files:
-                    changes['delete_protected'].append(path)
-                    # Deleted but protected files are the only ones that need
-                    # to be maintained in remote
-                    new_rmt.add_file(path, content_hash, attributes_hash)
-                else:
-                    changes['delete'].append(path)
-
-        for path, (content_hash, attributes_hash) in lcl.items():
-            try:
-                r_content_hash, r_attributes_hash = rmt[path]
-                if content_hash != r_content_hash:
-                    changes['upload']['content_changed'].append(path)
-                elif attributes_hash != r_attributes_hash:
-                    changes['upload']['attributes_changed'].append(path)
-                else:
-                    changes['unchanged'].append(path)
-            except KeyError:
-                changes['upload']['new_files'].append(path)
+        by_reason = {
+            ChangeReason.NEW_FILE: changes['upload']['new_files'],
+            ChangeReason.CONTENT_CHANGED: changes['upload']['content_changed'],
+            ChangeReason.ATTRIBUTES_CHANGED: (
+                changes['upload']['attributes_changed']),
+            ChangeReason.DELETED: changes['delete'],
+            ChangeReason.DELETED_PROTECTED: changes['delete_protected'],
+        }
+        if unchanged:
+            changes['unchanged'] = by_reason[ChangeReason.NO_CHANGE] = []
+
+        for cr, path in self.iter_diff(remote_catalogue, new_remote=new_rmt):
+            if cr == ChangeReason.NO_CHANGE:
+                changes['num_unchanged'] += 1
+                if not unchanged:
+                    continue
+            by_reason[cr].append(path)
+        # Listed in path order, as the merge-join goes by directory.
+        for paths in by_reason.values():
+            paths.sort()
+
+        changes['moved'] = _pair_moves(
+            changes['delete'], changes['upload']['new_files'],
+            remote_catalogue, self)
+        moved_from = {old for old, _ in changes['moved']}
+        moved_to = {new for _, new in changes['moved']}
+        changes['delete'] = [
+            p for p in changes['delete'] if p not in moved_from]
+        changes['upload']['new_files'] = [
+            p for p in changes['upload']['new_files'] if p not in moved_to]
 
         changes['num_changes'] = (
             len(changes['delete'])
+            + len(changes['moved'])
             + len(changes['upload']['new_files'])
             + len(changes['upload']['content_changed'])
             + len(changes['upload']['attributes_changed'])
@@ -159,6 +635,74 @@ class Catalogue:
         return changes, new_rmt
 
 
+def _merge_join(left, right):
+    """
+    Walk two sorted lists of distinct keys together, yielding
+    (key, in left, in right) for every key in either.
+    """
+    i = j = 0
+    while i < len(left) or j < len(right):
+        if j >= len(right) or (i < len(left) and left[i] < right[j]):
+            yield left[i], True, False
+            i += 1
+        elif i >= len(left) or right[j] < left[i]:
+            yield right[j], False, True
+            j += 1
+        else:
+            yield left[i], True, True
+            i += 1
+            j += 1
+
+
+def _pair_moves(deleted, new_files, remote_cat, local_cat):
+    """
+    Pair deleted paths with new paths having identical content, which can be
+    moved with a server-side copy instead of uploaded again. Where there is a
+    choice, a deleted path with the same file name is preferred, as when a
+    directory has been renamed. Returns a list of (old path, new path).
+    """
+    # content hash: (file name: deque of paths, deque of every path). Paths
+    # are taken from either, those already taken are skipped when reached in
+    # the other, so each pairing is O(1) however many paths share a hash.
+    by_hash = {}
+    for path in deleted:
+        ch = remote_cat.get(path)[0]
+        try:
+            by_name, in_order = by_hash[ch]
+        except KeyError:
+            by_name, in_order = by_hash[ch] = ({}, collections.deque())
+        name = posixpath.basename(path)
+        try:
+            by_name[name].append(path)
+        except KeyError:
+            by_name[name] = collections.deque([path])
+        in_order.append(path)
+
+    def _take(candidates, taken):
+        while candidates:
+            path = candidates.popleft()
+            if path not in taken:
+                return path
+        return None
+
+    taken = set()
+    moves = []
+    for path in new_files:
+        try:
+            by_name, in_order = by_hash[local_cat.get(path)[0]]
+        except KeyError:
+            continue
+        old = _take(
+            by_name.get(posixpath.basename(path), collections.deque()), taken)
+        if old is None:
+            old = _take(in_order, taken)
+        if old is None:
+            continue
+        taken.add(old)
+        moves.append((old, path))
+    return moves
+
+
 def print_diff_summary(dd, verbose=False):
     ie = inflect.engine()
     nc = dd['num_changes']
@@ -171,8 +715,9 @@ def print_diff_summary(dd, verbose=False):
     else:
         click.echo('Summary of local changes to be synced to S3:')
 
-    def _p(files, change_reason):
-        num_files = len(files)
+    def _p(files, change_reason, num_files=None):
+        if num_files is None:
+            num_files = len(files)
         if num_files <= 0:
             return
         crs = CR_STYLES[ChangeReason[change_reason]]
@@ -199,9 +744,14 @@ def print_diff_summary(dd, verbose=False):
     _p(dd['upload']['new_files'], 'NEW_FILE')
     _p(dd['upload']['content_changed'], 'CONTENT_CHANGED')
     _p(dd['upload']['attributes_changed'], 'ATTRIBUTES_CHANGED')
+    _p(['{0} -> {1}'.format(old, new) for old, new in dd['moved']], 'MOVED')
     _p(dd['delete'], 'DELETED')
     _p(dd['delete_protected'], 'DELETED_PROTECTED')
-    _p(dd['unchanged'], 'NO_CHANGE')
+    _p([], 'NO_CHANGE', num_files=dd['num_unchanged'])
+
+
+def is_html(path):
+    return path.lower().endswith(('.html', '.htm', '.xhtml'))
 
 
 def _order_for_upload(path_names):
@@ -214,7 +764,7 @@ def _order_for_upload(path_names):
     html, css, js, others = [], [], [], []
     for p in path_names:
         pl = p.lower()
-        if pl.endswith(('.html', '.htm', '.xhtml')):
+        if is_html(p):
             html.append(p)
         elif pl.endswith(('.css')):
             css.append(p)
@@ -246,6 +796,41 @@ def change_list(diff):
            for p in _order_for_upload(diff['upload']['new_files'])]
     dl += [(ChangeReason.CONTENT_CHANGED, p)
            for p in _order_for_upload(diff['upload']['content_changed'])]
+    # Moves are copied along with uploads, and the old path deleted with
+    # the rest of the deletions.
+    dl += [(ChangeReason.MOVED, p)
+           for p in _order_for_upload([new for _, new in diff['moved']])]
     dl += [(ChangeReason.DELETED, p)
-           for p in diff['delete']]
+           for p in diff['delete'] + [old for old, _ in diff['moved']]]
     return dl
+
+
+def change_phases(changes, html_last=True):
+    """
+    Split the output of change_list() into phases. Changes within a phase can
+    be made concurrently, but each phase must be completed before the next one
+    is started:
+
+      1) Attribute changes.
+      2) New, changed and moved static assets (everything other than HTML).
+      3) New, changed and moved HTML files.
+      4) Deletions.
+
+    Without html_last, phases 2 and 3 are combined, for when the order of
+    uploads is instead decided by the assets each file references.
+
+    Empty phases are dropped. Ordering within each phase is preserved.
+    """
+    attrs, assets, html, deletes = [], [], [], []
+    for cr, p in changes:
+        if cr == ChangeReason.ATTRIBUTES_CHANGED:
+            attrs.append((cr, p))
+        elif cr == ChangeReason.DELETED:
+            deletes.append((cr, p))
+        elif is_html(p):
+            html.append((cr, p))
+        else:
+            assets.append((cr, p))
+    if not html_last:
+        assets, html = assets + html, []
+    return [ph for ph in (attrs, assets, html, deletes) if len(ph) > 0]
@@ -0,0 +1,145 @@
+"""
+Local copy of the remote catalogue, so it is only downloaded when it has
+changed.
+
+The compressed catalogue is kept in a small SQLite database under the project
+directory, along with its ETag. Downloads are made conditional on that ETag
+using If-None-Match, so while nothing else has pushed to the bucket S3 answers
+304 Not Modified and the local copy is read instead. A copy is only used for
+the same bucket and key it came from.
+
+Objects the remote catalogue refers to that are never modified, such as the
+base and deltas of a log structured catalogue, are kept by key.
+"""
+import os
+import json
+import sqlite3
+
+import s3sup.utils
+
+
+CACHE_FILENAME = 'remotecatalogue.sqlite'
+SCHEMA_VERSION = 2
+
+
+class CatalogueCache:
+    """
+    target identifies where the catalogue is kept on S3, e.g. its bucket and
+    key, see Project._journal_target().
+    """
+
+    def __init__(self, local_project_root, target):
+        self.path = os.path.join(
+            local_project_root, s3sup.utils.STATE_DIR, CACHE_FILENAME)
+        self.target = json.dumps(target)
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def get(self):
+        """(ETag, compressed catalogue) of the local copy, or None"""
+        if not os.path.exists(self.path):
+            return None
+        c = None
+        try:
+            c = self._connect()
+            if c.execute('PRAGMA user_version').fetchone()[0] != (
+                    SCHEMA_VERSION):
+                return None
+            row = c.execute(
+                'SELECT etag, body FROM catalogue WHERE target = ?',
+                (self.target,)).fetchone()
+            return None if row is None else (row[0], bytes(row[1]))
+        except sqlite3.DatabaseError:
+            return None
+        finally:
+            if c is not None:
+                c.close()
+
+    def _open_for_write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        c = self._connect()
+        if c.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            c.execute('DROP TABLE IF EXISTS catalogue')
+            c.execute('DROP TABLE IF EXISTS objects')
+            c.execute('''CREATE TABLE catalogue (
+                target TEXT PRIMARY KEY,
+                etag TEXT,
+                body BLOB)''')
+            c.execute('''CREATE TABLE objects (
+                key TEXT PRIMARY KEY,
+                body BLOB)''')
+            c.execute('PRAGMA user_version = {v:d}'.format(
+                v=SCHEMA_VERSION))
+        return c
+
+    def _write(self, fn):
+        """
+        Call fn with a connection and commit. Failing to write is not an
+        error, the catalogue is simply downloaded again next time.
+        """
+        c = None
+        try:
+            c = self._open_for_write()
+            fn(c)
+            c.commit()
+        except (OSError, sqlite3.DatabaseError):
+            pass
+        finally:
+            if c is not None:
+                c.close()
+
+    def put(self, etag, body):
+        """
+        Keep body, the compressed catalogue with ETag etag, replacing any
+        earlier copy.
+        """
+        def _put(c):
+            # Only the latest catalogue of one target is worth keeping.
+            c.execute('DELETE FROM catalogue')
+            c.execute(
+                'INSERT INTO catalogue VALUES (?, ?, ?)',
+                (self.target, etag, body))
+        self._write(_put)
+
+    def get_object(self, key):
+        """Body of the unmodifiable object key, or None"""
+        if not os.path.exists(self.path):
+            return None
+        c = None
+        try:
+            c = self._connect()
+            if c.execute('PRAGMA user_version').fetchone()[0] != (
+                    SCHEMA_VERSION):
+                return None
+            row = c.execute(
+                'SELECT body FROM objects WHERE key = ?', (key,)).fetchone()
+            return None if row is None else bytes(row[0])
+        except sqlite3.DatabaseError:
+            return None
+        finally:
+            if c is not None:
+                c.close()
+
+    def put_object(self, key, body):
+        self._write(lambda c: c.execute(
+            'INSERT OR REPLACE INTO objects VALUES (?, ?)', (key, body)))
+
+    def keep_objects(self, keys):
+        """Forget every object other than those in keys"""
+        if not os.path.exists(self.path):
+            return
+
+        def _prune(c):
+            stale = [
+                row[0] for row in c.execute('SELECT key FROM objects')
+                if row[0] not in keys]
+            c.executemany(
+                'DELETE FROM objects WHERE key = ?', ((k,) for k in stale))
+        self._write(_prune)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
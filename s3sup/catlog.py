@@ -0,0 +1,112 @@
+"""
+Log structured remote catalogue, so each push writes only what it changed.
+
+With `deltas = true` in the [catalogue] section of s3sup.toml, the remote
+catalogue object holds a small log: the key of a base snapshot of the whole
+catalogue, followed by the keys of deltas made by each push since. A delta is
+a catalogue of the entries a push added or changed, along with the paths it
+removed. The catalogue is rebuilt by applying each delta to the base in turn.
+
+Base and delta objects are never modified, their keys include a digest of
+their content, so they can be kept locally once downloaded. The log is
+compacted, writing a new base in place of the deltas, once there are more
+than `max_deltas` deltas or they add up to more than `max_delta_ratio` times
+the size of the base.
+
+Logs are schema version 5, so s3sup versions without log support refuse to
+push to the project rather than treating it as never pushed.
+"""
+import io
+import hashlib
+
+import s3sup.catalogue
+
+
+LOG_SCHEMA_VERSION = 5
+DEFAULT_MAX_DELTAS = 50
+DEFAULT_MAX_DELTA_RATIO = 0.5
+
+
+def is_log(c):
+    """Whether open SQLite connection c is to a log"""
+    return c.execute('PRAGMA user_version').fetchone()[0] == (
+        LOG_SCHEMA_VERSION)
+
+
+def object_key(catalogue_key, body):
+    """Key of a base or delta, from its compressed content"""
+    return '{0}.log/{1}'.format(
+        catalogue_key, hashlib.sha256(body).hexdigest()[:32])
+
+
+def write_delta(changed, removed, compression='gzip', threads=1):
+    """Compressed delta object"""
+    buf = io.BytesIO()
+    with s3sup.catalogue.write_gzipped_sqlite(
+            buf, compression, threads) as c:
+        changed.to_connection(c)
+        c.execute('CREATE TABLE removed (path TEXT PRIMARY KEY)')
+        c.executemany(
+            'INSERT INTO removed VALUES (?)', ((p,) for p in removed))
+    return buf.getvalue()
+
+
+def apply_delta(catalogue, body):
+    """Make the changes in compressed delta object body to catalogue"""
+    changed = s3sup.catalogue.Catalogue()
+    with s3sup.catalogue.load_gzipped_sqlite(io.BytesIO(body)) as c:
+        changed.from_connection(c)
+        removed = [row[0] for row in c.execute('SELECT path FROM removed')]
+    for path in removed:
+        catalogue.remove(path)
+    for path in changed.paths():
+        catalogue.add_from(changed, path)
+
+
+class Log:
+
+    def __init__(self, base, meta=None):
+        # (key, size in bytes) of the base and each delta, in order.
+        self.base = base
+        self.deltas = []
+        # Catalogue metadata, e.g. the git commit pushed.
+        self.meta = {} if meta is None else dict(meta)
+
+    def keys(self):
+        return {self.base[0]} | {key for key, _ in self.deltas}
+
+    def needs_compaction(self, max_deltas=DEFAULT_MAX_DELTAS,
+                         max_delta_ratio=DEFAULT_MAX_DELTA_RATIO):
+        total = sum(size for _, size in self.deltas)
+        return (len(self.deltas) > max_deltas or
+                total > max_delta_ratio * self.base[1])
+
+    @classmethod
+    def from_connection(cls, c):
+        """Read a log from an open SQLite connection"""
+        rows = c.execute(
+            'SELECT key, size FROM objects ORDER BY position').fetchall()
+        log = cls(tuple(rows[0]))
+        log.deltas = [tuple(row) for row in rows[1:]]
+        log.meta = {
+            row[0]: row[1]
+            for row in c.execute('SELECT key, value FROM meta')}
+        return log
+
+    def to_sqlite(self, dest, compression='gzip', threads=1):
+        with s3sup.catalogue.write_gzipped_sqlite(
+                dest, compression, threads) as c:
+            c.execute('PRAGMA user_version = {v:d}'.format(
+                v=LOG_SCHEMA_VERSION))
+            # Position 0 is the base, then deltas in the order made.
+            c.execute('''CREATE TABLE objects (
+                position INTEGER PRIMARY KEY,
+                key TEXT,
+                size INTEGER)''')
+            c.executemany(
+                'INSERT INTO objects VALUES (?, ?, ?)',
+                ((i, key, size) for i, (key, size) in enumerate(
+                    [self.base] + self.deltas)))
+            c.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            c.executemany(
+                'INSERT INTO meta VALUES (?, ?)', sorted(self.meta.items()))
@@ -0,0 +1,149 @@
+"""
+Pre-compression of text based files before upload, enabled per path using the
+compress directive in [[path_specific]] sections.
+
+Compressed artifacts are kept in a local store keyed on the hash of the
+original content and the compression settings, so files are only compressed
+again when they, or the settings, change.
+"""
+import os
+import gzip
+import hashlib
+import tempfile
+
+import click
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import s3sup.hashing
+import s3sup.utils
+
+
+ARTIFACT_DIR = 'compressed'
+READ_BLOCK = 65536
+
+# Content-Encoding: highest (and default) compression level. Artifacts are
+# cached, so the extra time spent compressing is only paid once.
+MAX_LEVELS = {
+    'gzip': 9,
+    'br': 11
+}
+
+
+def check_settings(codec, level):
+    if codec not in MAX_LEVELS:
+        raise click.UsageError(
+            'Unknown compression "{0}", use one of: {1}'.format(
+                codec, ', '.join(sorted(MAX_LEVELS))))
+    if not 0 <= level <= MAX_LEVELS[codec]:
+        raise click.UsageError(
+            'compress_level for {0} must be between 0 and {1}'.format(
+                codec, MAX_LEVELS[codec]))
+    if codec == 'br' and brotli is None:
+        raise click.UsageError(
+            'Brotli compression requires the brotli package.\n -> Install it '
+            'using: pip install s3sup[brotli]\n -> Or use compress = "gzip" '
+            'in s3sup.toml.')
+
+
+def compress(f_in, f_out, codec, level):
+    """Stream f_in through compression to f_out"""
+    if codec == 'gzip':
+        # No file name or modification time, so output only depends on
+        # the content and level.
+        with gzip.GzipFile(
+                filename='', mode='wb', compresslevel=level, fileobj=f_out,
+                mtime=0) as gz:
+            buf = f_in.read(READ_BLOCK)
+            while len(buf) > 0:
+                gz.write(buf)
+                buf = f_in.read(READ_BLOCK)
+        return
+    c = brotli.Compressor(quality=level)
+    buf = f_in.read(READ_BLOCK)
+    while len(buf) > 0:
+        f_out.write(c.process(buf))
+        buf = f_in.read(READ_BLOCK)
+    f_out.write(c.finish())
+
+
+class _HashingWriter:
+    """Writes through to f_out, hashing what is written on the way"""
+
+    def __init__(self, f_out):
+        self.f_out = f_out
+        self.sha = hashlib.sha256()
+
+    def write(self, buf):
+        self.sha.update(buf)
+        return self.f_out.write(buf)
+
+    def flush(self):
+        self.f_out.flush()
+
+
+class ArtifactStore:
+    """
+    Each artifact is kept in a directory named after the hash of the original
+    content and the settings, as a file named after its own content hash, the
+    hash recorded for it in the local catalogue.
+    """
+
+    def __init__(self, local_project_root):
+        self.root = os.path.join(
+            local_project_root, s3sup.utils.STATE_DIR, ARTIFACT_DIR)
+
+    def artifact(self, source_path, codec, level):
+        """
+        (path, content hash) of the compressed version of source_path,
+        compressing it if there is no artifact for this content and these
+        settings yet. The content hash is the artifact's file name, so it is
+        never hashed again.
+        """
+        d = os.path.join(self.root, '{0}.{1}-{2:d}'.format(
+            s3sup.hashing.file_hash(source_path), codec, level))
+        try:
+            for name in os.listdir(d):
+                return os.path.join(d, name), name
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.root, exist_ok=True)
+        hndl, tmpp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(hndl, 'wb') as f_out:
+                with open(str(source_path), 'rb') as f_in:
+                    writer = _HashingWriter(f_out)
+                    compress(f_in, writer, codec, level)
+            content_hash = writer.sha.hexdigest()
+            os.makedirs(d, exist_ok=True)
+            path = os.path.join(d, content_hash)
+            os.replace(tmpp, path)
+        except BaseException:
+            os.remove(tmpp)
+            raise
+        return path, content_hash
+
+    def prune(self, content_hashes):
+        """
+        Remove artifacts whose content hashes are not in content_hashes,
+        e.g. those of files since edited.
+        """
+        try:
+            dirs = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for d in dirs:
+            d = os.path.join(self.root, d)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                if name not in content_hashes:
+                    os.remove(os.path.join(d, name))
+            try:
+                os.rmdir(d)
+            except OSError:
+                # Still holds a current artifact
+                pass
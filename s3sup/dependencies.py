@@ -0,0 +1,129 @@
+"""
+Finds the static assets referenced by HTML and CSS files, so that a file can
+be uploaded as soon as everything it references is on S3, rather than waiting
+for every asset in the push.
+
+Only local references are followed: href and src attributes (including
+srcset), CSS url() and @import. Links between HTML pages are not treated as
+dependencies, they would tie most of a site together into one cycle.
+"""
+import re
+import posixpath
+import html.parser
+import urllib.parse
+
+import s3sup.catalogue
+
+
+CSS_URL_RE = re.compile(
+    r'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^)'"\s]*))\s*\)'''
+    r'''|@import\s+(?:"([^"]*)"|'([^']*)')''')
+REFERENCE_ATTRIBUTES = {'href', 'src', 'poster', 'data'}
+MAX_PARSE_BYTES = 16 * 1024 * 1024
+
+
+def _is_css(path):
+    return path.lower().endswith('.css')
+
+
+def css_references(text):
+    return [next(g for g in m.groups() if g is not None)
+            for m in CSS_URL_RE.finditer(text)]
+
+
+class _ReferenceParser(html.parser.HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.references = []
+        self._in_style = False
+
+    def handle_starttag(self, tag, attrs):
+        self._in_style = tag == 'style'
+        for name, value in attrs:
+            if value is None:
+                continue
+            if name in REFERENCE_ATTRIBUTES:
+                self.references.append(value)
+            elif name == 'srcset':
+                self.references += [
+                    c.strip().split()[0] for c in value.split(',')
+                    if len(c.strip()) > 0]
+            elif name == 'style':
+                self.references += css_references(value)
+
+    def handle_endtag(self, tag):
+        if tag == 'style':
+            self._in_style = False
+
+    def handle_data(self, data):
+        if self._in_style:
+            self.references += css_references(data)
+
+
+def html_references(text):
+    parser = _ReferenceParser()
+    parser.feed(text)
+    parser.close()
+    return parser.references
+
+
+def resolve(reference, from_path):
+    """
+    Project relative path a reference made in from_path points to, or None
+    if it points somewhere else (another site, data: URIs etc.). Root
+    relative references are taken to be relative to the project root.
+    """
+    url = urllib.parse.urlsplit(reference.strip())
+    if url.scheme or url.netloc or len(url.path) == 0:
+        return None
+    path = urllib.parse.unquote(url.path)
+    if path.startswith('/'):
+        path = path.lstrip('/')
+    else:
+        path = posixpath.join(posixpath.dirname(from_path), path)
+    if path == '' or path.endswith('/'):
+        path += 'index.html'
+    path = posixpath.normpath(path)
+    if path.startswith('../') or path == '..':
+        return None
+    return path
+
+
+def references(fp):
+    """Project relative paths referenced by the local file of fp"""
+    path = fp.path_local_rel.as_posix()
+    if s3sup.catalogue.is_html(path):
+        find = html_references
+    elif _is_css(path):
+        find = css_references
+    else:
+        return set()
+    with fp.path_local_abs.open('rb') as f:
+        text = f.read(MAX_PARSE_BYTES).decode('utf-8', errors='replace')
+    resolved = (resolve(r, path) for r in find(text))
+    return {r for r in resolved if r is not None and r != path}
+
+
+UPLOADS = {
+    s3sup.catalogue.ChangeReason.NEW_FILE,
+    s3sup.catalogue.ChangeReason.CONTENT_CHANGED,
+    s3sup.catalogue.ChangeReason.MOVED
+}
+
+
+def dependency_graph(items):
+    """
+    Maps paths of uploads among (ChangeReason, path, FilePrepper) items to
+    the set of other non-HTML uploads that they reference.
+    """
+    uploads = [(p, fp) for cr, p, fp in items if cr in UPLOADS]
+    paths = {p for p, _ in uploads}
+    graph = {}
+    for p, fp in uploads:
+        deps = {
+            r for r in references(fp)
+            if r in paths and not s3sup.catalogue.is_html(r)}
+        if len(deps) > 0:
+            graph[p] = deps
+    return graph
@@ -1,3 +1,4 @@
+import os
 import functools
 import pathlib
 import pickle
@@ -8,6 +9,9 @@ import collections
 import click
 import humanize
 
+import s3sup.compression
+import s3sup.hashcache
+import s3sup.hashing
 import s3sup.rules
 
 
@@ -41,35 +45,52 @@ TEXT_BASED_MIMETYPES = {
     'application/vnd.mozilla.xul+xml'
 }
 DEFAULT_CHARSET_MIMETYPES = TEXT_BASED_MIMETYPES
-HASH_READ_BLOCK = 65536
+
+# Marks a per-instance cached value that has not been worked out yet.
+_UNSET = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _resolved_root(project_root):
+    return pathlib.Path(project_root).resolve()
 
 
 class FilePrepper:
 
-    def __init__(self, project_root, path, rules):
+    def __init__(self, project_root, path, rules, hash_cache=None,
+                 local_stat=None):
         self.project_root = project_root
         self.path = path
+        self.hash_cache = hash_cache
+        # os.stat() result for the local file, if already known.
+        self.local_stat = local_stat
+        self._content_hash = None
+        # Cached per instance, so they go when the FilePrepper does.
+        self._compression = _UNSET
+        self._attributes = None
+        self._content_path = None
+        # Content hash of the compressed artifact, known once it is found.
+        self._artifact_hash = None
+        self._attributes_hash = None
+        # ETag of the object on S3, once uploaded or copied by s3sup.
+        self.etag = None
 
         self.path_proj = pathlib.Path(project_root)
 
         # Relative to project root. E.g. 'index.html'.
         self.path_local_rel = pathlib.Path(path)
 
-        # Absolute path. E.g. '/home/jsmith/proj_1/index.html'
-        self.path_local_abs = self.path_proj.joinpath(
-            self.path_local_rel).resolve()
+        # Absolute path. E.g. '/home/jsmith/proj_1/index.html'. Only the
+        # project root is resolved, saving a realpath() for every file.
+        self.path_local_abs = _resolved_root(
+            os.path.abspath(project_root)).joinpath(self.path_local_rel)
 
         self.rules = rules
         self.path_directives = s3sup.rules.directives_for_path(
             self.path, self.rules)
 
-    @functools.lru_cache(maxsize=None)
-    def attributes(self):
-        # Defaults
-        attrs = {
-            'ACL': 'public-read',
-            'Cache-Control': 'max-age=10'
-        }
+    def _mime_type(self):
+        """(mime type, encoding) of the original local file"""
         fext = pathlib.Path(self.path).suffix
         mime_type, encoding = mimetypes.guess_type(self.path)
         try:
@@ -80,6 +101,42 @@ class FilePrepper:
             mime_type = self.rules['mimetype_overrides'][fext]
         except KeyError:
             pass
+        return mime_type, encoding
+
+    def compression(self):
+        """
+        (Content-Encoding, level) the file is compressed with before upload,
+        or None. Only text based files not already encoded are compressed.
+        """
+        if self._compression is _UNSET:
+            self._compression = self._find_compression()
+        return self._compression
+
+    def _find_compression(self):
+        try:
+            codec = self.path_directives['compress']
+        except KeyError:
+            return None
+        level = self.path_directives.get(
+            'compress_level', s3sup.compression.MAX_LEVELS.get(codec, 0))
+        s3sup.compression.check_settings(codec, level)
+        mime_type, encoding = self._mime_type()
+        if encoding is not None or mime_type not in TEXT_BASED_MIMETYPES:
+            return None
+        return codec, level
+
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = self._find_attributes()
+        return self._attributes
+
+    def _find_attributes(self):
+        # Defaults
+        attrs = {
+            'ACL': 'public-read',
+            'Cache-Control': 'max-age=10'
+        }
+        mime_type, encoding = self._mime_type()
 
         charset_mimetypes = DEFAULT_CHARSET_MIMETYPES
         try:
@@ -129,6 +186,8 @@ class FilePrepper:
                 attrs[dctv] = self.path_directives[dctv]
             except KeyError:
                 continue
+        if self.compression() is not None:
+            attrs['Content-Encoding'], _ = self.compression()
         # Set as a sorted dict
         # self.attributes() = {k: attrs[k] for k in sorted(attrs)}
         return collections.OrderedDict(
@@ -159,27 +218,115 @@ class FilePrepper:
             return '{0}/{1}'.format(root, path)
         return path
 
+    def content_path(self):
+        """
+        Local file holding the content to upload. The compressed artifact if
+        the file is pre-compressed, otherwise the file itself.
+        """
+        if self._content_path is not None:
+            return self._content_path
+        if self.compression() is None:
+            self._content_path = self.path_local_abs
+        else:
+            store = s3sup.compression.ArtifactStore(self.project_root)
+            path, self._artifact_hash = store.artifact(
+                self.path_local_abs, *self.compression())
+            self._content_path = pathlib.Path(path)
+            if (self._content_hash not in (None, self._artifact_hash) and
+                    self._stat_key() == self._hashed_key):
+                # Compressed again since the hash was cached, e.g. after the
+                # store was deleted, by a compressor giving different bytes.
+                self.set_content_hash(self._artifact_hash)
+        return self._content_path
+
     def content_fileobj(self):
-        return self.path_local_abs.open('rb')
+        return self.content_path().open('rb')
 
     def size(self):
-        """Size of local file in bytes"""
-        return self.path_local_abs.stat().st_size
+        """Size in bytes of content to upload"""
+        return self.content_path().stat().st_size
+
+    def known_size(self):
+        """
+        Size in bytes of content to upload, if known without compressing the
+        file or another stat(). Otherwise None.
+        """
+        if self.local_stat is None or self.compression() is not None:
+            return None
+        return self.local_stat.st_size
+
+    def _stat_key(self, st=None):
+        """Hash cache key for the current version of the local file"""
+        variant = ''
+        if self.compression() is not None:
+            variant = '{0}-{1:d}'.format(*self.compression())
+        if st is None:
+            st = self.path_local_abs.stat()
+        return s3sup.hashcache.stat_key(st, variant)
+
+    def cached_content_hash(self):
+        """
+        Content hash from the hash cache if the file is unchanged since it
+        was cached, otherwise None. Either way, records the version of the
+        file that content_hash() refers to.
+        """
+        if self._content_hash is not None:
+            return self._content_hash
+        self._hashed_key = self._stat_key(self.local_stat)
+        if self.hash_cache is None:
+            return None
+        self._content_hash = self.hash_cache.get(
+            self.path_local_rel.as_posix(), self._hashed_key)
+        return self._content_hash
+
+    def set_content_hash(self, content_hash):
+        """
+        Record the hash of content_path(), worked out elsewhere after calling
+        cached_content_hash().
+        """
+        self._content_hash = content_hash
+        if self.hash_cache is not None:
+            self.hash_cache.put(
+                self.path_local_rel.as_posix(), self._hashed_key,
+                content_hash)
+
+    def assume_content_hash(self, content_hash):
+        """
+        Use content_hash, known from elsewhere to match the local file,
+        without hashing the file or adding it to the hash cache. Any entry
+        already in the hash cache is kept.
+        """
+        self._hashed_key = self._stat_key(self.local_stat)
+        self._content_hash = content_hash
+        if self.hash_cache is not None:
+            self.hash_cache.keep(self.path_local_rel.as_posix())
 
-    @functools.lru_cache(maxsize=None)
     def content_hash(self):
-        sha = hashlib.sha256()
-        with self.content_fileobj() as f_in:
-            fbuf = f_in.read(HASH_READ_BLOCK)
-            while len(fbuf) > 0:
-                sha.update(fbuf)
-                fbuf = f_in.read(HASH_READ_BLOCK)
-            content_hash = sha.hexdigest()
-        return content_hash
-
-    @functools.lru_cache(maxsize=None)
+        if self.cached_content_hash() is None:
+            self.set_content_hash(self._uncached_content_hash())
+        return self._content_hash
+
+    def _uncached_content_hash(self):
+        content_path = self.content_path()
+        if self._artifact_hash is not None:
+            # Named after its hash by the artifact store.
+            return self._artifact_hash
+        return s3sup.hashing.file_hash(content_path)
+
+    def content_changed(self):
+        """
+        True if the local file has been modified since content_hash() was
+        worked out, going by its size, modification time, inode and change
+        time.
+        """
+        self.content_hash()
+        return self._stat_key() != self._hashed_key
+
     def attributes_hash(self):
-        return hashlib.sha256(pickle.dumps(self.attributes())).hexdigest()
+        if self._attributes_hash is None:
+            self._attributes_hash = hashlib.sha256(
+                pickle.dumps(self.attributes())).hexdigest()
+        return self._attributes_hash
 
     def hashes(self):
         return (self.content_hash(), self.attributes_hash())
@@ -191,6 +338,9 @@ class FilePrepper:
                 self.rules['aws']['s3_bucket_name'], self.s3_path()),
             'Attributes': self.attributes(),
             'Content size': humanize.naturalsize(self.size()),
+            'Pre-compression': (
+                'None' if self.compression() is None
+                else '{0} level {1}'.format(*self.compression())),
             'Content hash': self.content_hash(),
             'Attributes hash': self.attributes_hash()
         }
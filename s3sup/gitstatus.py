@@ -0,0 +1,97 @@
+"""
+Asks git which files have changed since the commit last pushed, so that only
+those need hashing.
+
+The commit checked out when the catalogue was made is stored in the remote
+catalogue, along with any tracked files that differed from it at the time.
+On the next push, tracked files git reports as unchanged since that commit,
+and that did not differ at the time, take their content hash from the remote
+catalogue. Every other file is hashed, including untracked and ignored files
+and anything within .git.
+"""
+import os
+import json
+import subprocess
+
+
+COMMIT_KEY = 'git_commit'
+DIRTY_KEY = 'git_dirty'
+
+
+def _git(local_project_root, *args):
+    """stdout of git run in the project directory, or None if it failed"""
+    try:
+        proc = subprocess.run(
+            ['git', '-C', str(local_project_root)] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        # git not installed
+        return None
+    if proc.returncode != 0:
+        return None
+    return proc.stdout
+
+
+def _paths(output):
+    """Project relative paths from NUL separated git output"""
+    return {os.fsdecode(p).replace('/', os.sep)
+            for p in output.split(b'\0') if len(p) > 0}
+
+
+def head_commit(local_project_root):
+    """Commit id checked out, or None if not within a git work tree"""
+    out = _git(local_project_root, 'rev-parse', '--verify', '-q', 'HEAD')
+    return None if out is None else out.decode('ascii').strip()
+
+
+def modified_since(local_project_root, commit):
+    """
+    Project relative paths of tracked files differing from commit in the
+    work tree, or None if git cannot tell, e.g. the commit is unknown.
+    """
+    out = _git(
+        local_project_root, 'diff', '--name-only', '-z', '--no-renames',
+        '--relative', commit, '--', '.')
+    return None if out is None else _paths(out)
+
+
+def tracked(local_project_root):
+    """Project relative paths of files in the git index"""
+    out = _git(local_project_root, 'ls-files', '-z', '--', '.')
+    return None if out is None else _paths(out)
+
+
+def unchanged_since(local_project_root, meta):
+    """
+    Paths of files known to match the catalogue with metadata meta. None if
+    git cannot tell, in which case every file must be hashed.
+    """
+    try:
+        commit = meta[COMMIT_KEY]
+    except KeyError:
+        return None
+    modified = modified_since(local_project_root, commit)
+    in_index = tracked(local_project_root)
+    if modified is None or in_index is None:
+        return None
+    return in_index - modified - set(json.loads(meta.get(DIRTY_KEY, '[]')))
+
+
+def catalogue_meta(local_project_root):
+    """Metadata recording git state, for a catalogue made from the work tree"""
+    commit = head_commit(local_project_root)
+    if commit is None:
+        return {}
+    modified = modified_since(local_project_root, commit)
+    if modified is None:
+        return {}
+    return {COMMIT_KEY: commit, DIRTY_KEY: json.dumps(sorted(modified))}
+
+
+def mark_dirty(meta, paths):
+    """Record paths as no longer matching the commit in meta"""
+    if COMMIT_KEY not in meta:
+        return
+    dirty = set(json.loads(meta.get(DIRTY_KEY, '[]')))
+    dirty.update(paths)
+    meta[DIRTY_KEY] = json.dumps(sorted(dirty))
@@ -0,0 +1,166 @@
+"""
+Local cache of file content hashes, so unchanged files are not read and
+hashed again on every run.
+
+Hashes are kept in a small SQLite database under the project directory, keyed
+by path and the file's size, modification time, inode and change time. If any
+of those differ the file is hashed again. Files modified in the last couple of
+seconds are never cached, as a further modification within the same
+timestamp granularity would go unnoticed.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+import s3sup.utils
+
+
+CACHE_FILENAME = 'hashcache.sqlite'
+SCHEMA_VERSION = 1
+# Files modified more recently than this are hashed but not cached.
+RACY_SECONDS = 2
+
+
+def stat_key(st, variant=''):
+    """
+    Identifies a version of a file from its os.stat() result. variant
+    distinguishes hashes of the same file prepared in different ways, e.g.
+    compressed with different settings.
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns, variant)
+
+
+class HashCache:
+    """
+    With rehash, cached hashes are ignored but the cache is still brought up
+    to date with the hashes worked out.
+    """
+
+    def __init__(self, local_project_root, rehash=False):
+        self.path = os.path.join(
+            local_project_root, s3sup.utils.STATE_DIR, CACHE_FILENAME)
+        self.rehash = rehash
+        self._entries = None
+        self._load_lock = threading.Lock()
+        self._updated = {}
+        self._seen = set()
+
+    def _connect(self):
+        c = sqlite3.connect(self.path)
+        c.execute('PRAGMA journal_mode = WAL')
+        c.execute('PRAGMA synchronous = NORMAL')
+        return c
+
+    def _load(self):
+        """path: (stat key, content hash) for every cached file"""
+        if self._entries is not None:
+            return self._entries
+        with self._load_lock:
+            if self._entries is None:
+                self._entries = self._read()
+        return self._entries
+
+    def _read(self):
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        c = None
+        try:
+            c = self._connect()
+            version = c.execute('PRAGMA user_version').fetchone()[0]
+            if version == SCHEMA_VERSION:
+                entries = {
+                    row[0]: (tuple(row[1:6]), row[6])
+                    for row in c.execute(
+                        'SELECT path, size, mtime_ns, ino, ctime_ns, '
+                        'variant, content_hash FROM hashes')}
+            return entries
+        except sqlite3.DatabaseError:
+            pass
+        finally:
+            if c is not None:
+                c.close()
+        # Unreadable, start again.
+        self.remove()
+        return entries
+
+    def remove(self):
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def get(self, path, key):
+        """Content hash cached for this version of path, or None"""
+        self._seen.add(path)
+        if self.rehash:
+            return None
+        try:
+            cached_key, content_hash = self._load()[path]
+        except KeyError:
+            return None
+        return content_hash if cached_key == key else None
+
+    def keep(self, path):
+        """
+        Keep the entry for path when pruning, for files whose hash was
+        looked up elsewhere.
+        """
+        self._seen.add(path)
+
+    def put(self, path, key, content_hash):
+        self._seen.add(path)
+        mtime_ns = key[1]
+        if mtime_ns >= (time.time() - RACY_SECONDS) * 1e9:
+            return
+        if self._load().get(path) != (key, content_hash):
+            self._updated[path] = (key, content_hash)
+
+    def save(self, prune=False):
+        """
+        Write new hashes to disk. With prune, entries for paths not looked
+        up since the cache was loaded are removed, for use after the whole
+        project has been walked. Failing to write the cache is not an error,
+        files are simply hashed again next time.
+        """
+        entries = self._load()
+        stale = set(entries) - self._seen if prune else set()
+        if len(self._updated) == 0 and len(stale) == 0:
+            return
+        c = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            c = self._connect()
+            if c.execute('PRAGMA user_version').fetchone()[0] != (
+                    SCHEMA_VERSION):
+                c.execute('DROP TABLE IF EXISTS hashes')
+                c.execute('''CREATE TABLE hashes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    ino INTEGER,
+                    ctime_ns INTEGER,
+                    variant TEXT,
+                    content_hash TEXT)''')
+                c.execute('PRAGMA user_version = {v:d}'.format(
+                    v=SCHEMA_VERSION))
+            with c:
+                c.executemany(
+                    'DELETE FROM hashes WHERE path = ?',
+                    ((p,) for p in stale))
+                c.executemany(
+                    'INSERT OR REPLACE INTO hashes '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    ((p,) + key + (ch,)
+                     for p, (key, ch) in self._updated.items()))
+        except (OSError, sqlite3.DatabaseError):
+            return
+        finally:
+            if c is not None:
+                c.close()
+        for p in stale:
+            del entries[p]
+        entries.update(self._updated)
+        self._updated = {}
@@ -0,0 +1,73 @@
+"""
+Content hashing of local files, spread across cores.
+
+Files are hashed by a pool of threads by default. hashlib releases the GIL
+while hashing buffers of more than a couple of kilobytes, so large files are
+hashed in parallel. For projects made up of huge numbers of tiny files, where
+per-file Python overhead dominates, the process engine sends files to a pool
+of processes in batches instead. Both give the same hashes as hashing one file
+at a time.
+"""
+import os
+import hashlib
+import concurrent.futures
+
+
+HASH_READ_BLOCK = 65536
+ENGINES = ('threads', 'processes')
+# Files sent to a worker process at a time by the process engine.
+PROCESS_BATCH_SIZE = 256
+
+
+def default_workers():
+    return min(32, os.cpu_count() or 1)
+
+
+def file_hash(path):
+    """Hex SHA-256 digest of the file at path"""
+    sha = hashlib.sha256()
+    with open(str(path), 'rb') as f_in:
+        fbuf = f_in.read(HASH_READ_BLOCK)
+        while len(fbuf) > 0:
+            sha.update(fbuf)
+            fbuf = f_in.read(HASH_READ_BLOCK)
+    return sha.hexdigest()
+
+
+def hash_content(fps, workers=None, engine='threads'):
+    """
+    Work out content_hash() of every FilePrepper in fps, so later calls
+    return straight away. Hashes already in the hash cache are not worked
+    out again. With one worker files are hashed one after another in the
+    calling thread.
+    """
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1 or len(fps) <= 1:
+        for fp in fps:
+            fp.content_hash()
+        return
+    if engine == 'processes':
+        misses = []
+        for fp in fps:
+            if fp.cached_content_hash() is not None:
+                continue
+            if fp.compression() is not None:
+                # Compressed artifacts are named after their hash.
+                fp.content_hash()
+                continue
+            misses.append(fp)
+        if len(misses) == 0:
+            return
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as pool:
+            hashes = pool.map(
+                file_hash, [str(fp.content_path()) for fp in misses],
+                chunksize=max(1, min(
+                    PROCESS_BATCH_SIZE, len(misses) // workers)))
+            for fp, content_hash in zip(misses, hashes):
+                fp.set_content_hash(content_hash)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(lambda fp: fp.content_hash(), fps):
+            pass
@@ -0,0 +1,174 @@
+"""
+Local journal of changes made to S3 during a push.
+
+The remote catalogue is only written once every change has been made, so a
+push that dies part way through would otherwise upload everything again next
+time. Each completed change is recorded in a small SQLite database under the
+project directory. The next push overlays it on the remote catalogue, so
+changes already made are skipped, then removes it once the remote catalogue
+has been written.
+
+A journal is only trusted if it was started against the same bucket, project
+root and remote catalogue, otherwise it is thrown away.
+"""
+import os
+import copy
+import json
+import hashlib
+import sqlite3
+
+import s3sup.catalogue
+import s3sup.utils
+
+
+JOURNAL_FILENAME = 'journal.sqlite'
+SCHEMA_VERSION = 2
+
+
+def fingerprint(target, catalogue):
+    """
+    Identifies the state a journal was started from: where the push is going
+    (e.g. bucket and S3 project root) and the remote catalogue found there.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(target).encode('utf-8'))
+    for path, (ch, ah) in catalogue.items():
+        h.update('\0{0}\0{1}\0{2}'.format(path, ch, ah).encode('utf-8'))
+    return h.hexdigest()
+
+
+class Journal:
+
+    def __init__(self, local_project_root):
+        self.path = os.path.join(
+            local_project_root, s3sup.utils.STATE_DIR, JOURNAL_FILENAME)
+        self._conn = None
+
+    def _connect(self):
+        c = sqlite3.connect(self.path)
+        c.row_factory = sqlite3.Row
+        # WAL with synchronous=NORMAL survives the process being killed, and
+        # is cheap enough to commit after every change.
+        c.execute('PRAGMA journal_mode = WAL')
+        c.execute('PRAGMA synchronous = NORMAL')
+        return c
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def entries(self, fp):
+        """
+        Changes recorded against the state identified by fingerprint fp, as
+        a dict of path: (ChangeReason, content_hash, attributes_hash, size,
+        etag). Empty if there is no journal, or it belongs to some other
+        state.
+        """
+        if not self.exists():
+            return {}
+        c = self._conn
+        try:
+            if c is None:
+                c = self._connect()
+            if not self._started_from(c, fp):
+                return {}
+            return {
+                row['path']: (
+                    s3sup.catalogue.ChangeReason[row['change_reason']],
+                    row['content_hash'], row['attributes_hash'],
+                    row['size'], row['etag'])
+                for row in c.execute('SELECT * FROM changes')}
+        except sqlite3.DatabaseError:
+            return {}
+        finally:
+            if c is not None and c is not self._conn:
+                c.close()
+
+    def apply(self, catalogue, fp):
+        """
+        Copy of remote catalogue with changes from the journal made to it.
+        Returns (catalogue, number of changes applied).
+        """
+        entries = self.entries(fp)
+        if len(entries) == 0:
+            return catalogue, 0
+        applied = copy.deepcopy(catalogue)
+        for path, (cr, ch, ah, size, etag) in entries.items():
+            if cr == s3sup.catalogue.ChangeReason.DELETED:
+                applied.remove(path)
+            else:
+                applied.add_file(path, ch, ah, size=size, etag=etag)
+        return applied, len(entries)
+
+    @staticmethod
+    def _fingerprint(c):
+        row = c.execute(
+            "SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        return None if row is None else row['value']
+
+    @classmethod
+    def _started_from(cls, c, fp):
+        """True if journal c was written by this version against fp"""
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        return version == SCHEMA_VERSION and cls._fingerprint(c) == fp
+
+    def start(self, fp):
+        """
+        Open the journal for recording. Entries from an earlier interrupted
+        push are kept if they were made against the same state.
+        """
+        if os.path.exists(self.path):
+            c = None
+            try:
+                c = self._connect()
+                if self._started_from(c, fp):
+                    self._conn = c
+                    return
+            except sqlite3.DatabaseError:
+                pass
+            if c is not None:
+                c.close()
+            self.remove()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        c = self._connect()
+        c.execute('PRAGMA user_version = {v:d}'.format(v=SCHEMA_VERSION))
+        c.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        c.execute('''CREATE TABLE changes (
+            path TEXT PRIMARY KEY,
+            change_reason TEXT,
+            content_hash TEXT,
+            attributes_hash TEXT,
+            size INTEGER,
+            etag TEXT)''')
+        c.execute(
+            "INSERT INTO meta VALUES ('fingerprint', ?)", (fp,))
+        c.commit()
+        self._conn = c
+
+    def record(self, cr, path, content_hash=None, attributes_hash=None,
+               size=None, etag=None):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?, ?)',
+            (path, cr.name, content_hash, attributes_hash, size, etag))
+        self._conn.commit()
+
+    def forget(self, path):
+        self._conn.execute('DELETE FROM changes WHERE path = ?', (path,))
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def remove(self):
+        """Delete the journal, once the remote catalogue is up to date"""
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
@@ -0,0 +1,62 @@
+import threading
+import collections
+
+
+class S3Metrics:
+    """
+    Counts requests made to S3 by one or more clients, along with the number
+    of HTTP connections opened to make them. Far fewer connections than
+    requests shows keep-alive connections are being reused.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = []
+        self.requests = collections.Counter()
+        self.retries = collections.Counter()
+
+    def register(self, client):
+        client.meta.events.register(
+            'request-created.s3', self._on_request_created)
+        self._clients.append(client)
+
+    def _on_request_created(self, operation_name=None, **kwargs):
+        with self._lock:
+            self.requests[operation_name] += 1
+
+    def record_retry(self, kind):
+        with self._lock:
+            self.retries[kind] += 1
+
+    def connections_opened(self):
+        """
+        Connections opened by the urllib3 pools of registered boto3 clients.
+        None if not known, e.g. for clients not using urllib3.
+        """
+        total = None
+        for client in self._clients:
+            try:
+                manager = client._endpoint.http_session._manager
+                opened = sum(
+                    manager.pools[k].num_connections
+                    for k in manager.pools.keys())
+            except (AttributeError, KeyError):
+                continue
+            total = (total or 0) + opened
+        return total
+
+    def summary(self):
+        num_requests = sum(self.requests.values())
+        s = collections.OrderedDict([('S3 requests', num_requests)])
+        conns = self.connections_opened()
+        if conns is not None:
+            s['Connections opened'] = conns
+            if num_requests > 0:
+                s['Connection reuse'] = '{0:.1%}'.format(
+                    max(0, num_requests - conns) / num_requests)
+        s['Requests by operation'] = collections.OrderedDict(
+            sorted(self.requests.items()))
+        if len(self.retries) > 0:
+            s['Retries'] = collections.OrderedDict(
+                sorted(self.retries.items()))
+        return s
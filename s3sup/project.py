@@ -1,17 +1,32 @@
+import io
 import os
 import functools
-import tempfile
 import pkgutil
 
 import boto3
 import botocore
+import botocore.config
 import click
 import humanize
 
+import s3sup.aiotransfer
 import s3sup.catalogue
+import s3sup.catcache
+import s3sup.catlog
+import s3sup.compression
+import s3sup.dependencies
 import s3sup.fileprepper
+import s3sup.gitstatus
+import s3sup.hashcache
+import s3sup.hashing
+import s3sup.journal
+import s3sup.metrics
+import s3sup.retry
 import s3sup.rules
+import s3sup.shards
+import s3sup.transfer
 import s3sup.utils
+import s3sup.walker
 
 
 def load_skeleton_s3sup_toml():
@@ -21,7 +36,8 @@ def load_skeleton_s3sup_toml():
 class Project:
 
     def __init__(self, local_project_root, dryrun=False,
-                 preserve_deleted_files=False, verbose=True):
+                 preserve_deleted_files=False, verbose=True,
+                 concurrency=None, rehash=False):
         self.dryrun = dryrun
         self.verbose = verbose
         self.local_project_root = local_project_root
@@ -47,12 +63,175 @@ class Project:
         except KeyError:
             pass
 
+        self._transport = 'threads'
+        try:
+            self._transport = self.rules['transfer']['transport']
+        except KeyError:
+            pass
+
+        self._concurrency = s3sup.transfer.DEFAULT_CONCURRENCY
+        if self._transport == 'asyncio':
+            self._concurrency = s3sup.aiotransfer.DEFAULT_CONCURRENCY
+        try:
+            self._concurrency = self.rules['transfer']['concurrency']
+        except KeyError:
+            pass
+        if concurrency is not None:
+            self._concurrency = concurrency
+
+        self._max_inflight_bytes = (
+            s3sup.transfer.DEFAULT_MAX_INFLIGHT_MB * s3sup.transfer.MB)
+        try:
+            self._max_inflight_bytes = (
+                self.rules['transfer']['max_inflight_mb'] * s3sup.transfer.MB)
+        except KeyError:
+            pass
+
+        self._multipart_args = {}
+        for conf_key, arg in (
+                ('multipart_threshold_mb', 'multipart_threshold'),
+                ('multipart_chunksize_mb', 'multipart_chunksize')):
+            try:
+                self._multipart_args[arg] = (
+                    self.rules['transfer'][conf_key] * s3sup.transfer.MB)
+            except KeyError:
+                pass
+        try:
+            self._multipart_args['multipart_concurrency'] = (
+                self.rules['transfer']['multipart_concurrency'])
+        except KeyError:
+            pass
+
+        # Enough connections for every worker to have each part of a
+        # multipart upload in flight at the same time.
+        self._max_pool_connections = self._concurrency * (
+            self._multipart_args.get(
+                'multipart_concurrency',
+                s3sup.transfer.DEFAULT_MULTIPART_CONCURRENCY))
+        try:
+            self._max_pool_connections = (
+                self.rules['transfer']['max_pool_connections'])
+        except KeyError:
+            pass
+        self._scheduler = 'phases'
+        try:
+            self._scheduler = self.rules['transfer']['scheduler']
+        except KeyError:
+            pass
+
+        self._deduplicate_uploads = True
+        try:
+            self._deduplicate_uploads = self.rules['transfer']['deduplicate']
+        except KeyError:
+            pass
+
+        self._s3 = None
+        self.metrics = s3sup.metrics.S3Metrics()
+
+        max_attempts = s3sup.retry.DEFAULT_MAX_ATTEMPTS
+        try:
+            max_attempts = self.rules['transfer']['max_attempts']
+        except KeyError:
+            pass
+        max_rate = s3sup.retry.DEFAULT_MAX_REQUESTS_PER_SECOND
+        try:
+            max_rate = self.rules['transfer']['max_requests_per_second']
+        except KeyError:
+            pass
+        self._retrier = s3sup.retry.Retrier(
+            max_attempts=max_attempts,
+            limiter=s3sup.retry.AdaptiveRateLimiter(max_rate=max_rate),
+            metrics=self.metrics)
+
+        self._hash_workers = s3sup.hashing.default_workers()
+        try:
+            self._hash_workers = self.rules['hashing']['workers']
+        except KeyError:
+            pass
+        self._hash_engine = 'threads'
+        try:
+            self._hash_engine = self.rules['hashing']['engine']
+        except KeyError:
+            pass
+        self._git_changes = False
+        try:
+            self._git_changes = self.rules['hashing']['git']
+        except KeyError:
+            pass
+
+        self._catalogue_compression = 'gzip'
+        try:
+            self._catalogue_compression = (
+                self.rules['catalogue']['compression'])
+        except KeyError:
+            pass
+        self._catalogue_compression_threads = 1
+        try:
+            self._catalogue_compression_threads = (
+                self.rules['catalogue']['compression_threads'])
+        except KeyError:
+            pass
+        self._catalogue_shards = None
+        try:
+            self._catalogue_shards = self.rules['catalogue']['shards']
+        except KeyError:
+            pass
+        self._catalogue_deltas = False
+        try:
+            self._catalogue_deltas = self.rules['catalogue']['deltas']
+        except KeyError:
+            pass
+        if self._catalogue_deltas and self._catalogue_shards is not None:
+            raise click.UsageError(
+                'Only one of "shards" and "deltas" can be set in the '
+                '[catalogue] section of s3sup.toml.')
+        self._max_deltas = s3sup.catlog.DEFAULT_MAX_DELTAS
+        try:
+            self._max_deltas = self.rules['catalogue']['max_deltas']
+        except KeyError:
+            pass
+        self._max_delta_ratio = s3sup.catlog.DEFAULT_MAX_DELTA_RATIO
+        try:
+            self._max_delta_ratio = self.rules['catalogue']['max_delta_ratio']
+        except KeyError:
+            pass
+
+        self._path_filter = s3sup.walker.PathFilter.from_rules(self.rules)
+
+        self._journal = s3sup.journal.Journal(local_project_root)
+        self._hash_cache = s3sup.hashcache.HashCache(
+            local_project_root, rehash=rehash)
         self._fp_cache = {}
+        self._cat_cache = s3sup.catcache.CatalogueCache(
+            local_project_root, self._journal_target())
+        # Remote catalogue as left by the last push made by this Project.
+        self._pushed_cat = None
+        # Manifest of the remote catalogue, if sharded.
+        self._remote_manifest = None
+        # Log of the remote catalogue if log structured, and the catalogue
+        # it holds, which the next delta is made against.
+        self._remote_log = None
+        self._log_cat = None
         self.local_preflight_checks()
 
     def _boto_bucket(self):
+        """
+        boto3 S3 resource and bucket, created once and shared by everything
+        this project does. Credentials, endpoint setup and the connection pool
+        (with its keep-alive connections) are reused across all phases of a
+        push. Use resource.meta.client when sharing between threads.
+
+        botocore's own retries are turned off, s3sup.retry handles them so
+        that throttling can be fed back into the rate limiter.
+        """
+        if self._s3 is not None:
+            return self._s3
         s = boto3.session.Session()
-        res_args = {}
+        res_args = {
+            'config': botocore.config.Config(
+                max_pool_connections=self._max_pool_connections,
+                retries={'max_attempts': 0})
+        }
         try:
             res_args['region_name'] = self.rules['aws']['region_name']
         except KeyError:
@@ -62,15 +241,44 @@ class Project:
         except KeyError:
             pass
         r = s.resource(service_name='s3', **res_args)
+        self.metrics.register(r.meta.client)
         b = r.Bucket(self.rules['aws']['s3_bucket_name'])
-        return r, b
+        self._s3 = (r, b)
+        return self._s3
 
-    def file_prepper_wrapped(self, path):
+    def _executor(self):
+        """
+        Execution engine used to apply changes to S3, dependent on the
+        configured transport.
+        """
+        rsrc, _ = self._boto_bucket()
+        ops = s3sup.transfer.S3Operations(
+            rsrc.meta.client, self.rules['aws']['s3_bucket_name'],
+            retrier=self._retrier, **self._multipart_args)
+        if self._transport == 'asyncio':
+            client_factory = s3sup.aiotransfer.create_client_factory(
+                region_name=self.rules['aws'].get('region_name'),
+                endpoint_url=self.rules['aws'].get('s3_endpoint_url'),
+                max_pool_connections=self._concurrency)
+            return s3sup.aiotransfer.AsyncExecutor(
+                client_factory, self.rules['aws']['s3_bucket_name'],
+                metrics=self.metrics, retrier=self._retrier,
+                concurrency=self._concurrency,
+                max_inflight_bytes=self._max_inflight_bytes,
+                inflight_bytes=ops.inflight_bytes,
+                fallback_operation=ops)
+        return s3sup.transfer.Executor(
+            ops, concurrency=self._concurrency,
+            max_inflight_bytes=self._max_inflight_bytes,
+            inflight_bytes=ops.inflight_bytes)
+
+    def file_prepper_wrapped(self, path, local_stat=None):
         try:
             return self._fp_cache[path]
         except KeyError:
             self._fp_cache[path] = s3sup.fileprepper.FilePrepper(
-                self.local_project_root, path, self.rules)
+                self.local_project_root, path, self.rules,
+                hash_cache=self._hash_cache, local_stat=local_stat)
         return self._fp_cache[path]
 
     def _local_fs_path(self, rel_path):
@@ -91,29 +299,55 @@ class Project:
         rmt_cat_fp = self.file_prepper_wrapped('.s3sup.write_test')
         rsrc, b = self._boto_bucket()
         o = b.Object(rmt_cat_fp.s3_path())
+        prefix = s3sup.retry.key_prefix(o.key)
         try:
-            o.put(Body='Can s3sup write to bucket?', ACL='private')
+            self._retrier.call(
+                prefix, o.put, Body='Can s3sup write to bucket?',
+                ACL='private')
         except rsrc.meta.client.exceptions.NoSuchBucket:
             raise click.ClickException('S3 bucket does not exist: {0}'.format(
                 self.rules['aws']['s3_bucket_name']))
-        o.delete()
+        self._retrier.call(prefix, o.delete)
 
     @functools.lru_cache(maxsize=8)
     def local_catalogue(self):
         local_cat = s3sup.catalogue.Catalogue(
             preserve_deleted_files=self._preserve_deleted_files)
-        for root, dirs, files in os.walk(self.local_project_root):
-            for f in files:
-                if f == 's3sup.toml':
-                    continue
-                abs_path = os.path.join(root, f)
-                rel_path = os.path.relpath(
-                    abs_path, start=self.local_project_root)
-                fp = self.file_prepper_wrapped(rel_path)
-                local_cat.add_file(
-                    rel_path, fp.content_hash(), fp.attributes_hash())
+        fps = [
+            self.file_prepper_wrapped(rel_path, local_stat=st)
+            for rel_path, st in s3sup.walker.walk(
+                str(self.local_project_root), self._path_filter)]
+        if self._git_changes:
+            known = self._git_unchanged_hashes()
+            for fp in fps:
+                if fp.path in known:
+                    fp.assume_content_hash(known[fp.path])
+            local_cat.meta.update(
+                s3sup.gitstatus.catalogue_meta(self.local_project_root))
+        s3sup.hashing.hash_content(
+            fps, workers=self._hash_workers, engine=self._hash_engine)
+        for fp in fps:
+            local_cat.add_file(
+                fp.path, fp.content_hash(), fp.attributes_hash(),
+                size=fp.known_size())
+        self._hash_cache.save(prune=True)
         return local_cat
 
+    def _git_unchanged_hashes(self):
+        """
+        path: content hash, from the remote catalogue, for files git says
+        are unchanged since the commit last pushed.
+        """
+        remote_cat = self.get_remote_catalogue()
+        unchanged = s3sup.gitstatus.unchanged_since(
+            self.local_project_root, remote_cat.meta)
+        if (unchanged is None or
+                s3sup.walker.CONFIG_FILENAME not in unchanged):
+            # Changed rules may change how content is prepared.
+            return {}
+        return {p: remote_cat.get(p)[0]
+                for p in remote_cat.paths() if p in unchanged}
+
     @functools.lru_cache(maxsize=8)
     def get_remote_catalogue(self):
         remote_cat = s3sup.catalogue.Catalogue(
@@ -126,11 +360,16 @@ class Project:
         new_cat_fp = self.file_prepper_wrapped('.s3sup.cat')
         new_f = b.Object(new_cat_fp.s3_path())
 
-        hndl, tmpp = tempfile.mkstemp()
-        os.close(hndl)
         try:
-            new_f.download_file(tmpp)
-            remote_cat.from_sqlite(tmpp)
+            body = self._catalogue_body(new_f)
+            with s3sup.catalogue.load_gzipped_sqlite(io.BytesIO(body)) as c:
+                if s3sup.shards.is_manifest(c):
+                    self._remote_manifest = (
+                        s3sup.shards.Manifest.from_connection(c))
+                elif s3sup.catlog.is_log(c):
+                    self._remote_log = s3sup.catlog.Log.from_connection(c)
+                else:
+                    remote_cat.from_connection(c)
         except botocore.exceptions.NoCredentialsError:
             raise click.UsageError(
                 'Cannot find AWS credentials.\n -> Configure AWS credentials '
@@ -143,8 +382,9 @@ class Project:
                     ('Could not find SQLite based remote catalogue on S3 '
                      '(expected at {0}).').format(new_cat_fp.s3_path()))
             try:
-                old_f.download_file(tmpp)
-                remote_cat.from_csv(tmpp)
+                body = self._retrier.call(
+                    '', lambda: old_f.get()['Body'].read())
+                remote_cat.from_csv(io.BytesIO(body))
                 click.echo(click.style((
                     'WARNING: After the next s3sup push, do not attempt to '
                     'use older versions of s3sup (0.3.0 or below) with this '
@@ -159,19 +399,228 @@ class Project:
                             old_cat_fp.s3_path()))
                 pass
             pass
-        os.remove(tmpp)
+        if self._remote_manifest is not None:
+            try:
+                self._read_shards(self._remote_manifest, remote_cat)
+            except botocore.exceptions.ClientError as e:
+                raise click.ClickException((
+                    'Could not download a shard of the remote catalogue '
+                    '({0}). The remote catalogue may have been changed by '
+                    'another push, try again.').format(e))
+        elif self._remote_log is not None:
+            try:
+                self._read_log(self._remote_log, remote_cat)
+            except botocore.exceptions.ClientError as e:
+                raise click.ClickException((
+                    'Could not download the base or a delta of the remote '
+                    'catalogue ({0}). The remote catalogue may have been '
+                    'changed by another push, try again.').format(e))
         return remote_cat
 
+    def _catalogue_body(self, obj):
+        """
+        Compressed remote catalogue from S3 object obj. If S3 reports it
+        unchanged since last downloaded or written, the local copy is read
+        instead.
+        """
+        cached = self._cat_cache.get()
+        get_args = {}
+        if cached is not None:
+            get_args['IfNoneMatch'] = cached[0]
+
+        def _get():
+            # Retried as a whole, including reading the body.
+            resp = obj.get(**get_args)
+            return resp['ETag'], resp['Body'].read()
+        try:
+            etag, body = self._retrier.call('', _get)
+        except botocore.exceptions.ClientError as e:
+            status = e.response.get(
+                'ResponseMetadata', {}).get('HTTPStatusCode')
+            if cached is not None and status == 304:
+                return cached[1]
+            raise
+        self._cat_cache.put(etag, body)
+        return body
+
+    def _get_object(self, key):
+        """Body of the object key, for objects the remote catalogue uses"""
+        rsrc, _ = self._boto_bucket()
+
+        def _read():
+            return rsrc.meta.client.get_object(
+                Bucket=self.rules['aws']['s3_bucket_name'],
+                Key=key)['Body'].read()
+        return self._retrier.call(s3sup.retry.key_prefix(key), _read)
+
+    def _put_object(self, key, body):
+        rsrc, _ = self._boto_bucket()
+        self._retrier.call(
+            s3sup.retry.key_prefix(key), rsrc.meta.client.put_object,
+            Bucket=self.rules['aws']['s3_bucket_name'], Key=key, Body=body,
+            ACL='private')
+
+    def _read_log(self, log, remote_cat):
+        """
+        Fill remote_cat from the base and deltas of a log structured remote
+        catalogue. Those not kept locally are downloaded concurrently.
+        """
+        keys = [log.base[0]] + [key for key, _ in log.deltas]
+        bodies = {key: self._cat_cache.get_object(key) for key in keys}
+        missing = sorted(key for key, body in bodies.items() if body is None)
+        for key, body in zip(missing, s3sup.transfer.run_concurrently(
+                self._get_object, missing, self._concurrency)):
+            bodies[key] = body
+            self._cat_cache.put_object(key, body)
+        self._cat_cache.keep_objects(set(keys))
+
+        remote_cat.from_sqlite(io.BytesIO(bodies[keys[0]]))
+        for key in keys[1:]:
+            s3sup.catlog.apply_delta(remote_cat, bodies[key])
+        remote_cat.meta = dict(log.meta)
+        self._log_cat = remote_cat.snapshot()
+
+    def _write_log(self, catalogue, key):
+        """
+        Upload the changes made to the remote catalogue as a delta, or a new
+        base once the log needs compacting. Returns the log to write in place
+        of the catalogue.
+        """
+        compression = {
+            'compression': self._catalogue_compression,
+            'threads': self._catalogue_compression_threads}
+        if self._remote_log is not None and self._log_cat is not None:
+            log = s3sup.catlog.Log(self._remote_log.base, meta=catalogue.meta)
+            log.deltas = list(self._remote_log.deltas)
+            changed, removed = catalogue.delta(self._log_cat)
+            body = None
+            if len(changed) > 0 or len(removed) > 0:
+                body = s3sup.catlog.write_delta(
+                    changed, removed, **compression)
+                log.deltas.append(
+                    (s3sup.catlog.object_key(key, body), len(body)))
+            if not log.needs_compaction(
+                    self._max_deltas, self._max_delta_ratio):
+                if body is not None:
+                    self._put_object(log.deltas[-1][0], body)
+                    self._cat_cache.put_object(log.deltas[-1][0], body)
+                # Kept to make the next delta against, e.g. when watching.
+                self._log_cat = catalogue.snapshot()
+                return log
+
+        buf = io.BytesIO()
+        catalogue.to_sqlite(buf, **compression)
+        body = buf.getvalue()
+        log = s3sup.catlog.Log(
+            (s3sup.catlog.object_key(key, body), len(body)),
+            meta=catalogue.meta)
+        self._put_object(log.base[0], body)
+        self._cat_cache.put_object(log.base[0], body)
+        self._log_cat = catalogue.snapshot()
+        return log
+
+    def _read_shards(self, manifest, remote_cat):
+        """
+        Fill remote_cat from the shards of a sharded remote catalogue. Only
+        shards differing from the local catalogue are downloaded, entries of
+        the rest are the same as the local ones. With git aware hashing every
+        shard is downloaded, as the local catalogue is made using them.
+        """
+        remote_cat.meta = dict(manifest.meta)
+        wanted = set(manifest.shards)
+        if not self._git_changes:
+            local_cat = self.local_catalogue()
+            wanted = manifest.changed(s3sup.shards.shard_digests(
+                local_cat, manifest.num_shards))
+            for p in local_cat.paths():
+                i = s3sup.shards.shard_of(p, manifest.num_shards)
+                if i in manifest.shards and i not in wanted:
+                    remote_cat.add_from(local_cat, p)
+
+        def _get(key):
+            shard = s3sup.catalogue.Catalogue()
+            shard.from_sqlite(io.BytesIO(self._get_object(key)))
+            return shard
+        shards = s3sup.transfer.run_concurrently(
+            _get, [manifest.shards[i][1] for i in sorted(wanted)],
+            self._concurrency)
+        for shard in shards:
+            for p in shard.paths():
+                remote_cat.add_from(shard, p)
+
+    def _write_shards(self, catalogue, key):
+        """
+        Upload the shards of catalogue that differ from those already on S3.
+        Returns the manifest to write in place of the catalogue.
+        """
+        manifest, parts = s3sup.shards.Manifest.for_catalogue(
+            catalogue, self._catalogue_shards, key)
+        existing = set()
+        if self._remote_manifest is not None:
+            existing = self._remote_manifest.keys()
+
+        def _put(i):
+            buf = io.BytesIO()
+            parts[i].to_sqlite(
+                buf, compression=self._catalogue_compression,
+                threads=self._catalogue_compression_threads)
+            self._put_object(manifest.shards[i][1], buf.getvalue())
+        s3sup.transfer.run_concurrently(
+            _put, [i for i, (_, shard_key) in sorted(manifest.shards.items())
+                   if shard_key not in existing],
+            self._concurrency)
+        return manifest
+
+    def _delete_catalogue_objects(self, keys):
+        """
+        Delete shards, bases or deltas no longer referred to by the remote
+        catalogue. Any left behind are harmless, so failures are ignored.
+        """
+        rsrc, _ = self._boto_bucket()
+        keys = sorted(keys)
+        batches = [
+            keys[i:i + s3sup.transfer.DELETE_BATCH_SIZE]
+            for i in range(0, len(keys), s3sup.transfer.DELETE_BATCH_SIZE)]
+
+        def _delete(batch):
+            self._retrier.call(
+                '', rsrc.meta.client.delete_objects,
+                Bucket=self.rules['aws']['s3_bucket_name'],
+                Delete={'Objects': [{'Key': k} for k in batch],
+                        'Quiet': True})
+        s3sup.transfer.run_concurrently(_delete, batches, self._concurrency)
+
     def write_remote_catalogue(self, catalogue):
-        hndl, tmpp = tempfile.mkstemp()
-        os.close(hndl)
-        catalogue.to_sqlite(tmpp)
         rmt_cat_fp = self.file_prepper_wrapped('.s3sup.cat')
         _, b = self._boto_bucket()
         o = b.Object(rmt_cat_fp.s3_path())
-        with open(tmpp, 'rb') as lf:
-            o.put(Body=lf, ACL='private')
-        os.remove(tmpp)
+        stale = set()
+        for layout in (self._remote_manifest, self._remote_log):
+            if layout is not None:
+                stale |= layout.keys()
+        head = catalogue
+        if self._catalogue_shards is not None:
+            head = self._write_shards(catalogue, rmt_cat_fp.s3_path())
+        elif self._catalogue_deltas:
+            head = self._write_log(catalogue, rmt_cat_fp.s3_path())
+        if head is not catalogue:
+            stale -= head.keys()
+        buf = io.BytesIO()
+        head.to_sqlite(
+            buf, compression=self._catalogue_compression,
+            threads=self._catalogue_compression_threads)
+        body = buf.getvalue()
+        resp = self._retrier.call('', o.put, Body=body, ACL='private')
+        self._cat_cache.put(resp['ETag'], body)
+        self._remote_manifest = None
+        self._remote_log = None
+        if isinstance(head, s3sup.shards.Manifest):
+            self._remote_manifest = head
+        elif isinstance(head, s3sup.catlog.Log):
+            self._remote_log = head
+            self._cat_cache.keep_objects(head.keys())
+        if len(stale) > 0:
+            self._delete_catalogue_objects(stale)
 
         # Deliberately break older s3sup clients <= 0.3.0.
         # This file even needs uploading even for projects that have never used
@@ -183,22 +632,55 @@ class Project:
             b'catalogue format It is not used any more and this file is only '
             b'here to cause s3sup clients <= 0.3.0 to fail, rather than have '
             b'them try to upload everything again.')
-        b.Object(old_rmt_cat_fp.s3_path()).put(Body=the_breaker, ACL='private')
+        self._retrier.call(
+            '', b.Object(old_rmt_cat_fp.s3_path()).put,
+            Body=the_breaker, ACL='private')
 
-    def calculate_diff(self):
-        local_cat = self.local_catalogue()
-        remote_cat = self.get_remote_catalogue()
-        diff, new_remote_cat = local_cat.diff_dict(remote_cat)
+    def _journal_target(self):
+        return [self.rules['aws']['s3_bucket_name'],
+                self.file_prepper_wrapped('.s3sup.cat').s3_path()]
+
+    @functools.lru_cache(maxsize=8)
+    def _journal_fingerprint(self):
+        return s3sup.journal.fingerprint(
+            self._journal_target(), self.get_remote_catalogue())
+
+    def remote_catalogue_with_journal(self):
+        """
+        Remote catalogue with changes made by an interrupted push applied.
+        Returns (catalogue, number of changes already made).
+        """
+        if not self._journal.exists():
+            # Fingerprinting hashes the whole catalogue, only worth doing
+            # when there is a journal to check.
+            return self.get_remote_catalogue(), 0
+        return self._journal.apply(
+            self.get_remote_catalogue(), self._journal_fingerprint())
+
+    def calculate_diff(self, unchanged=False):
+        """
+        (diff, remote catalogue once synced). Unchanged files are only
+        listed in the diff if unchanged is True.
+        """
+        remote_cat, _ = self.remote_catalogue_with_journal()
+        return self._calculate_diff(remote_cat, unchanged=unchanged)
+
+    def _calculate_diff(self, remote_cat, unchanged=False):
+        """calculate_diff() against remote_cat"""
+        diff, new_remote_cat = self.local_catalogue().diff_dict(
+            remote_cat, unchanged=unchanged)
         return (diff, new_remote_cat)
 
     def sync(self):
         self.remote_preflight_checks()
-        diff, new_remote_cat = self.calculate_diff()
+        remote_cat, num_resumed = self.remote_catalogue_with_journal()
+        diff, new_remote_cat = self._calculate_diff(remote_cat)
         changes = s3sup.catalogue.change_list(diff)
-        changes_with_prep = [
-            (cr, p, self.file_prepper_wrapped(p)) for cr, p in changes]
 
-        if len(changes) <= 0:
+        if len(changes) <= 0 and num_resumed <= 0:
+            if not self.dryrun:
+                self._pushed_cat = new_remote_cat
+                self._prune_artifacts()
             return changes
 
         if self.dryrun:
@@ -206,7 +688,192 @@ class Project:
                 'Not making any changes as this is a dry run.', fg='blue'))
             return changes
 
-        _, b = self._boto_bucket()
+        if num_resumed > 0:
+            click.echo(click.style(
+                'Resuming interrupted push, skipping {0} changes already '
+                'made.'.format(num_resumed), fg='blue'))
+        self._journal.start(self._journal_fingerprint())
+        try:
+            failures = self._apply_changes(diff, changes, new_remote_cat)
+        finally:
+            self._journal.close()
+
+        self._keep_failed_deletes(failures, new_remote_cat, remote_cat)
+
+        self.write_remote_catalogue(new_remote_cat)
+        self._journal.remove()
+        self._pushed_cat = new_remote_cat
+        self._prune_artifacts()
+        if self.verbose:
+            s3sup.utils.pprint_h3('S3 connection metrics')
+            s3sup.utils.pprint_dict(self.metrics.summary())
+        return changes
+
+    def _prune_artifacts(self):
+        """Remove compressed artifacts no longer used by any local file"""
+        s3sup.compression.ArtifactStore(self.local_project_root).prune(
+            {ch for _, (ch, _) in self.local_catalogue().items()})
+
+    @staticmethod
+    def _keep_failed_deletes(failures, new_remote_cat, remote_cat):
+        """
+        Files that could not be deleted are still on S3, so must stay in the
+        catalogue to be retried on the next push. remote_cat is the
+        catalogue the diff was calculated against.
+        """
+        for (cr, p, fp), code, msg in failures:
+            click.echo(click.style(
+                'Could not delete {0}: {1} {2}'.format(
+                    fp.s3_path(), code, msg), fg='red'), err=True)
+            new_remote_cat.add_from(remote_cat, p)
+
+    def _refresh_local_paths(self, local_cat, paths):
+        """
+        Bring the local catalogue up to date for project relative paths,
+        which may be files or directories, present or deleted. Returns every
+        catalogue path that may have changed.
+        """
+        affected = set()
+        fps = []
+        gone_dirs = []
+        for path in paths:
+            path = os.path.normpath(path)
+            try:
+                st = os.stat(self._local_fs_path(path))
+            except (FileNotFoundError, NotADirectoryError):
+                gone_dirs.append(path + os.sep)
+                affected.add(path)
+                continue
+            if os.path.isdir(self._local_fs_path(path)):
+                gone_dirs.append(path + os.sep)
+                if s3sup.walker.walked(path, self._path_filter):
+                    for rel_path, sub_st in s3sup.walker.walk(
+                            str(self.local_project_root), self._path_filter,
+                            top=path):
+                        affected.add(rel_path)
+                        fps.append((rel_path, sub_st))
+            else:
+                affected.add(path)
+                if s3sup.walker.walked(path, self._path_filter):
+                    fps.append((path, st))
+        if len(gone_dirs) > 0:
+            # Whatever was beneath a deleted, moved or excluded directory.
+            prefixes = tuple(gone_dirs)
+            affected.update(
+                p for p in local_cat.paths() if p.startswith(prefixes))
+
+        for p in affected:
+            local_cat.remove(p)
+            self._fp_cache.pop(p, None)
+        fps = [self.file_prepper_wrapped(p, local_stat=st) for p, st in fps]
+        s3sup.hashing.hash_content(
+            fps, workers=self._hash_workers, engine=self._hash_engine)
+        for fp in fps:
+            local_cat.add_file(
+                fp.path, fp.content_hash(), fp.attributes_hash(),
+                size=fp.known_size())
+        self._hash_cache.save()
+        return affected
+
+    def calculate_paths_diff(self, paths, unchanged=False):
+        """
+        Like calculate_diff(), but only for the given project relative paths,
+        such as those reported by filesystem events after a push. Local and
+        remote catalogues are kept in memory and updated, rather than walking
+        the project and downloading the remote catalogue again. Directories
+        stand for everything within them. The returned catalogue only holds
+        the paths looked at, pass it on to sync_paths_diff().
+        """
+        local_cat = self.local_catalogue()
+        remote_cat = self._pushed_cat
+        if remote_cat is None:
+            remote_cat, _ = self.remote_catalogue_with_journal()
+        lcl = s3sup.catalogue.Catalogue(
+            preserve_deleted_files=self._preserve_deleted_files)
+        rmt = s3sup.catalogue.Catalogue(
+            preserve_deleted_files=self._preserve_deleted_files)
+        for p in self._refresh_local_paths(local_cat, paths):
+            for cat, sub_cat in ((local_cat, lcl), (remote_cat, rmt)):
+                try:
+                    sub_cat.add_from(cat, p)
+                except KeyError:
+                    pass
+        return lcl.diff_dict(rmt, unchanged=unchanged)
+
+    def sync_paths_diff(self, diff, new_remote_paths_cat):
+        """
+        Make changes from calculate_paths_diff() on S3, then write the
+        remote catalogue with them merged in.
+        """
+        changes = s3sup.catalogue.change_list(diff)
+        if len(changes) <= 0:
+            return changes
+        if self.dryrun:
+            click.echo(click.style(
+                'Not making any changes as this is a dry run.', fg='blue'))
+            return changes
+        remote_cat = self._pushed_cat
+        if remote_cat is None:
+            remote_cat = self.remote_catalogue_with_journal()[0].snapshot()
+
+        self._journal.start(s3sup.journal.fingerprint(
+            self._journal_target(), remote_cat))
+        try:
+            failures = self._apply_changes(
+                diff, changes, new_remote_paths_cat)
+        finally:
+            self._journal.close()
+
+        self._keep_failed_deletes(failures, new_remote_paths_cat, remote_cat)
+        s3sup.gitstatus.mark_dirty(remote_cat.meta, [p for _, p in changes])
+        for p in diff['delete'] + [old for old, _ in diff['moved']]:
+            remote_cat.remove(p)
+        for p in new_remote_paths_cat.paths():
+            remote_cat.add_from(new_remote_paths_cat, p)
+
+        self.write_remote_catalogue(remote_cat)
+        self._journal.remove()
+        self._pushed_cat = remote_cat
+        self._prune_artifacts()
+        return changes
+
+    def _deduplicate(self, diff, phases, new_remote_cat, dependencies):
+        """
+        Replace uploads of content already on S3, or uploaded earlier in the
+        push, with server-side copies.
+        """
+        if not self._deduplicate_uploads:
+            return phases
+        uploads = (
+            diff['upload']['new_files'] + diff['upload']['content_changed'])
+        if len(uploads) == 0:
+            return phases
+        wanted = {new_remote_cat.get(p)[0] for p in uploads}
+        not_on_s3 = set(uploads) | {new for _, new in diff['moved']}
+        # Objects whose content is the same before and after the push, and
+        # is needed by an upload.
+        sources = {}
+        for p in new_remote_cat.paths():
+            if p in not_on_s3:
+                continue
+            content_hash, _ = new_remote_cat.get(p)
+            if content_hash in wanted and (
+                    content_hash not in sources or p < sources[content_hash]):
+                sources[content_hash] = p
+        existing = {h: self.file_prepper_wrapped(p).s3_path()
+                    for h, p in sources.items()}
+        return s3sup.transfer.deduplicate(
+            phases, lambda p: new_remote_cat.get(p)[0], existing,
+            dependencies=dependencies)
+
+    def _apply_changes(self, diff, changes, new_remote_cat):
+        """
+        Make changes on S3, recording each one in the journal as it completes.
+        Returns deletions S3 refused to make.
+        """
+        if len(changes) <= 0:
+            return []
+        executor = self._executor()
 
         def display_current(item):
             if item is None:
@@ -223,31 +890,51 @@ class Project:
                 cur += ' ({0})'.format(humanize.naturalsize(fp.size()))
             return cur
 
-        with click.progressbar(changes_with_prep, label='Syncing to S3',
+        moved_from = {new: old for old, new in diff['moved']}
+
+        def change_item(cr, p):
+            fp = self.file_prepper_wrapped(p)
+            if cr == s3sup.catalogue.ChangeReason.MOVED:
+                fp = s3sup.transfer.ServerSideCopy(
+                    fp, self.file_prepper_wrapped(moved_from[p]).s3_path())
+            return (cr, p, fp)
+
+        use_graph = self._scheduler == 'graph'
+        phases = [
+            [change_item(cr, p) for cr, p in phase]
+            for phase in s3sup.catalogue.change_phases(
+                changes, html_last=not use_graph)]
+        dependencies = None
+        if use_graph:
+            dependencies = s3sup.dependencies.dependency_graph(
+                [item for phase in phases for item in phase])
+        phases = self._deduplicate(
+            diff, phases, new_remote_cat, dependencies)
+
+        with click.progressbar(length=len(changes), label='Syncing to S3',
                                item_show_func=display_current) as bar:
-            for cr, p, fp in bar:
-                o = b.Object(fp.s3_path())
-                if cr == s3sup.catalogue.ChangeReason['NEW_FILE']:
-                    with fp.content_fileobj() as lf:
-                        o.put(Body=lf, **fp.attributes_as_boto_args())
-                elif cr == s3sup.catalogue.ChangeReason['CONTENT_CHANGED']:
-                    with fp.content_fileobj() as lf:
-                        o.put(Body=lf, **fp.attributes_as_boto_args())
-                elif cr == s3sup.catalogue.ChangeReason['ATTRIBUTES_CHANGED']:
-                    o.copy_from(
-                        CopySource={
-                            'Bucket': self.rules['aws']['s3_bucket_name'],
-                            'Key': fp.s3_path()},
-                        MetadataDirective='REPLACE',
-                        TaggingDirective='REPLACE',
-                        **fp.attributes_as_boto_args())
-                elif cr == s3sup.catalogue.ChangeReason['DELETED']:
-                    o.delete()
+            def on_done(item):
+                cr, p, fp = item
+                if cr == s3sup.catalogue.ChangeReason.DELETED:
+                    self._journal.record(cr, p)
                 else:
-                    raise Exception('Unknown ChangeReason: {0}'.format(cr))
-
-        self.write_remote_catalogue(new_remote_cat)
-        return changes
+                    # Size of the content uploaded, which for pre-compressed
+                    # files is not known until it has been compressed.
+                    new_remote_cat.set_size(p, fp.size())
+                    if fp.etag is not None:
+                        new_remote_cat.set_etag(p, fp.etag)
+                    ch, ah = new_remote_cat.get(p)
+                    size, etag = new_remote_cat.get_object(p)
+                    self._journal.record(
+                        cr, p, ch, ah, size=size, etag=etag)
+                bar.current_item = item
+                bar.update(1)
+            failures = executor.run(
+                phases, on_done=on_done, dependencies=dependencies)
+
+        for (cr, p, _), _, _ in failures:
+            self._journal.forget(p)
+        return failures
 
     def print_summary(self):
         lcl_dir = click.format_filename(self.local_project_root)
@@ -0,0 +1,200 @@
+"""
+Retrying of S3 requests that fail for temporary reasons, such as throttling
+(503 SlowDown) or a dropped connection.
+
+Retries back off exponentially with full jitter. Requests are also paced by
+an adaptive token bucket per key prefix: the permitted rate is cut in half
+whenever S3 throttles a prefix and creeps back up with each success (AIMD),
+so one hot directory being throttled does not slow down the rest of a push.
+"""
+import time
+import random
+import asyncio
+import threading
+
+import botocore.exceptions
+
+
+DEFAULT_MAX_ATTEMPTS = 8
+# S3 supports at least 3,500 PUT/COPY/POST/DELETE requests per second per
+# prefix, so start there and only slow down when told to.
+DEFAULT_MAX_REQUESTS_PER_SECOND = 3500
+MIN_REQUESTS_PER_SECOND = 1
+
+THROTTLE_ERROR_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'ServiceUnavailable',
+    '503'
+}
+TRANSIENT_ERROR_CODES = {
+    'InternalError',
+    'RequestTimeout',
+    'RequestTimeoutException',
+    '500',
+    '502',
+    '504'
+}
+
+
+def key_prefix(key):
+    """Prefix used to group keys for rate limiting, e.g. 'assets/img'"""
+    return key.rsplit('/', 1)[0] if '/' in key else ''
+
+
+def classify_error(exc):
+    """
+    Returns 'throttle' if S3 asked us to slow down, 'transient' for other
+    errors worth retrying, or None if the error should not be retried.
+    """
+    if isinstance(exc, botocore.exceptions.ClientError):
+        err = exc.response.get('Error', {})
+        code = str(err.get('Code', ''))
+        status = str(exc.response.get(
+            'ResponseMetadata', {}).get('HTTPStatusCode', ''))
+        if code in THROTTLE_ERROR_CODES or status in THROTTLE_ERROR_CODES:
+            return 'throttle'
+        if code in TRANSIENT_ERROR_CODES or status in TRANSIENT_ERROR_CODES:
+            return 'transient'
+        return None
+    if isinstance(exc, (botocore.exceptions.HTTPClientError,
+                        botocore.exceptions.ConnectionError,
+                        ConnectionError, TimeoutError)):
+        return 'transient'
+    return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket per key prefix with an adaptive rate. Tokens may be borrowed,
+    in which case reserve() returns how long the caller must wait before
+    making its request. This lets threads (time.sleep) and coroutines
+    (asyncio.sleep) share the same limiter.
+    """
+
+    def __init__(self, max_rate=DEFAULT_MAX_REQUESTS_PER_SECOND,
+                 min_rate=MIN_REQUESTS_PER_SECOND, increase=1.0,
+                 decrease_factor=0.5, clock=time.monotonic):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, prefix):
+        try:
+            return self._buckets[prefix]
+        except KeyError:
+            b = {'rate': self.max_rate, 'tokens': float(self.max_rate),
+                 'last': self.clock()}
+            self._buckets[prefix] = b
+            return b
+
+    def rate(self, prefix):
+        with self._lock:
+            return self._bucket(prefix)['rate']
+
+    def reserve(self, prefix):
+        """Take a token, returning seconds to wait before using it"""
+        with self._lock:
+            b = self._bucket(prefix)
+            now = self.clock()
+            b['tokens'] = min(
+                b['rate'], b['tokens'] + (now - b['last']) * b['rate'])
+            b['last'] = now
+            b['tokens'] -= 1
+            if b['tokens'] >= 0:
+                return 0.0
+            return -b['tokens'] / b['rate']
+
+    def on_success(self, prefix):
+        with self._lock:
+            b = self._bucket(prefix)
+            b['rate'] = min(self.max_rate, b['rate'] + self.increase)
+
+    def on_throttle(self, prefix):
+        with self._lock:
+            b = self._bucket(prefix)
+            b['rate'] = max(self.min_rate, b['rate'] * self.decrease_factor)
+            b['tokens'] = min(b['tokens'], b['rate'])
+
+
+class Retrier:
+    """
+    Calls a function, retrying temporary failures with jittered exponential
+    backoff, pacing each attempt through the rate limiter.
+    """
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, limiter=None,
+                 base_delay=0.1, max_delay=20.0, metrics=None,
+                 sleep=time.sleep, async_sleep=asyncio.sleep):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.max_attempts = max_attempts
+        self.limiter = limiter
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self.sleep = sleep
+        self.async_sleep = async_sleep
+
+    def backoff(self, attempt):
+        """Full jitter: anywhere between zero and the exponential cap"""
+        cap = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+    def _before_attempt(self, prefix):
+        if self.limiter is None:
+            return 0.0
+        return self.limiter.reserve(prefix)
+
+    def _after_success(self, prefix):
+        if self.limiter is not None:
+            self.limiter.on_success(prefix)
+
+    def _after_failure(self, prefix, exc, attempt):
+        """Seconds to wait before retrying, or re-raises if giving up"""
+        kind = classify_error(exc)
+        if kind is None or attempt >= self.max_attempts:
+            raise exc
+        if kind == 'throttle' and self.limiter is not None:
+            self.limiter.on_throttle(prefix)
+        if self.metrics is not None:
+            self.metrics.record_retry(kind)
+        return self.backoff(attempt)
+
+    def call(self, prefix, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = self._before_attempt(prefix)
+            if wait > 0:
+                self.sleep(wait)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.sleep(self._after_failure(prefix, e, attempt))
+                continue
+            self._after_success(prefix)
+            return result
+
+    async def call_async(self, prefix, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = self._before_attempt(prefix)
+            if wait > 0:
+                await self.async_sleep(wait)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                await self.async_sleep(self._after_failure(prefix, e, attempt))
+                continue
+            self._after_success(prefix)
+            return result
@@ -8,6 +8,7 @@ sys.path.insert(
     0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
 import s3sup.project  # noqa: E402
 import s3sup.catalogue  # noqa: E402
+import s3sup.watch  # noqa: E402
 
 
 def common_options(f):
@@ -40,6 +41,10 @@ def options_for_remotes(f):
             help=('Do not delete any files on S3, add/modify operations only. '
                   'Alternatively set "preserve_deleted_files" '
                   'in s3sup.toml.')),
+        click.option(
+            '--rehash', is_flag=True,
+            help=('Hash the content of every file again, rather than trusting '
+                  'hashes cached for files that appear unchanged.')),
     ]
     return functools.reduce(lambda x, opt: opt(x), options, f)
 
@@ -102,14 +107,14 @@ def init(projectdir, verbose):
 @cli.command()
 @common_options
 @options_for_remotes
-def status(projectdir, verbose, dryrun, nodelete):
+def status(projectdir, verbose, dryrun, nodelete, rehash):
     """
     Show S3 changes that will be made on next push.
     """
     click.echo('S3 site uploader. Using:')
     p = s3sup.project.Project(
         projectdir, dryrun=dryrun, preserve_deleted_files=nodelete,
-        verbose=verbose)
+        verbose=verbose, rehash=rehash)
     if verbose or projectdir != '.':
         click.echo(' * Local project directory: {0}'.format(projectdir))
 
@@ -155,7 +160,11 @@ def inspect(local_file, projectdir, verbose):
 @cli.command()
 @common_options
 @options_for_remotes
-def push(projectdir, verbose, dryrun, nodelete):
+@click.option(
+    '-c', '--concurrency', type=click.IntRange(min=1),
+    help=('Number of S3 operations to run at the same time. Alternatively '
+          'set "concurrency" in the [transfer] section of s3sup.toml.'))
+def push(projectdir, verbose, dryrun, nodelete, rehash, concurrency):
     """
     Synchronise local static site to S3.
 
@@ -166,12 +175,70 @@ def push(projectdir, verbose, dryrun, nodelete):
     """
     p = s3sup.project.Project(
         projectdir, dryrun=dryrun, preserve_deleted_files=nodelete,
-        verbose=verbose)
+        verbose=verbose, concurrency=concurrency, rehash=rehash)
     diff, _ = p.calculate_diff()
     s3sup.catalogue.print_diff_summary(diff, verbose=verbose)
     p.sync()
     click.echo(click.style('Done!', fg='green'))
 
 
+@cli.command()
+@common_options
+@options_for_remotes
+@click.option(
+    '-c', '--concurrency', type=click.IntRange(min=1),
+    help=('Number of S3 operations to run at the same time. Alternatively '
+          'set "concurrency" in the [transfer] section of s3sup.toml.'))
+@click.option(
+    '-q', '--quiet-period', type=click.FloatRange(min=0),
+    default=s3sup.watch.DEFAULT_QUIET_SECONDS, show_default=True,
+    help=('Seconds without any further changes to wait for before pushing, '
+          'so bursts of changes are pushed together.'))
+def watch(projectdir, verbose, dryrun, nodelete, rehash, concurrency,
+          quiet_period):
+    """
+    Push, then keep pushing local changes as they are made.
+
+    Only files that changed since the last push are looked at and synced,
+    the project is not scanned again. Stop with Ctrl+C. Requires installing
+    with "pip3 install s3sup[watch]".
+    """
+    p = s3sup.project.Project(
+        projectdir, dryrun=dryrun, preserve_deleted_files=nodelete,
+        verbose=verbose, concurrency=concurrency, rehash=rehash)
+    debouncer = s3sup.watch.Debouncer(quiet_seconds=quiet_period)
+    with s3sup.watch.Watcher(projectdir, debouncer=debouncer) as w:
+        diff, _ = p.calculate_diff()
+        s3sup.catalogue.print_diff_summary(diff, verbose=verbose)
+        p.sync()
+        click.echo(click.style(
+            'Watching for changes, press Ctrl+C to stop.', fg='green'))
+        for paths in w.batches():
+            try:
+                diff, new_remote_cat = p.calculate_paths_diff(paths)
+            except FileNotFoundError:
+                # Deleted while being hashed, look again once it settles.
+                for path in paths:
+                    debouncer.add(path)
+                continue
+            if diff['num_changes'] <= 0:
+                continue
+            s3sup.catalogue.print_diff_summary(diff, verbose=verbose)
+            try:
+                p.sync_paths_diff(diff, new_remote_cat)
+            except (FileNotFoundError, click.FileError) as e:
+                # Deleted or changed again before it was uploaded, push the
+                # batch again once it settles.
+                if isinstance(e, click.FileError):
+                    e = e.format_message()
+                click.echo(click.style(
+                    '{0}\nPushing again once changes settle.'.format(e),
+                    fg='blue'), err=True)
+                for path in paths:
+                    debouncer.add(path)
+                continue
+            click.echo(click.style('Done!', fg='green'))
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,134 @@
+"""
+Sharded remote catalogue, for projects of very many files.
+
+With `shards` set in the [catalogue] section of s3sup.toml, the remote
+catalogue object holds a small manifest instead of every file. Files are
+split between a fixed number of shards by a hash of their path, and each
+shard is stored as a catalogue object of its own. The manifest lists the
+shards along with a digest of the hashes of the files each one holds.
+
+The same digests are worked out for the local catalogue before diffing.
+Shards whose digests match hold exactly the local hashes, so only the others
+are downloaded. After a push only shards whose digests have changed are
+uploaded. Shard keys include the digest, so the manifest, which is uploaded
+last, never refers to a partly written shard. Shards it no longer refers to
+are deleted afterwards.
+
+Manifests are schema version 4, so s3sup versions without sharding support
+refuse to push to the project rather than treating it as never pushed.
+"""
+import hashlib
+
+import s3sup.catalogue
+
+
+MANIFEST_SCHEMA_VERSION = 4
+
+
+def shard_of(path, num_shards):
+    h = hashlib.sha256(path.encode('utf-8', 'surrogatepass')).digest()
+    return int.from_bytes(h[:4], 'big') % num_shards
+
+
+def shard_digests(catalogue, num_shards):
+    """shard: digest of the paths and hashes of every file in it"""
+    hashers = {}
+    for path, (ch, ah) in catalogue.items():
+        i = shard_of(path, num_shards)
+        try:
+            h = hashers[i]
+        except KeyError:
+            h = hashers[i] = hashlib.sha256()
+        h.update('{0}\0{1}\0{2}\0'.format(path, ch, ah).encode(
+            'utf-8', 'surrogatepass'))
+    return {i: h.hexdigest() for i, h in hashers.items()}
+
+
+def partition(catalogue, num_shards):
+    """shard: Catalogue of the files in it, including sizes and ETags"""
+    parts = {}
+    for path in catalogue.paths():
+        i = shard_of(path, num_shards)
+        try:
+            part = parts[i]
+        except KeyError:
+            part = parts[i] = s3sup.catalogue.Catalogue()
+        part.add_from(catalogue, path)
+    return parts
+
+
+def shard_key(catalogue_key, shard, digest):
+    return '{0}.shards/{1:05d}-{2}'.format(catalogue_key, shard, digest[:16])
+
+
+def is_manifest(c):
+    """Whether open SQLite connection c is to a manifest"""
+    return c.execute('PRAGMA user_version').fetchone()[0] == (
+        MANIFEST_SCHEMA_VERSION)
+
+
+class Manifest:
+
+    def __init__(self, num_shards, meta=None):
+        self.num_shards = num_shards
+        # shard: (digest, S3 key)
+        self.shards = {}
+        # Catalogue metadata, e.g. the git commit pushed.
+        self.meta = {} if meta is None else dict(meta)
+
+    @classmethod
+    def for_catalogue(cls, catalogue, num_shards, catalogue_key):
+        """
+        Manifest for writing catalogue as shards. Returns (manifest, shard:
+        Catalogue of the files in it).
+        """
+        manifest = cls(num_shards, meta=catalogue.meta)
+        parts = partition(catalogue, num_shards)
+        for i, digest in shard_digests(catalogue, num_shards).items():
+            manifest.shards[i] = (
+                digest, shard_key(catalogue_key, i, digest))
+        return manifest, parts
+
+    def keys(self):
+        return {key for _, key in self.shards.values()}
+
+    def changed(self, digests):
+        """Shards in the manifest whose digests differ from digests"""
+        return {i for i, (digest, _) in self.shards.items()
+                if digests.get(i) != digest}
+
+    @classmethod
+    def from_connection(cls, c):
+        """Read a manifest from an open SQLite connection"""
+        manifest = cls(int(c.execute(
+            "SELECT value FROM manifest WHERE key = 'num_shards'"
+        ).fetchone()[0]))
+        manifest.shards = {
+            row[0]: (row[1], row[2])
+            for row in c.execute('SELECT shard, digest, key FROM shards')}
+        manifest.meta = {
+            row[0]: row[1]
+            for row in c.execute('SELECT key, value FROM meta')}
+        return manifest
+
+    def to_sqlite(self, dest, compression='gzip', threads=1):
+        with s3sup.catalogue.write_gzipped_sqlite(
+                dest, compression, threads) as c:
+            c.execute('PRAGMA user_version = {v:d}'.format(
+                v=MANIFEST_SCHEMA_VERSION))
+            c.execute(
+                'CREATE TABLE manifest (key TEXT PRIMARY KEY, value TEXT)')
+            c.execute(
+                "INSERT INTO manifest VALUES ('num_shards', ?)",
+                (str(self.num_shards),))
+            c.execute('''CREATE TABLE shards (
+                shard INTEGER PRIMARY KEY,
+                digest TEXT,
+                key TEXT)''')
+            c.executemany(
+                'INSERT INTO shards VALUES (?, ?, ?)',
+                ((i, digest, key)
+                 for i, (digest, key) in sorted(self.shards.items())))
+            c.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            c.executemany(
+                'INSERT INTO meta VALUES (?, ?)', sorted(self.meta.items()))
@@ -0,0 +1,498 @@
+import base64
+import hashlib
+import collections
+import concurrent.futures
+
+import click
+
+import s3sup.catalogue
+import s3sup.retry
+
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_MAX_INFLIGHT_MB = 64
+
+DEFAULT_MULTIPART_THRESHOLD_MB = 64
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 16
+DEFAULT_MULTIPART_CONCURRENCY = 4
+MULTIPART_MAX_PARTS = 10000
+DELETE_BATCH_SIZE = 1000
+MB = 1024 * 1024
+# Largest object S3 can copy in a single CopyObject request.
+COPY_MAX_BYTES = 5 * 1024 * MB
+
+
+def multipart_part_size(size, chunksize):
+    """
+    Part size to use for a multipart upload of size bytes. The configured
+    chunksize is used unless it would need more parts than S3 allows, in which
+    case the smallest whole number of megabytes that fits is used instead.
+    """
+    min_part_size = -(-size // MULTIPART_MAX_PARTS)
+    if min_part_size <= chunksize:
+        return chunksize
+    return -(-min_part_size // MB) * MB
+
+
+def sha256_checksum(data):
+    """Base64 SHA-256 digest of data, as sent in x-amz-checksum-sha256"""
+    return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+
+def _content_changed_error(fp):
+    return click.FileError(
+        fp.path, hint='changed during the push, run s3sup push again')
+
+
+def read_verified(fp):
+    """
+    Read the content of fp for a single request upload, hashing it in the
+    same pass. Returns (body, checksum), checksum being for
+    x-amz-checksum-sha256 so S3 rejects a body corrupted on the way. Raises
+    click.FileError if the content no longer matches its catalogued hash.
+    """
+    with fp.content_fileobj() as lf:
+        body = lf.read()
+    sha = hashlib.sha256(body)
+    if sha.hexdigest() != fp.content_hash():
+        raise _content_changed_error(fp)
+    return body, base64.b64encode(sha.digest()).decode('ascii')
+
+
+class ServerSideCopy:
+    """
+    Stands in for the FilePrepper of a file that does not need uploading,
+    because an object with identical content is already on S3. The object is
+    created by copying source_key, with the file's own attributes.
+    """
+
+    def __init__(self, fp, source_key):
+        self.fp = fp
+        self.source_key = source_key
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+def deduplicate(phases, content_hash, existing=None, dependencies=None):
+    """
+    Upload each distinct piece of content once. Phases are lists of
+    (ChangeReason, path, FilePrepper) items, as passed to Executor.run().
+
+    content_hash is called with a path to get the hash of its content.
+    existing maps content hashes to S3 keys of objects already holding that
+    content, which will not change during the push.
+
+    New and changed files whose content is in existing, or is uploaded in an
+    earlier phase, become server-side copies in the same phase. Duplicates
+    of content uploaded in the same phase are copied in a phase of their own
+    straight after it. Or, if a dependencies dict is given, they stay in the
+    same phase and the path they are copied from is added to their
+    dependencies. Returns the new list of phases.
+    """
+    available = dict(existing or {})
+    deduped = []
+    for phase in phases:
+        uploads, later_copies = [], []
+        uploading = {}
+        for cr, p, fp in phase:
+            if cr not in (s3sup.catalogue.ChangeReason.NEW_FILE,
+                          s3sup.catalogue.ChangeReason.CONTENT_CHANGED):
+                uploads.append((cr, p, fp))
+                continue
+            h = content_hash(p)
+            if h in available:
+                uploads.append((cr, p, ServerSideCopy(fp, available[h])))
+            elif h in uploading:
+                source_path, source_key = uploading[h]
+                item = (cr, p, ServerSideCopy(fp, source_key))
+                if dependencies is None:
+                    later_copies.append(item)
+                else:
+                    dependencies.setdefault(p, set()).add(source_path)
+                    uploads.append(item)
+            else:
+                uploading[h] = (p, fp.s3_path())
+                uploads.append((cr, p, fp))
+        deduped += [ph for ph in (uploads, later_copies) if len(ph) > 0]
+        available.update({h: key for h, (_, key) in uploading.items()})
+    return deduped
+
+
+class S3Operations:
+    """
+    Carries out an individual change on S3. Only uses a boto3 client, which
+    (unlike boto3 resources) is safe to share between threads.
+
+    Files of multipart_threshold bytes or more are uploaded, or copied on
+    S3, in parts, with multipart_concurrency parts in flight at once. A
+    failed part is retried on its own, without restarting the whole upload.
+
+    Every request goes through the retrier, so temporary failures and
+    throttling are retried and paced per key prefix.
+    """
+
+    def __init__(self, client, bucket_name,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD_MB * MB,
+                 multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE_MB * MB,
+                 multipart_concurrency=DEFAULT_MULTIPART_CONCURRENCY,
+                 retrier=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.multipart_concurrency = multipart_concurrency
+        if retrier is None:
+            retrier = s3sup.retry.Retrier(
+                limiter=s3sup.retry.AdaptiveRateLimiter())
+        self.retrier = retrier
+
+    def _request(self, method, key, **kwargs):
+        return self.retrier.call(
+            s3sup.retry.key_prefix(key), getattr(self.client, method),
+            Bucket=self.bucket_name, Key=key, **kwargs)
+
+    def __call__(self, cr, fp):
+        if cr in (s3sup.catalogue.ChangeReason.NEW_FILE,
+                  s3sup.catalogue.ChangeReason.CONTENT_CHANGED,
+                  s3sup.catalogue.ChangeReason.MOVED):
+            self.put(fp)
+        elif cr == s3sup.catalogue.ChangeReason.ATTRIBUTES_CHANGED:
+            self.copy_attributes(fp)
+        elif cr == s3sup.catalogue.ChangeReason.DELETED:
+            self.delete(fp)
+        else:
+            raise Exception('Unknown ChangeReason: {0}'.format(cr))
+
+    def inflight_bytes(self, cr, fp):
+        """Most bytes held in memory or on the wire at once for this change"""
+        nbytes = transfer_size(cr, fp)
+        if nbytes >= self.multipart_threshold:
+            part_size = multipart_part_size(nbytes, self.multipart_chunksize)
+            return min(nbytes, part_size * self.multipart_concurrency)
+        return nbytes
+
+    def put(self, fp):
+        if isinstance(fp, ServerSideCopy):
+            self.copy(fp)
+            return
+        if fp.size() >= self.multipart_threshold:
+            self.put_multipart(fp)
+            return
+
+        # Read once, also checking the content against its catalogued hash.
+        # Retries send the same bytes rather than reading the file again.
+        body, checksum = read_verified(fp)
+        resp = self._request(
+            'put_object', fp.s3_path(), Body=body, ChecksumSHA256=checksum,
+            **fp.attributes_as_boto_args())
+        fp.etag = resp.get('ETag')
+
+    def put_multipart(self, fp):
+        def upload_part(key, upload_id, part_number, offset, part_size):
+            with fp.content_fileobj() as lf:
+                lf.seek(offset)
+                body = lf.read(part_size)
+            checksum = sha256_checksum(body)
+            resp = self._request(
+                'upload_part', key, UploadId=upload_id,
+                PartNumber=part_number, Body=body, ChecksumSHA256=checksum)
+            return {'ETag': resp['ETag'], 'ChecksumSHA256': checksum}
+
+        def check_unchanged():
+            # Parts are read out of order, so rather than hashing the whole
+            # file again compare its size and modification time.
+            if fp.content_changed():
+                raise _content_changed_error(fp)
+        self._multipart(
+            fp, upload_part, before_complete=check_unchanged,
+            ChecksumAlgorithm='SHA256')
+
+    def _multipart(self, fp, send_part, before_complete=None, **create_args):
+        """
+        Create the object for fp using a multipart upload, with parts sent
+        concurrently by send_part(key, upload_id, part_number, offset,
+        part_size), which returns a dict of the part's ETag and any checksum.
+        before_complete is called once every part is sent. The upload is
+        aborted if any part cannot be sent or before_complete raises. Sets
+        the ETag of fp to that of the completed object.
+        """
+        size = fp.size()
+        part_size = multipart_part_size(size, self.multipart_chunksize)
+        key = fp.s3_path()
+        mpu = self._request(
+            'create_multipart_upload', key, **create_args,
+            **fp.attributes_as_boto_args())
+        upload_id = mpu['UploadId']
+
+        def part(part_number):
+            offset = (part_number - 1) * part_size
+            sent = send_part(
+                key, upload_id, part_number, offset,
+                min(part_size, size - offset))
+            return dict(sent, PartNumber=part_number)
+
+        num_parts = max(1, -(-size // part_size))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.multipart_concurrency) as pool:
+                parts = list(pool.map(part, range(1, num_parts + 1)))
+            if before_complete is not None:
+                before_complete()
+            resp = self._request(
+                'complete_multipart_upload', key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except BaseException:
+            self._request('abort_multipart_upload', key, UploadId=upload_id)
+            raise
+        fp.etag = resp.get('ETag')
+
+    def copy_attributes(self, fp):
+        self._copy(fp.s3_path(), fp)
+
+    def copy(self, fp):
+        """Create a file by copying an object on S3 with the same content"""
+        self._copy(fp.source_key, fp)
+
+    def _copy(self, source_key, fp):
+        """
+        Server-side copy of source_key to fp, replacing its attributes. Large
+        objects, including any too big for CopyObject, are copied in parts.
+        """
+        size = fp.size()
+        if size >= self.multipart_threshold or size > COPY_MAX_BYTES:
+            self.copy_multipart(source_key, fp)
+            return
+        resp = self._request(
+            'copy_object', fp.s3_path(),
+            CopySource={'Bucket': self.bucket_name, 'Key': source_key},
+            MetadataDirective='REPLACE',
+            TaggingDirective='REPLACE',
+            **fp.attributes_as_boto_args())
+        fp.etag = resp.get('CopyObjectResult', {}).get('ETag')
+
+    def copy_multipart(self, source_key, fp):
+        def copy_part(key, upload_id, part_number, offset, part_size):
+            resp = self._request(
+                'upload_part_copy', key, UploadId=upload_id,
+                PartNumber=part_number,
+                CopySource={'Bucket': self.bucket_name, 'Key': source_key},
+                CopySourceRange='bytes={0}-{1}'.format(
+                    offset, offset + part_size - 1))
+            return {'ETag': resp['CopyPartResult']['ETag']}
+        self._multipart(fp, copy_part)
+
+    def delete(self, fp):
+        self._request('delete_object', fp.s3_path())
+
+    def delete_batch(self, fps):
+        """
+        Delete up to DELETE_BATCH_SIZE objects in one request. Returns a list
+        of (key, error code, error message) for keys S3 could not delete.
+        """
+        resp = self.retrier.call(
+            s3sup.retry.key_prefix(fps[0].s3_path()),
+            self.client.delete_objects,
+            Bucket=self.bucket_name,
+            Delete={
+                'Objects': [{'Key': fp.s3_path()} for fp in fps],
+                'Quiet': True})
+        return [(e['Key'], e.get('Code'), e.get('Message'))
+                for e in resp.get('Errors', [])]
+
+
+def transfer_size(cr, fp):
+    """Number of bytes sent to S3 to make this change"""
+    if isinstance(fp, ServerSideCopy):
+        return 0
+    if cr in (s3sup.catalogue.ChangeReason.NEW_FILE,
+              s3sup.catalogue.ChangeReason.CONTENT_CHANGED):
+        return fp.size()
+    return 0
+
+
+def work_units(operation, phase, inflight_bytes=transfer_size):
+    """
+    Split a phase into units of work, each a tuple of:
+        (callable, args, [items], inflight bytes)
+
+    Normally every item is its own unit. A phase made up entirely of deletions
+    is sent as batches of up to DELETE_BATCH_SIZE keys instead, when the
+    operation supports delete_batch().
+    """
+    if hasattr(operation, 'delete_batch') and all(
+            cr == s3sup.catalogue.ChangeReason.DELETED for cr, _, _ in phase):
+        for i in range(0, len(phase), DELETE_BATCH_SIZE):
+            batch = phase[i:i + DELETE_BATCH_SIZE]
+            yield (operation.delete_batch, ([fp for _, _, fp in batch],),
+                   batch, 0)
+        return
+    for item in phase:
+        cr, _, fp = item
+        yield operation, (cr, fp), [item], inflight_bytes(cr, fp)
+
+
+def unit_failures(items, result):
+    """
+    Map keys that failed within a batch operation back to their items. Returns
+    a list of (item, error code, error message).
+    """
+    if not result:
+        return []
+    by_key = {fp.s3_path(): (cr, p, fp) for cr, p, fp in items}
+    return [(by_key[key], code, msg) for key, code, msg in result]
+
+
+class DependencyTracker:
+    """
+    Hands out the work units of a phase in order, holding back any unit
+    until the paths it depends on are done. dependencies maps a path to the
+    set of paths that must be on S3 before it. Only paths within the phase
+    are waited for, anything else is assumed to be done already.
+    """
+
+    def __init__(self, units, dependencies=None):
+        self._units = list(units)
+        dependencies = dependencies or {}
+        in_phase = {p for _, _, items, _ in self._units for _, p, _ in items}
+        self._blocked_by = []
+        self._dependents = collections.defaultdict(list)
+        self._ready = collections.deque()
+        for i, (_, _, items, _) in enumerate(self._units):
+            own = {p for _, p, _ in items}
+            blocked_by = {
+                d for p in own for d in dependencies.get(p, ())
+                if d in in_phase and d not in own}
+            self._blocked_by.append(blocked_by)
+            for d in blocked_by:
+                self._dependents[d].append(i)
+            if len(blocked_by) == 0:
+                self._ready.append(i)
+        self._remaining = len(self._units)
+
+    def __len__(self):
+        """Units not yet handed out"""
+        return self._remaining
+
+    def next_unit(self, force=False):
+        """
+        Next unit free to start, or None if all remaining units are waiting.
+        With force, the earliest waiting unit is handed out regardless, which
+        is how dependency cycles are broken.
+        """
+        while len(self._ready) > 0:
+            i = self._ready.popleft()
+            if self._units[i] is not None:
+                return self._take(i)
+        if force and self._remaining > 0:
+            return self._take(next(
+                i for i, u in enumerate(self._units) if u is not None))
+        return None
+
+    def _take(self, i):
+        unit = self._units[i]
+        self._units[i] = None
+        self._remaining -= 1
+        return unit
+
+    def done(self, items):
+        for _, p, _ in items:
+            for i in self._dependents.pop(p, ()):
+                self._blocked_by[i].discard(p)
+                if len(self._blocked_by[i]) == 0:
+                    self._ready.append(i)
+
+
+def run_concurrently(fn, items, concurrency):
+    """[fn(item) for item in items], run using a pool of threads"""
+    items = list(items)
+    if len(items) == 0:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(concurrency, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+class Executor:
+    """
+    Worker pool running S3 changes concurrently, one phase at a time.
+
+    Two limits are applied to work in flight: the number of concurrent
+    operations, and the total number of bytes being uploaded. A single file
+    larger than the byte budget is let through once nothing else is in
+    flight, otherwise it would never be uploaded.
+    """
+
+    def __init__(self, operation, concurrency=DEFAULT_CONCURRENCY,
+                 max_inflight_bytes=DEFAULT_MAX_INFLIGHT_MB * MB,
+                 inflight_bytes=transfer_size):
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+        self.operation = operation
+        self.concurrency = concurrency
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = inflight_bytes
+
+    def run(self, phases, on_done=None, dependencies=None):
+        """
+        Phases are lists of (ChangeReason, path, FilePrepper) items. on_done is
+        called from the calling thread with each item once it is complete.
+        Within a phase, items are started in order, except that an item is
+        not started before the items it depends on (see DependencyTracker)
+        are complete.
+
+        An exception raised by an operation stops the run. Individual keys
+        that S3 refused to delete as part of a batch do not, they are returned
+        as a list of (item, error code, error message) instead.
+        """
+        failures = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency) as pool:
+            for phase in phases:
+                failures += self._run_phase(
+                    pool, phase, on_done, dependencies)
+        return failures
+
+    def _run_phase(self, pool, phase, on_done, dependencies):
+        inflight = {}
+        inflight_bytes = 0
+        failures = []
+
+        def _wait_for_one():
+            nonlocal inflight_bytes
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                items, nbytes = inflight.pop(f)
+                inflight_bytes -= nbytes
+                try:
+                    failures.extend(unit_failures(items, f.result()))
+                except BaseException:
+                    for pending in inflight:
+                        pending.cancel()
+                    raise
+                tracker.done(items)
+                if on_done is not None:
+                    for item in items:
+                        on_done(item)
+
+        tracker = DependencyTracker(
+            work_units(self.operation, phase, self.inflight_bytes),
+            dependencies)
+        while len(tracker) > 0:
+            unit = tracker.next_unit(force=len(inflight) == 0)
+            if unit is None:
+                _wait_for_one()
+                continue
+            fn, args, items, nbytes = unit
+            while len(inflight) > 0 and (
+                    len(inflight) >= self.concurrency or
+                    inflight_bytes + nbytes > self.max_inflight_bytes):
+                _wait_for_one()
+            f = pool.submit(fn, *args)
+            inflight[f] = (items, nbytes)
+            inflight_bytes += nbytes
+
+        while len(inflight) > 0:
+            _wait_for_one()
+        return failures
@@ -1,6 +1,11 @@
 import click
 
 
+# Directory within the project holding local state, such as the push journal
+# and caches. Never uploaded.
+STATE_DIR = '.s3sup'
+
+
 def pprint_h1(text):
     click.echo('*'*60)
     click.echo('* {0}'.format(text))
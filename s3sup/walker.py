@@ -0,0 +1,133 @@
+"""
+Walks the local project to find the files to upload.
+
+Built on os.scandir(), so the stat result of each file comes for free on most
+platforms and is handed on to the hash cache. Files and directories can be
+left out using gitignore style patterns, from the exclude and include lists
+in s3sup.toml:
+
+ * A pattern without a slash, e.g. '*.swp' or 'node_modules', matches a name
+   at any depth. One containing a slash, or starting with one, is relative to
+   the project root, e.g. '/drafts' or 'assets/*.psd'.
+ * '*' matches anything except '/', '?' matches one character, '[a-z]' a
+   range, and '**' matches across directories, e.g. 'assets/**/*.map'.
+ * A trailing slash, e.g. '.git/', only matches directories.
+ * Include patterns bring back paths matched by an exclude pattern.
+
+Excluded directories are not descended into at all, so nothing within them
+can be included again.
+"""
+import os
+import re
+
+import s3sup.utils
+
+
+# Never uploaded, in any directory.
+CONFIG_FILENAME = 's3sup.toml'
+
+
+def pattern_regex(pattern):
+    """
+    Compile a gitignore style pattern. Returns (regex, directories only),
+    the regex matching '/' separated paths relative to the project root.
+    """
+    dir_only = pattern.endswith('/')
+    anchored = '/' in pattern.rstrip('/')
+    p = pattern.strip('/')
+    regex = ''
+    i = 0
+    while i < len(p):
+        if p.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif p.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif p[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif p[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif p[i] == '[' and ']' in p[i + 2:]:
+            end = p.index(']', i + 2)
+            chars = p[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            regex += re.escape(p[i])
+            i += 1
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return re.compile(regex + '$'), dir_only
+
+
+class PathFilter:
+
+    def __init__(self, exclude=(), include=()):
+        self._exclude = [pattern_regex(p) for p in exclude]
+        self._include = [pattern_regex(p) for p in include]
+
+    @classmethod
+    def from_rules(cls, rules):
+        return cls(rules.get('exclude', ()), rules.get('include', ()))
+
+    @staticmethod
+    def _matches(patterns, path, is_dir):
+        return any(
+            regex.match(path) is not None for regex, dir_only in patterns
+            if is_dir or not dir_only)
+
+    def excluded(self, path, is_dir=False):
+        """Whether '/' separated project relative path is left out"""
+        return (self._matches(self._exclude, path, is_dir) and
+                not self._matches(self._include, path, is_dir))
+
+
+def walked(rel_path, path_filter=None):
+    """
+    Whether walk() yields the file at project relative path rel_path, going
+    by its path alone. Used for paths reported by filesystem events.
+    """
+    if path_filter is None:
+        path_filter = PathFilter()
+    parts = rel_path.split(os.sep)
+    if parts[0] == s3sup.utils.STATE_DIR and len(parts) > 1:
+        return False
+    if parts[-1] == CONFIG_FILENAME:
+        return False
+    for i in range(1, len(parts)):
+        if path_filter.excluded('/'.join(parts[:i]), is_dir=True):
+            return False
+    return not path_filter.excluded('/'.join(parts))
+
+
+def walk(local_project_root, path_filter=None, top=''):
+    """
+    Yield (path relative to project root, os.stat_result) for every file to
+    upload, optionally only those within project relative directory top.
+    Like os.walk(), symbolic links to directories are not followed.
+    """
+    if path_filter is None:
+        path_filter = PathFilter()
+    stack = [top]
+    while len(stack) > 0:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(local_project_root, rel_dir)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            rel_path = os.path.join(rel_dir, entry.name)
+            match_path = rel_path.replace(os.sep, '/')
+            if entry.is_dir():
+                if rel_dir == '' and entry.name == s3sup.utils.STATE_DIR:
+                    # Local state such as the push journal and caches.
+                    continue
+                if (not entry.is_symlink() and
+                        not path_filter.excluded(match_path, is_dir=True)):
+                    stack.append(rel_path)
+            elif (entry.name != CONFIG_FILENAME and
+                    not path_filter.excluded(match_path)):
+                yield rel_path, entry.stat()
@@ -0,0 +1,139 @@
+"""
+Continuous pushes driven by filesystem events, for `s3sup watch`.
+
+Changed paths are collected until events stop arriving for a quiet period, so
+a site generator rewriting hundreds of files results in a single push of
+only those files. Uses inotify on Linux, and the native equivalent elsewhere.
+
+Requires watchdog, installed with: pip install s3sup[watch]
+"""
+import os
+import threading
+import time
+
+import click
+
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+import s3sup.utils
+
+
+DEFAULT_QUIET_SECONDS = 1.0
+# Push at least this often while events keep arriving.
+DEFAULT_MAX_DELAY_SECONDS = 30.0
+
+# Events for files being read, e.g. by s3sup hashing them, are ignored.
+CHANGE_EVENT_TYPES = ('created', 'modified', 'moved', 'deleted', 'closed')
+
+
+def available():
+    return watchdog is not None
+
+
+class Debouncer:
+    """
+    Collects changed paths into batches. A batch is ready once no path has
+    been added for quiet_seconds, or max_delay_seconds after its first path.
+    Safe to add to from other threads.
+    """
+
+    def __init__(self, quiet_seconds=DEFAULT_QUIET_SECONDS,
+                 max_delay_seconds=DEFAULT_MAX_DELAY_SECONDS):
+        self.quiet_seconds = quiet_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._cond = threading.Condition()
+        self._paths = set()
+        self._first = None
+        self._last = None
+
+    def add(self, path):
+        with self._cond:
+            now = time.monotonic()
+            if len(self._paths) == 0:
+                self._first = now
+            self._paths.add(path)
+            self._last = now
+            self._cond.notify_all()
+
+    def batch(self, timeout=None):
+        """
+        Wait for the next batch of paths. Returns an empty set if there is
+        none within timeout seconds.
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                now = time.monotonic()
+                wait = None
+                if len(self._paths) > 0:
+                    ready_at = min(self._last + self.quiet_seconds,
+                                   self._first + self.max_delay_seconds)
+                    if now >= ready_at:
+                        paths = self._paths
+                        self._paths = set()
+                        return paths
+                    wait = ready_at - now
+                if deadline is not None:
+                    if now >= deadline:
+                        return set()
+                    wait = deadline - now if wait is None else min(
+                        wait, deadline - now)
+                self._cond.wait(wait)
+
+
+class Watcher:
+    """
+    Watches a project directory, use as a context manager. Events start
+    being collected on entry, so nothing is missed during an initial push.
+    """
+
+    def __init__(self, local_project_root, debouncer=None):
+        if not available():
+            raise click.UsageError(
+                's3sup watch requires watchdog, install using: '
+                'pip3 install s3sup[watch]')
+        self.root = os.path.abspath(local_project_root)
+        self.debouncer = debouncer if debouncer is not None else Debouncer()
+        self._observer = None
+
+    def on_event(self, event):
+        if event.event_type not in CHANGE_EVENT_TYPES:
+            return
+        if event.is_directory and event.event_type == 'modified':
+            # Implied by events for what changed within it.
+            return
+        for abs_path in (event.src_path, getattr(event, 'dest_path', '')):
+            if not abs_path:
+                continue
+            if isinstance(abs_path, bytes):
+                abs_path = os.fsdecode(abs_path)
+            rel_path = os.path.relpath(abs_path, self.root)
+            first = rel_path.split(os.sep)[0]
+            if first in (os.curdir, os.pardir, s3sup.utils.STATE_DIR):
+                continue
+            self.debouncer.add(rel_path)
+
+    def __enter__(self):
+        handler = watchdog.events.FileSystemEventHandler()
+        handler.on_any_event = self.on_event
+        self._observer = watchdog.observers.Observer()
+        self._observer.schedule(handler, self.root, recursive=True)
+        self._observer.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._observer.stop()
+        self._observer.join()
+        self._observer = None
+        return False
+
+    def batches(self):
+        """Yield each batch of changed project relative paths, forever"""
+        while True:
+            paths = self.debouncer.batch()
+            if len(paths) > 0:
+                yield paths
@@ -39,7 +39,8 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     python_requires='>=3, <4',
     install_requires=[
-        'boto3>=1,<2',
+        'boto3>=1.21.8,<2',
+        'botocore>=1.24.8,<2',
         'click>=7,<9',
         'humanize>=0.4,<1',
         'inflect>=2,<3',
@@ -48,7 +49,11 @@ setup(
     ],
     include_package_data=True,
     extras_require={
+        'asyncio': ['aiobotocore>=2.2,<3'],
+        'brotli': ['brotli>=1,<2'],
         'test': ['flake8', 'moto'],
+        'watch': ['watchdog>=2'],
+        'zstd': ['zstandard'],
     },
     entry_points={
         'console_scripts': [
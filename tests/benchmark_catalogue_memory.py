@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Measure how peak memory use grows with the number of files in a catalogue.
+
+For each file count a fresh Python process builds local and remote
+catalogues of a synthetic site, diffs them and writes the result as a remote
+catalogue would be, then reports its peak resident set size. Linux and macOS
+only. Example:
+
+    ./benchmark_catalogue_memory.py --files 10000 100000 1000000
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import s3sup.catalogue  # noqa: E402
+
+# Files changed between the local and remote catalogues.
+CHANGED_FRACTION = 0.01
+
+
+def peak_rss_bytes():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def synthetic_path(i):
+    return 'section{0:03d}/sub{1:02d}/page-{2}.html'.format(
+        i % 500, (i // 500) % 40, i)
+
+
+def digest(*parts):
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def measure(num_files):
+    """Run in a child process, prints a JSON result"""
+    baseline = peak_rss_bytes()
+    start = time.perf_counter()
+    local = s3sup.catalogue.Catalogue()
+    remote = s3sup.catalogue.Catalogue()
+    changed_every = int(1 / CHANGED_FRACTION)
+    for i in range(num_files):
+        path = synthetic_path(i)
+        ah = digest('attrs', i % 7)
+        local.add_file(path, digest(i), ah)
+        version = 1 if i % changed_every == 0 else 0
+        remote.add_file(path, digest(i, version) if version else digest(i), ah)
+    built = peak_rss_bytes()
+    diff, new_remote = local.diff_dict(remote)
+    with tempfile.TemporaryDirectory() as tmpd:
+        new_remote.to_sqlite(os.path.join(tmpd, 'cat'))
+    print(json.dumps({
+        'files': num_files,
+        'changes': diff['num_changes'],
+        'seconds': time.perf_counter() - start,
+        'built_rss': built - baseline,
+        'peak_rss': peak_rss_bytes() - baseline,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--files', type=int, nargs='+',
+                        default=[10000, 100000, 500000])
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        measure(args.child)
+        return
+
+    print('{0:>10} {1:>9} {2:>14} {3:>14} {4:>12}'.format(
+        'files', 'seconds', 'catalogues MB', 'peak MB', 'bytes/file'))
+    for num_files in args.files:
+        out = subprocess.run(
+            [sys.executable, __file__, '--child', str(num_files)],
+            stdout=subprocess.PIPE, check=True).stdout
+        r = json.loads(out.decode('utf-8'))
+        print('{0:>10} {1:>9.2f} {2:>14.1f} {3:>14.1f} {4:>12.0f}'.format(
+            r['files'], r['seconds'], r['built_rss'] / 2 ** 20,
+            r['peak_rss'] / 2 ** 20, r['peak_rss'] / r['files']))
+
+
+if __name__ == '__main__':
+    main()
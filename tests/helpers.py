@@ -0,0 +1,62 @@
+"""
+Shared test helpers.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+from unittest import mock
+
+import s3sup.utils
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def copy_fixture(fixture_name, dest):
+    """
+    Copy fixture project fixture_name to dest, leaving out any local state,
+    so every test starts from a project that has never been pushed from.
+    """
+    shutil.copytree(
+        os.path.join(MODULE_DIR, fixture_name), dest,
+        ignore=shutil.ignore_patterns(s3sup.utils.STATE_DIR))
+    return dest
+
+
+def fixture_project(testcase, fixture_name):
+    """
+    Path to a copy of fixture project fixture_name in a temporary directory,
+    removed once testcase finishes. Projects write local state, such as
+    caches, into their directory, so fixtures are never used in place.
+    """
+    tmpd = tempfile.TemporaryDirectory()
+    testcase.addCleanup(tmpd.cleanup)
+    return copy_fixture(fixture_name, os.path.join(tmpd.name, fixture_name))
+
+
+class FakeFilePrepper:
+    """Stands in for a FilePrepper of size bytes of content"""
+
+    def __init__(self, path, size=1):
+        self.path = path
+        self._size = size
+
+    def size(self):
+        return self._size
+
+    def s3_path(self):
+        return self.path
+
+    def content_fileobj(self):
+        return mock.mock_open(read_data=b'x' * self._size)()
+
+    def content_hash(self):
+        return hashlib.sha256(b'x' * self._size).hexdigest()
+
+    def attributes_as_boto_args(self):
+        return {'ACL': 'public-read'}
+
+
+def make_phase(cr, paths, size=1):
+    """A phase of changes cr to FakeFilePreppers for paths"""
+    return [(cr, p, FakeFilePrepper(p, size)) for p in paths]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Compare push times of the threaded boto3 transport against the asyncio
+transport, for a project made up of many small files.
+
+Requires the local moto server to be running first (see start_moto.sh) and
+aiobotocore to be installed (pip install s3sup[asyncio]). Example:
+
+    ./benchmark_transports.py --files 5000 --concurrency 10 100 500
+"""
+import os
+import sys
+import time
+import tempfile
+import argparse
+
+import boto3
+
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+import s3sup.project  # noqa: E402
+
+ENDPOINT_URL = 'http://localhost:5000'
+BUCKET_NAME = 'benchmark.example.com'
+
+CONF_TEMPLATE = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = '{bucket}'
+s3_project_root = '{root}'
+s3_endpoint_url = '{endpoint}'
+
+[transfer]
+transport = '{transport}'
+concurrency = {concurrency}
+'''
+
+
+def create_project(path, num_files, file_size):
+    for i in range(num_files):
+        d = os.path.join(path, 'section{0:03d}'.format(i % 100))
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'page{0}.html'.format(i)), 'wb') as f:
+            f.write(os.urandom(file_size // 2).hex().encode('ascii'))
+
+
+def write_conf(path, transport, concurrency, run_id):
+    with open(os.path.join(path, 's3sup.toml'), 'wt') as f:
+        f.write(CONF_TEMPLATE.format(
+            bucket=BUCKET_NAME, endpoint=ENDPOINT_URL, transport=transport,
+            concurrency=concurrency,
+            root='bench/{0}-{1}-{2}'.format(run_id, transport, concurrency)))
+
+
+def time_push(path):
+    p = s3sup.project.Project(path, verbose=False)
+    p.calculate_diff()  # Hashing excluded from the timings
+    start = time.perf_counter()
+    changes = p.sync()
+    return time.perf_counter() - start, len(changes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--file-size', type=int, default=2048)
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[10, 100])
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'FOO')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'BAR')
+    s3 = boto3.resource(
+        's3', region_name='eu-west-1', endpoint_url=ENDPOINT_URL)
+    s3.create_bucket(
+        Bucket=BUCKET_NAME,
+        CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+
+    run_id = int(time.time())
+    print('{0} files of {1} bytes'.format(args.files, args.file_size))
+    print('{0:<10} {1:>12} {2:>10} {3:>12}'.format(
+        'transport', 'concurrency', 'seconds', 'files/sec'))
+    with tempfile.TemporaryDirectory() as proj:
+        create_project(proj, args.files, args.file_size)
+        for concurrency in args.concurrency:
+            for transport in ('threads', 'asyncio'):
+                write_conf(proj, transport, concurrency, run_id)
+                secs, num = time_push(proj)
+                print('{0:<10} {1:>12} {2:>10.2f} {3:>12.0f}'.format(
+                    transport, concurrency, secs, num / secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+import boto3
+
+try:
+    import moto.server
+    import werkzeug.serving
+except ImportError:
+    werkzeug = None
+
+import s3sup.aiotransfer
+import s3sup.transfer
+from s3sup.aiotransfer import AsyncExecutor
+from s3sup.catalogue import ChangeReason
+from tests.helpers import FakeFilePrepper, make_phase
+
+
+class FakeAsyncClient:
+
+    def __init__(self):
+        self.calls = []
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def _call(self, name, kwargs):
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        await asyncio.sleep(0.001)
+        self.inflight -= 1
+        if kwargs['Key'] == 'broken.png':
+            raise RuntimeError('S3 said no')
+        self.calls.append((name, kwargs['Key']))
+
+    async def put_object(self, **kwargs):
+        await self._call('put_object', kwargs)
+        return {'ETag': '"put"'}
+
+    async def copy_object(self, **kwargs):
+        await self._call('copy_object', kwargs)
+        return {'CopyObjectResult': {'ETag': '"copied"'}}
+
+    async def delete_object(self, **kwargs):
+        await self._call('delete_object', kwargs)
+
+    async def delete_objects(self, **kwargs):
+        keys = [o['Key'] for o in kwargs['Delete']['Objects']]
+        await self._call('delete_objects', {'Key': ','.join(keys)})
+        return {'Errors': [
+            {'Key': k, 'Code': 'AccessDenied', 'Message': 'Access Denied'}
+            for k in keys if k == 'protected.html']}
+
+
+class TestAsyncExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeAsyncClient()
+
+    def executor(self, **kwargs):
+        return AsyncExecutor(lambda: self.client, 'www.example.com', **kwargs)
+
+    def test_phases_run_in_order(self):
+        phases = [
+            make_phase(ChangeReason.ATTRIBUTES_CHANGED, ['a.css']),
+            make_phase(ChangeReason.NEW_FILE, ['b.png', 'c.png', 'd.png']),
+            make_phase(ChangeReason.CONTENT_CHANGED, ['index.html']),
+            make_phase(ChangeReason.DELETED, ['old.html'])]
+        done = []
+        self.executor(concurrency=100).run(phases, on_done=done.append)
+        self.assertEqual(('copy_object', 'a.css'), self.client.calls[0])
+        self.assertEqual(
+            {'b.png', 'c.png', 'd.png'},
+            {k for _, k in self.client.calls[1:4]})
+        self.assertEqual(('put_object', 'index.html'), self.client.calls[4])
+        self.assertEqual(('delete_objects', 'old.html'), self.client.calls[5])
+        self.assertEqual(6, len(done))
+
+    def test_deletes_batched_and_failures_returned(self):
+        paths = ['{0}.html'.format(i) for i in range(1500)]
+        paths.append('protected.html')
+        phases = [make_phase(ChangeReason.DELETED, paths)]
+        failures = self.executor().run(phases)
+        self.assertEqual(2, len(self.client.calls))
+        self.assertEqual(1, len(failures))
+        (cr, p, _), code, _ = failures[0]
+        self.assertEqual('protected.html', p)
+        self.assertEqual('AccessDenied', code)
+
+    def test_concurrency_limit_respected(self):
+        phases = [make_phase(
+            ChangeReason.NEW_FILE, ['{0}.png'.format(i) for i in range(50)])]
+        self.executor(concurrency=7).run(phases)
+        self.assertEqual(7, self.client.max_inflight)
+        self.assertEqual(50, len(self.client.calls))
+
+    def test_large_files_use_fallback_operation(self):
+        fallback_calls = []
+
+        def fallback(cr, fp):
+            fallback_calls.append(fp.path)
+
+        big = s3sup.aiotransfer.INLINE_MAX_BYTES + 1
+        phases = [
+            make_phase(ChangeReason.NEW_FILE, ['small.png']) +
+            [(ChangeReason.NEW_FILE, 'video.mp4', mock.Mock(
+                path='video.mp4', size=mock.Mock(return_value=big)))]]
+        self.executor(fallback_operation=fallback).run(phases)
+        self.assertEqual(['video.mp4'], fallback_calls)
+        self.assertEqual([('put_object', 'small.png')], self.client.calls)
+
+    def test_fallback_pool_sized_separately(self):
+        self.assertEqual(3, self.executor(concurrency=3).fallback_concurrency)
+        self.assertEqual(
+            s3sup.transfer.DEFAULT_CONCURRENCY,
+            self.executor(concurrency=500).fallback_concurrency)
+        self.assertEqual(2, self.executor(
+            concurrency=3, fallback_concurrency=2).fallback_concurrency)
+
+    def test_files_read_off_the_event_loop(self):
+        read_in = []
+
+        class ReadRecordingFilePrepper(FakeFilePrepper):
+            def content_fileobj(self):
+                read_in.append(threading.get_ident())
+                return super().content_fileobj()
+
+        phases = [[(ChangeReason.NEW_FILE, 'a.css',
+                    ReadRecordingFilePrepper('a.css'))]]
+        self.executor().run(phases)
+        self.assertEqual([('put_object', 'a.css')], self.client.calls)
+        self.assertNotIn(threading.get_ident(), read_in)
+
+    def test_server_side_copies(self):
+        copy = s3sup.transfer.ServerSideCopy(
+            FakeFilePrepper('b/video.mp4'), 'a/video.mp4')
+        phases = [[(ChangeReason.NEW_FILE, 'b/video.mp4', copy)]]
+        self.executor(fallback_operation=mock.Mock()).run(phases)
+        self.assertEqual([('copy_object', 'b/video.mp4')], self.client.calls)
+        self.assertEqual('"copied"', copy.etag)
+
+    def test_large_copies_use_fallback_operation(self):
+        fallback = mock.Mock()
+        big = s3sup.aiotransfer.INLINE_MAX_BYTES + 1
+        phases = [make_phase(
+            ChangeReason.ATTRIBUTES_CHANGED, ['video.mp4'], size=big)]
+        self.executor(fallback_operation=fallback).run(phases)
+        self.assertEqual(1, fallback.call_count)
+        self.assertEqual([], self.client.calls)
+
+    def test_failure_stops_later_phases(self):
+        phases = [
+            make_phase(ChangeReason.NEW_FILE, ['broken.png', 'ok.png']),
+            make_phase(ChangeReason.NEW_FILE, ['index.html'])]
+        with self.assertRaisesRegex(RuntimeError, 'S3 said no'):
+            self.executor().run(phases)
+        self.assertNotIn(('put_object', 'index.html'), self.client.calls)
+
+    def test_missing_dependency_reported(self):
+        with mock.patch.object(s3sup.aiotransfer, 'aiobotocore', None):
+            with self.assertRaisesRegex(Exception, 'requires aiobotocore'):
+                s3sup.aiotransfer.create_client_factory()
+
+
+if werkzeug is not None:
+    class _QuietRequestHandler(werkzeug.serving.WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+
+@unittest.skipIf(not s3sup.aiotransfer.available(), 'aiobotocore missing')
+@unittest.skipIf(werkzeug is None, 'moto[server] missing')
+class TestAsyncExecutorMotoServer(unittest.TestCase):
+    """
+    Against a local moto server, as aiobotocore requests are not intercepted
+    by moto's in-process mocks.
+    """
+
+    def setUp(self):
+        self.server = werkzeug.serving.make_server(
+            '127.0.0.1', 0, moto.server.DomainDispatcherApplication(
+                moto.server.create_backend_app, service='s3'),
+            threaded=True, request_handler=_QuietRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.shutdown)
+        self.endpoint_url = 'http://127.0.0.1:{0}'.format(
+            self.server.server_port)
+        self.bucket = boto3.resource(
+            's3', region_name='eu-west-1', endpoint_url=self.endpoint_url,
+            aws_access_key_id='FOO', aws_secret_access_key='BAR',
+        ).create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+
+    def test_push(self):
+        self.bucket.put_object(Key='old.html', Body=b'old')
+        self.bucket.put_object(Key='a.css', Body=b'x')
+        fps = {p: FakeFilePrepper(p, size=10) for p in ['b.png', 'c.png']}
+        copy = s3sup.transfer.ServerSideCopy(
+            FakeFilePrepper('d.png', size=10), 'b.png')
+        phases = [
+            make_phase(ChangeReason.ATTRIBUTES_CHANGED, ['a.css']),
+            [(ChangeReason.NEW_FILE, p, fp) for p, fp in fps.items()],
+            [(ChangeReason.NEW_FILE, 'd.png', copy)],
+            make_phase(ChangeReason.DELETED, ['old.html'])]
+        env = {'AWS_ACCESS_KEY_ID': 'FOO', 'AWS_SECRET_ACCESS_KEY': 'BAR'}
+        with mock.patch.dict('os.environ', env):
+            failures = AsyncExecutor(
+                s3sup.aiotransfer.create_client_factory(
+                    region_name='eu-west-1', endpoint_url=self.endpoint_url),
+                'www.example.com').run(phases)
+        self.assertEqual([], failures)
+        self.assertEqual(
+            ['a.css', 'b.png', 'c.png', 'd.png'],
+            sorted(o.key for o in self.bucket.objects.all()))
+        for p, fp in fps.items():
+            o = self.bucket.Object(p)
+            self.assertEqual(b'x' * 10, o.get()['Body'].read())
+            self.assertEqual(o.e_tag, fp.etag)
+        self.assertEqual(self.bucket.Object('d.png').e_tag, copy.etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,23 @@
+import io
 import os
+import copy
+import hashlib
+import binascii
 import click
 import csv
 import tempfile
 import unittest
+from unittest import mock
 
 from s3sup.catalogue import (
     Catalogue, load_gzipped_sqlite, write_gzipped_sqlite,
-    MAX_DB_SCHEMA_VERSION, change_list, ChangeReason, _order_for_upload)
+    MAX_DB_SCHEMA_VERSION, change_list, change_phases, ChangeReason,
+    print_diff_summary, _order_for_upload)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class TestCatalogueReadersAndWriters(unittest.TestCase):
@@ -46,7 +57,7 @@ class TestCatalogueReadersAndWriters(unittest.TestCase):
         self.simple_cat.to_sqlite(self.tmpf_path)
         with load_gzipped_sqlite(self.tmpf_path) as c:
             r = c.execute('PRAGMA user_version').fetchone()
-            self.assertEqual(2, r[0])
+            self.assertEqual(3, r[0])
             r = c.execute('SELECT * FROM files').fetchone()
             self.assertEqual('test/blah.img', r['path'])
             self.assertEqual('AABBCC', r['content_hash'])
@@ -64,6 +75,13 @@ class TestCatalogueReadersAndWriters(unittest.TestCase):
         ncat.from_sqlite(self.tmpf_path)
         self.assertEqual(ncat.to_dict(), self.simple_cat.to_dict())
 
+    def test_meta_round_trip(self):
+        self.simple_cat.meta['git_commit'] = 'abc123'
+        self.simple_cat.to_sqlite(self.tmpf_path)
+        ncat = Catalogue()
+        ncat.from_sqlite(self.tmpf_path)
+        self.assertEqual({'git_commit': 'abc123'}, ncat.meta)
+
     def test_edge_cases_to_dict(self):
         self.assertEqual(
             self.edgecase_cat.to_dict(),
@@ -107,6 +125,66 @@ class TestCatalogueReadersAndWriters(unittest.TestCase):
         ncat = Catalogue()
         ncat.from_sqlite(self.tmpf_path)
         self.assertEqual({}, ncat.to_dict())
+        self.assertEqual({}, ncat.meta)
+
+    def test_from_sqlite_version_2(self):
+        ch = hashlib.sha256(b'content').hexdigest()
+        with write_gzipped_sqlite(self.tmpf_path) as c:
+            c.execute('PRAGMA user_version = 2')
+            c.execute('''CREATE TABLE files (
+                path TEXT,
+                content_hash TEXT,
+                attributes_hash TEXT)''')
+            c.executemany('INSERT INTO files VALUES (?, ?, ?)', [
+                ('a.html', ch, ch), ('b.html', 'AABBCC', 'XXYYZZ')])
+        ncat = Catalogue()
+        ncat.from_sqlite(self.tmpf_path)
+        self.assertEqual(
+            {'a.html': (ch, ch), 'b.html': ('AABBCC', 'XXYYZZ')},
+            ncat.to_dict())
+        self.assertEqual((None, None), ncat.get_object('a.html'))
+
+    def test_digests_stored_as_blobs(self):
+        ch = hashlib.sha256(b'content').hexdigest()
+        Catalogue().add_file('a.html', ch, ch, 12, '"e1"').to_sqlite(
+            self.tmpf_path)
+        with load_gzipped_sqlite(self.tmpf_path) as c:
+            r = c.execute('SELECT * FROM files').fetchone()
+            self.assertEqual(bytes.fromhex(ch), r['content_hash'])
+            self.assertEqual(12, r['size'])
+            self.assertEqual('"e1"', r['etag'])
+
+    def test_size_and_etag_round_trip(self):
+        ch = hashlib.sha256(b'content').hexdigest()
+        cat = (
+            Catalogue()
+            .add_file('a.html', ch, ch, 12, '"e1"')
+            .add_file('b.html', ch, ch, 0)
+            .add_file('c.html', 'AABBCC', 'XXYYZZ', 3, '"e3"')
+            .add_file('d.html', ch, ch))
+        cat.to_sqlite(self.tmpf_path)
+        ncat = Catalogue()
+        ncat.from_sqlite(self.tmpf_path)
+        self.assertEqual(cat.to_dict(), ncat.to_dict())
+        self.assertEqual((12, '"e1"'), ncat.get_object('a.html'))
+        self.assertEqual((0, None), ncat.get_object('b.html'))
+        self.assertEqual((3, '"e3"'), ncat.get_object('c.html'))
+        self.assertEqual((None, None), ncat.get_object('d.html'))
+
+    @unittest.skipIf(zstandard is None, 'zstandard not installed')
+    def test_zstd_round_trip(self):
+        self.edgecase_cat.to_sqlite(self.tmpf_path, compression='zstd',
+                                    threads=2)
+        with open(self.tmpf_path, 'rb') as f:
+            self.assertEqual(b'\x28\xb5\x2f\xfd', f.read(4))
+        ncat = Catalogue()
+        ncat.from_sqlite(self.tmpf_path)
+        self.assertEqual(ncat.to_dict(), self.edgecase_cat.to_dict())
+
+    def test_zstd_not_installed(self):
+        with mock.patch('s3sup.catalogue.zstandard', None):
+            with self.assertRaisesRegex(click.UsageError, r's3sup\[zstd\]'):
+                self.simple_cat.to_sqlite(self.tmpf_path, compression='zstd')
 
     def test_edgecase_from_sqlite_but_newer_version(self):
         new_version = MAX_DB_SCHEMA_VERSION + 1
@@ -115,10 +193,132 @@ class TestCatalogueReadersAndWriters(unittest.TestCase):
             c.execute('CREATE TABLE dummy ( path TEXT )')
         ncat = Catalogue()
         with self.assertRaisesRegex(
-                click.ClickException, 'is version 3.*to version 2'):
+                click.ClickException, 'is version 4.*to version 3'):
             ncat.from_sqlite(self.tmpf_path)
 
 
+class Unseekable(io.RawIOBase):
+    """Readable but not seekable, like an S3 response body"""
+
+    def __init__(self, data):
+        self._f = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._f.readinto(b)
+
+
+class TestCatalogueFileObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.cat = (
+            Catalogue()
+            .add_file('a.html', hashlib.sha256(b'a').hexdigest(),
+                      hashlib.sha256(b'b').hexdigest(), 3, '"e"')
+            .add_file('b/c.html', 'AABBCC', 'XXYYZZ'))
+        self.cat.meta['git_commit'] = 'abc123'
+
+    def round_trip(self, **kwargs):
+        buf = io.BytesIO()
+        self.cat.to_sqlite(buf, **kwargs)
+        ncat = Catalogue()
+        ncat.from_sqlite(Unseekable(buf.getvalue()))
+        self.assertEqual(self.cat.to_dict(), ncat.to_dict())
+        self.assertEqual((3, '"e"'), ncat.get_object('a.html'))
+        self.assertEqual(self.cat.meta, ncat.meta)
+
+    def test_gzip_round_trip(self):
+        self.round_trip()
+
+    @unittest.skipIf(zstandard is None, 'zstandard not installed')
+    def test_zstd_round_trip(self):
+        self.round_trip(compression='zstd')
+
+    def test_temporary_file_fallback(self):
+        with mock.patch('s3sup.catalogue._IN_MEMORY', False):
+            self.round_trip()
+
+    def test_nothing_left_on_error(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            with mock.patch('tempfile.tempdir', tmpd):
+                for in_memory in (True, False):
+                    with mock.patch('s3sup.catalogue._IN_MEMORY', in_memory):
+                        dest = os.path.join(tmpd, 'cat')
+                        with self.assertRaises(RuntimeError):
+                            with write_gzipped_sqlite(dest):
+                                raise RuntimeError('interrupted')
+                        with self.assertRaises(OSError):
+                            Catalogue().from_sqlite(io.BytesIO(b'junk'))
+                self.assertEqual([], os.listdir(tmpd))
+
+    def test_from_csv_file_object(self):
+        ncat = Catalogue()
+        ncat.from_csv(io.BytesIO(
+            b'path,content_hash,attributes_hash\r\n"a, b.html",AA,BB\r\n'))
+        self.assertEqual({'a, b.html': ('AA', 'BB')}, ncat.to_dict())
+
+
+class TestCatalogueStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.ch = hashlib.sha256(b'content').hexdigest()
+        self.ah = hashlib.sha256(b'attributes').hexdigest()
+
+    def test_hex_digests_stored_as_binary(self):
+        cat = Catalogue().add_file('assets/logo.svg', self.ch, self.ah)
+        self.assertEqual((self.ch, self.ah), cat.get('assets/logo.svg'))
+        self.assertEqual(
+            self.ch.encode('ascii'),
+            binascii.hexlify(cat._dirs['assets/']['logo.svg'][:32]))
+
+    def test_other_hashes_kept_as_given(self):
+        cat = (Catalogue()
+               .add_file('a.html', self.ch.upper(), self.ah)
+               .add_file('b.html', self.ch[:-1] + 'g', self.ah)
+               .add_file('c.html', 'AABBCC', self.ah))
+        self.assertEqual(
+            {'a.html': (self.ch.upper(), self.ah),
+             'b.html': (self.ch[:-1] + 'g', self.ah),
+             'c.html': ('AABBCC', self.ah)},
+            cat.to_dict())
+
+    def test_paths_grouped_by_directory(self):
+        cat = (Catalogue()
+               .add_file('index.html', self.ch, self.ah)
+               .add_file('/index.html', self.ah, self.ch)
+               .add_file('a/b/c.html', self.ch, self.ah)
+               .add_file('a/b.html', self.ch, self.ah))
+        self.assertEqual(4, len(cat))
+        self.assertEqual(
+            ['/index.html', 'a/b.html', 'a/b/c.html', 'index.html'],
+            [p for p, _ in cat.items()])
+        self.assertIn('a/b/c.html', cat)
+        self.assertNotIn('a/b', cat)
+        cat.remove('a/b/c.html').remove('a/b/missing.html')
+        self.assertNotIn('a/b/', cat._dirs)
+        self.assertEqual(3, len(copy.deepcopy(cat)))
+        self.assertEqual((self.ah, self.ch), cat.get('/index.html'))
+
+    def test_snapshot_copied_on_write(self):
+        cat = (Catalogue()
+               .add_file('a/1.html', self.ch, self.ah)
+               .add_file('a/2.html', self.ch, self.ah)
+               .add_file('b/1.html', self.ch, self.ah))
+        snap = cat.snapshot()
+        self.assertIs(cat._dirs['a/'], snap._dirs['a/'])
+        cat.add_file('a/1.html', self.ah, self.ch).remove('b/1.html')
+        snap.add_file('c/1.html', self.ch, self.ah)
+        self.assertEqual(
+            {'a/1.html': (self.ah, self.ch), 'a/2.html': (self.ch, self.ah)},
+            cat.to_dict())
+        self.assertEqual(
+            {'a/1.html': (self.ch, self.ah), 'a/2.html': (self.ch, self.ah),
+             'b/1.html': (self.ch, self.ah), 'c/1.html': (self.ch, self.ah)},
+            snap.to_dict())
+
+
 class TestCatalogueDiff(unittest.TestCase):
 
     def setUp(self):
@@ -155,7 +355,8 @@ class TestCatalogueDiff(unittest.TestCase):
             .add_file('robots.txt', 'asdfhl', 'lkjfds')
             .add_file('tempfile.txt', 'fj8fj8', 'flwlfwl')
         )
-        diff_dict, new_remote_catalogue = local_cat.diff_dict(remote_cat)
+        diff_dict, new_remote_catalogue = local_cat.diff_dict(
+            remote_cat, unchanged=True)
         expected = {
             'num_changes': 5,
             'upload': {
@@ -165,10 +366,62 @@ class TestCatalogueDiff(unittest.TestCase):
             },
             'delete': ['tempfile.txt'],
             'delete_protected': [],
+            'moved': [],
+            'num_unchanged': 2,
             'unchanged': ['consistent.html.html', '♬ /music.fav.mp3']
         }
         self.assertEqual(expected, diff_dict)
 
+        diff_dict, _ = local_cat.diff_dict(remote_cat)
+        del expected['unchanged']
+        self.assertEqual(expected, diff_dict)
+
+    def test_iter_diff_merges_directories(self):
+        local_cat = (
+            Catalogue()
+            .add_file('a/b0.html', '1', '1')
+            .add_file('a/b/c.html', '2', '2')
+            .add_file('a/new.html', '3', '3')
+            .add_file('z.html', '4', '4')
+        )
+        remote_cat = (
+            Catalogue()
+            .add_file('a/b/c.html', '2', '2')
+            .add_file('a/b/old.html', '5', '5')
+            .add_file('a/b0.html', '1', '0')
+            .add_file('z.html', '0', '4')
+        )
+        new_remote = Catalogue()
+        changes = list(local_cat.iter_diff(remote_cat, new_remote=new_remote))
+        self.assertEqual(sorted([
+            (ChangeReason.ATTRIBUTES_CHANGED, 'a/b0.html'),
+            (ChangeReason.NEW_FILE, 'a/new.html'),
+            (ChangeReason.NO_CHANGE, 'a/b/c.html'),
+            (ChangeReason.DELETED, 'a/b/old.html'),
+            (ChangeReason.CONTENT_CHANGED, 'z.html'),
+        ], key=lambda c: c[1]), sorted(changes, key=lambda c: c[1]))
+        self.assertEqual(local_cat.to_dict(), new_remote.to_dict())
+
+    def test_iter_diff_keeps_remote_etags(self):
+        ch = hashlib.sha256(b'content').hexdigest()
+        ah = hashlib.sha256(b'attributes').hexdigest()
+        local_cat = (
+            Catalogue()
+            .add_file('same.html', ch, ah, 7)
+            .add_file('attrs.html', ch, ah, 7)
+            .add_file('content.html', ah, ah, 7))
+        remote_cat = (
+            Catalogue()
+            .add_file('same.html', ch, ah, 7, '"e1"')
+            .add_file('attrs.html', ch, ch, 7, '"e2"')
+            .add_file('content.html', ch, ah, 7, '"e3"'))
+        new_remote = Catalogue()
+        list(local_cat.iter_diff(remote_cat, new_remote=new_remote))
+        self.assertEqual(local_cat.to_dict(), new_remote.to_dict())
+        self.assertEqual((7, '"e1"'), new_remote.get_object('same.html'))
+        self.assertEqual((7, '"e2"'), new_remote.get_object('attrs.html'))
+        self.assertEqual((7, None), new_remote.get_object('content.html'))
+
     def test_diff_dict_with_protected_deletion(self):
         local_cat = (
             Catalogue(preserve_deleted_files=True)
@@ -187,7 +440,8 @@ class TestCatalogueDiff(unittest.TestCase):
             .add_file('robots.txt', 'asdfhl', 'lkjfds')
             .add_file('tempfile.txt', 'fj8fj8', 'flwlfwl')
         )
-        diff_dict, new_remote_catalogue = local_cat.diff_dict(remote_cat)
+        diff_dict, new_remote_catalogue = local_cat.diff_dict(
+            remote_cat, unchanged=True)
         expected_diff = {
             'num_changes': 4,
             'upload': {
@@ -197,6 +451,8 @@ class TestCatalogueDiff(unittest.TestCase):
             },
             'delete': [],
             'delete_protected': ['tempfile.txt', '♬ /music.fav.mp3'],
+            'moved': [],
+            'num_unchanged': 1,
             'unchanged': ['consistent.html.html']
         }
         self.assertEqual(expected_diff, diff_dict)
@@ -206,6 +462,79 @@ class TestCatalogueDiff(unittest.TestCase):
         self.assertTrue('♬ /music.fav.mp3' in rmt_cat_d)
         self.assertEqual(('200010', '7A9 '), rmt_cat_d['♬ /music.fav.mp3'])
 
+    def test_diff_dict_detects_moves(self):
+        local_cat = (
+            Catalogue()
+            .add_file('v2/jquery.js', 'J1J1J1', 'A1A1A1')
+            .add_file('v2/logo.png', 'L1L1L1', 'A2A2A2')
+            .add_file('img/logo.png', 'L1L1L1', 'A2A2A2')
+            .add_file('new.css', 'C1C1C1', 'A3A3A3')
+        )
+        remote_cat = (
+            Catalogue()
+            .add_file('v1/jquery.js', 'J1J1J1', 'A1A1A1')
+            .add_file('v1/logo.png', 'L1L1L1', 'A2A2A2')
+            .add_file('gone.css', 'G1G1G1', 'A3A3A3')
+        )
+        diff_dict, new_remote_catalogue = local_cat.diff_dict(remote_cat)
+        self.assertEqual(
+            [('v1/logo.png', 'img/logo.png'),
+             ('v1/jquery.js', 'v2/jquery.js')],
+            diff_dict['moved'])
+        self.assertEqual(
+            ['new.css', 'v2/logo.png'], diff_dict['upload']['new_files'])
+        self.assertEqual(['gone.css'], diff_dict['delete'])
+        self.assertEqual(5, diff_dict['num_changes'])
+        self.assertEqual(
+            ('J1J1J1', 'A1A1A1'),
+            new_remote_catalogue.to_dict()['v2/jquery.js'])
+        self.assertNotIn('v1/jquery.js', new_remote_catalogue.to_dict())
+
+        changes = change_list(diff_dict)
+        self.assertIn((ChangeReason.MOVED, 'v2/jquery.js'), changes)
+        self.assertEqual(
+            [(ChangeReason.DELETED, 'gone.css'),
+             (ChangeReason.DELETED, 'v1/logo.png'),
+             (ChangeReason.DELETED, 'v1/jquery.js')],
+            changes[-3:])
+
+    def test_many_identical_files_moved(self):
+        local_cat = Catalogue()
+        remote_cat = Catalogue()
+        for i in range(20000):
+            remote_cat.add_file('old/{0}/stub.html'.format(i), 'S1', 'A1')
+            local_cat.add_file('new/{0}/stub.html'.format(i), 'S1', 'A1')
+        remote_cat.add_file('old/empty.txt', 'E1', 'A1')
+        remote_cat.add_file('old/blank.txt', 'E1', 'A1')
+        local_cat.add_file('new/blank.txt', 'E1', 'A1')
+        diff_dict, _ = local_cat.diff_dict(remote_cat)
+        moved = {new: old for old, new in diff_dict['moved']}
+        self.assertEqual(20001, len(moved))
+        self.assertEqual('old/blank.txt', moved['new/blank.txt'])
+        self.assertEqual(
+            20000, len({moved['new/{0}/stub.html'.format(i)]
+                        for i in range(20000)}))
+        self.assertEqual(['old/empty.txt'], diff_dict['delete'])
+
+    def test_moves_shown_in_summary(self):
+        local_cat = Catalogue().add_file('v2/jquery.js', 'J1', 'A1')
+        remote_cat = Catalogue().add_file('v1/jquery.js', 'J1', 'A1')
+        diff_dict, _ = local_cat.diff_dict(remote_cat)
+        with mock.patch('click.echo') as echo:
+            print_diff_summary(diff_dict, verbose=True)
+        output = click.unstyle(
+            '\n'.join(str(c[0][0]) for c in echo.call_args_list))
+        self.assertIn('> moved: 1 file', output)
+        self.assertIn('> v1/jquery.js -> v2/jquery.js', output)
+
+    def test_moves_not_detected_when_deletes_preserved(self):
+        local_cat = Catalogue(preserve_deleted_files=True).add_file(
+            'v2/jquery.js', 'J1J1J1', 'A1A1A1')
+        remote_cat = Catalogue().add_file('v1/jquery.js', 'J1J1J1', 'A1A1A1')
+        diff_dict, _ = local_cat.diff_dict(remote_cat)
+        self.assertEqual([], diff_dict['moved'])
+        self.assertEqual(['v2/jquery.js'], diff_dict['upload']['new_files'])
+
 
 class TestOrderForUpload(unittest.TestCase):
     def testGeneral(self):
@@ -327,5 +656,41 @@ class TestChangeList(unittest.TestCase):
         ], cl)
 
 
+class TestChangePhases(unittest.TestCase):
+
+    def testPhasesForMixedChanges(self):
+        local_cat = (
+            Catalogue()
+            .add_file('index.html', 'AAACHANGED', '111')
+            .add_file('flex.js', 'HHH', '888CHANGED')
+            .add_file('news/new.html', 'GGG', '777')
+            .add_file('assets/blah.jpg', 'FFF', '666')
+            .add_file('assets/xtr/blam.css', 'IIICHANGED', '999')
+        )
+        remote_cat = (
+            Catalogue()
+            .add_file('index.html', 'AAA', '111')
+            .add_file('flex.js', 'HHH', '888')
+            .add_file('assets/xtr/blam.css', 'III', '999')
+            .add_file('gone.html', 'JJJ', '000')
+        )
+        diff, new_remote_catalogue = local_cat.diff_dict(remote_cat)
+        phases = change_phases(change_list(diff))
+        self.assertEqual([
+            [(ChangeReason.ATTRIBUTES_CHANGED, 'flex.js')],
+            [(ChangeReason.NEW_FILE, 'assets/blah.jpg'),
+             (ChangeReason.CONTENT_CHANGED, 'assets/xtr/blam.css')],
+            [(ChangeReason.NEW_FILE, 'news/new.html'),
+             (ChangeReason.CONTENT_CHANGED, 'index.html')],
+            [(ChangeReason.DELETED, 'gone.html')]
+        ], phases)
+
+    def testEmptyPhasesDropped(self):
+        self.assertEqual([], change_phases([]))
+        self.assertEqual(
+            [[(ChangeReason.DELETED, 'a.html')]],
+            change_phases([(ChangeReason.DELETED, 'a.html')]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from s3sup.catcache import CatalogueCache
+
+TARGET = ['www.example.com', '.s3sup.cat']
+
+
+class TestCatalogueCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.root = self.tmpd.name
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def test_empty(self):
+        self.assertIsNone(CatalogueCache(self.root, TARGET).get())
+
+    def test_copy_persisted(self):
+        CatalogueCache(self.root, TARGET).put('"e1"', b'\x1f\x8b one')
+        c = CatalogueCache(self.root, TARGET)
+        self.assertEqual(('"e1"', b'\x1f\x8b one'), c.get())
+        c.put('"e2"', b'two')
+        self.assertEqual(('"e2"', b'two'), c.get())
+
+    def test_other_target_ignored(self):
+        CatalogueCache(self.root, TARGET).put('"e1"', b'one')
+        self.assertIsNone(
+            CatalogueCache(self.root, ['other.example.com', '.s3sup.cat'])
+            .get())
+
+    def test_corrupt_copy_ignored(self):
+        c = CatalogueCache(self.root, TARGET)
+        c.put('"e1"', b'one')
+        with open(c.path, 'wb') as f:
+            f.write(b'not sqlite at all' * 100)
+        self.assertIsNone(c.get())
+        c.remove()
+        self.assertFalse(os.path.exists(c.path))
+
+    def test_objects_kept(self):
+        c = CatalogueCache(self.root, TARGET)
+        self.assertIsNone(c.get_object('.s3sup.cat.log/a'))
+        c.put_object('.s3sup.cat.log/a', b'base')
+        c.put_object('.s3sup.cat.log/b', b'delta')
+        c.put('"e1"', b'one')
+        c = CatalogueCache(self.root, TARGET)
+        self.assertEqual(b'base', c.get_object('.s3sup.cat.log/a'))
+        c.keep_objects({'.s3sup.cat.log/b'})
+        self.assertIsNone(c.get_object('.s3sup.cat.log/a'))
+        self.assertEqual(b'delta', c.get_object('.s3sup.cat.log/b'))
+        self.assertEqual(('"e1"', b'one'), c.get())
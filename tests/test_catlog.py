@@ -0,0 +1,96 @@
+import io
+import copy
+import unittest
+
+from s3sup.catalogue import Catalogue, load_gzipped_sqlite
+import s3sup.catlog
+
+
+class TestCatalogueLog(unittest.TestCase):
+
+    def setUp(self):
+        self.cat = Catalogue()
+        for i in range(200):
+            self.cat.add_file(
+                'dir{0}/page{1}.html'.format(i % 7, i), 'C{0}'.format(i),
+                'A{0}'.format(i % 3), size=i)
+
+    def test_delta_round_trip(self):
+        old = copy.deepcopy(self.cat)
+        self.cat.add_file('dir1/page1.html', 'changed', 'A1', size=1)
+        self.cat.set_etag('dir2/page2.html', '"abc"')
+        self.cat.add_file('new.html', 'C', 'A')
+        self.cat.remove('dir3/page3.html')
+        changed, removed = self.cat.delta(old)
+        self.assertEqual(
+            ['dir1/page1.html', 'dir2/page2.html', 'new.html'],
+            sorted(changed.paths()))
+        self.assertEqual(['dir3/page3.html'], removed)
+
+        body = s3sup.catlog.write_delta(changed, removed)
+        s3sup.catlog.apply_delta(old, body)
+        self.assertEqual(self.cat.to_dict(), old.to_dict())
+        self.assertEqual(
+            (2, '"abc"'), old.get_object('dir2/page2.html'))
+
+    def test_delta_against_snapshot(self):
+        old = self.cat.snapshot()
+        self.cat.add_file('dir1/page1.html', 'changed', 'A1', size=1)
+        self.cat.remove('dir3/page3.html')
+        changed, removed = self.cat.delta(old)
+        self.assertEqual(['dir1/page1.html'], list(changed.paths()))
+        self.assertEqual(['dir3/page3.html'], removed)
+        # Only the two directories changed are still compared.
+        self.assertEqual(
+            5, sum(self.cat._dirs[d] is old._dirs[d] for d in old._dirs))
+        self.assertEqual('C1', old.get('dir1/page1.html')[0])
+        self.assertIn('dir3/page3.html', old)
+
+    def test_unchanged_delta_is_empty(self):
+        changed, removed = self.cat.delta(copy.deepcopy(self.cat))
+        self.assertEqual(0, len(changed))
+        self.assertEqual([], removed)
+
+    def test_object_key_from_content(self):
+        key = s3sup.catlog.object_key('staging/.s3sup.cat', b'body')
+        self.assertTrue(key.startswith('staging/.s3sup.cat.log/'))
+        self.assertEqual(
+            key, s3sup.catlog.object_key('staging/.s3sup.cat', b'body'))
+        self.assertNotEqual(
+            key, s3sup.catlog.object_key('staging/.s3sup.cat', b'other'))
+
+    def test_needs_compaction(self):
+        log = s3sup.catlog.Log(('base', 1000))
+        self.assertFalse(log.needs_compaction(2, 0.5))
+        log.deltas = [('d1', 100), ('d2', 100)]
+        self.assertFalse(log.needs_compaction(2, 0.5))
+        log.deltas.append(('d3', 100))
+        self.assertTrue(log.needs_compaction(2, 0.5))
+        self.assertFalse(log.needs_compaction(3, 0.5))
+        log.deltas.append(('d4', 300))
+        self.assertTrue(log.needs_compaction(10, 0.5))
+        self.assertEqual({'base', 'd1', 'd2', 'd3', 'd4'}, log.keys())
+
+    def test_log_round_trip(self):
+        log = s3sup.catlog.Log(('base', 1000), meta={'git_commit': 'abc'})
+        log.deltas = [('d1', 10), ('d2', 20)]
+        buf = io.BytesIO()
+        log.to_sqlite(buf)
+        with load_gzipped_sqlite(io.BytesIO(buf.getvalue())) as c:
+            self.assertTrue(s3sup.catlog.is_log(c))
+            read = s3sup.catlog.Log.from_connection(c)
+        self.assertEqual(('base', 1000), read.base)
+        self.assertEqual([('d1', 10), ('d2', 20)], read.deltas)
+        self.assertEqual({'git_commit': 'abc'}, read.meta)
+
+    def test_catalogue_is_not_log(self):
+        buf = io.BytesIO()
+        self.cat.to_sqlite(buf)
+        with load_gzipped_sqlite(io.BytesIO(buf.getvalue())) as c:
+            self.assertFalse(s3sup.catlog.is_log(c))
+
+    def test_older_s3sup_refuses_log(self):
+        buf = io.BytesIO()
+        s3sup.catlog.Log(('base', 0)).to_sqlite(buf)
+        with self.assertRaisesRegex(Exception, 'Upgrade to latest s3sup'):
+            Catalogue().from_sqlite(io.BytesIO(buf.getvalue()))
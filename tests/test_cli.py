@@ -7,8 +7,11 @@ import unittest
 import moto
 import pathlib
 from click.testing import CliRunner
+from unittest import mock
 
+import s3sup.project
 import s3sup.scripts.s3sup
+from tests.helpers import copy_fixture, fixture_project
 
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 os.environ['AWS_ACCESS_KEY_ID'] = 'FOO'
@@ -86,7 +89,7 @@ class TestStatus(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_with_a_new_project(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner(mix_stderr=False)
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -100,7 +103,7 @@ class TestStatus(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_with_a_shortened_command_alias(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner(mix_stderr=False)
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -114,7 +117,7 @@ class TestStatus(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_with_a_minimal_project(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_2_minimal')
+        project_root = fixture_project(self, 'fixture_proj_2_minimal')
         runner = CliRunner(mix_stderr=False)
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -129,7 +132,7 @@ class TestStatus(S3supCliTestCaseBase):
     def test_nodelete(self):
         # Get things uploaded first so we have something to delete
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         cmd_result = self.upload_fixture_proj_dir(
            project_root, ['upload'])
         self.assertSuccess(cmd_result)
@@ -137,7 +140,7 @@ class TestStatus(S3supCliTestCaseBase):
             'staging/assets/landscape.62.png', all_bucket_keys(b))
 
         # First check that it would have been deleted without --nodelete
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1.1')
+        project_root = fixture_project(self, 'fixture_proj_1.1')
         cmd_result = self.upload_fixture_proj_dir(
            project_root, ['status'])
         self.assertSuccess(cmd_result)
@@ -171,7 +174,7 @@ class TestUpload(S3supCliTestCaseBase):
 
     @moto.mock_s3
     def test_bucket_doesnt_exist(self):
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         cmd_result = self.upload_fixture_proj_dir(
            project_root, ['upload'])
         self.assertEqual(1, cmd_result.exit_code)
@@ -180,7 +183,7 @@ class TestUpload(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_new_project(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner()
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -195,7 +198,7 @@ class TestUpload(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_new_project_with_push_command_alias(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner()
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -210,7 +213,7 @@ class TestUpload(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_minimal_project(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_2_minimal')
+        project_root = fixture_project(self, 'fixture_proj_2_minimal')
         runner = CliRunner()
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -226,7 +229,7 @@ class TestUpload(S3supCliTestCaseBase):
     def test_project_changes(self):
         b = self.create_example_bucket()
         o = b.Object('staging/robots.txt')
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner()
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -234,7 +237,7 @@ class TestUpload(S3supCliTestCaseBase):
         self.assertSuccess(result)
         self.assertIn('new: 11 files', result.stdout)
         self.assertEqual('text/invalid', o.content_type)
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1.1')
+        project_root = fixture_project(self, 'fixture_proj_1.1')
         runner = CliRunner()
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -249,7 +252,7 @@ class TestUpload(S3supCliTestCaseBase):
     def test_works_with_current_directory_not_p(self):
         b = self.create_example_bucket()
         o = b.Object('staging/robots.txt')
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner()
         with runner.isolated_filesystem():
             new_projdir = os.path.join(os.getcwd(), 'proj')
@@ -265,7 +268,7 @@ class TestUpload(S3supCliTestCaseBase):
         b = self.create_example_bucket()
         self.assertEqual([], [o for o in b.objects.all()])
 
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner()
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -278,14 +281,14 @@ class TestUpload(S3supCliTestCaseBase):
     @moto.mock_s3
     def test_nodelete(self):
         b = self.create_example_bucket()
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         cmd_result = self.upload_fixture_proj_dir(
            project_root, ['upload'])
         self.assertSuccess(cmd_result)
         self.assertIn(
             'staging/assets/landscape.62.png', all_bucket_keys(b))
 
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1.1')
+        project_root = fixture_project(self, 'fixture_proj_1.1')
 
         # Double check that --dryrun definitely still works with --nodelete
         cmd_result = self.upload_fixture_proj_dir(
@@ -319,7 +322,7 @@ class TestInspect(S3supCliTestCaseBase):
 
     @moto.mock_s3
     def test_minimal_project(self):
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_2_minimal')
+        project_root = fixture_project(self, 'fixture_proj_2_minimal')
         runner = CliRunner(mix_stderr=False)
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -329,7 +332,7 @@ class TestInspect(S3supCliTestCaseBase):
 
     @moto.mock_s3
     def test_normal_use_case_individual_file_in_current_dir(self):
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner(mix_stderr=False)
         with runner.isolated_filesystem():
             new_projdir = os.path.join(os.getcwd(), 'proj')
@@ -343,7 +346,7 @@ class TestInspect(S3supCliTestCaseBase):
             self.assertIn('Cache-Control: private; max-age=400', result.stdout)
 
     def test_with_different_proj_dir_and_non_existing_file(self):
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         runner = CliRunner(mix_stderr=False)
         result = runner.invoke(
             s3sup.scripts.s3sup.cli,
@@ -357,3 +360,62 @@ class TestInspect(S3supCliTestCaseBase):
 
         self.assertIn('white-paper.pdf', result.stdout)
         self.assertIn('StorageClass: REDUCED_REDUNDANCY', result.stdout)
+
+
+class FakeWatcher:
+    """
+    Stands in for s3sup.watch.Watcher. Each batch is the result of calling
+    the next of changes with the debouncer.
+    """
+    changes = []
+
+    def __init__(self, projectdir, debouncer):
+        self.debouncer = debouncer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def batches(self):
+        for make_changes in self.changes:
+            yield make_changes(self.debouncer)
+
+
+class TestWatch(S3supCliTestCaseBase):
+
+    @moto.mock_s3
+    def test_file_deleted_before_upload_retried(self):
+        b = self.create_example_bucket()
+        tmpd = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpd.cleanup)
+        project_root = os.path.join(tmpd.name, 'proj')
+        copy_fixture('fixture_proj_1', project_root)
+        robots = os.path.join(project_root, 'robots.txt')
+        orig_calculate = s3sup.project.Project.calculate_paths_diff
+
+        def delete_after_diff(p, paths, **kwargs):
+            result = orig_calculate(p, paths, **kwargs)
+            if os.path.exists(robots):
+                os.remove(robots)
+            return result
+
+        def edit(debouncer):
+            with open(robots, 'a') as f:
+                f.write('Disallow: /private/\n')
+            return {'robots.txt'}
+
+        runner = CliRunner(mix_stderr=False)
+        with mock.patch.object(FakeWatcher, 'changes', [
+                edit, lambda debouncer: debouncer.batch(timeout=5)]), \
+                mock.patch('s3sup.watch.Watcher', FakeWatcher), \
+                mock.patch.object(
+                    s3sup.project.Project, 'calculate_paths_diff',
+                    delete_after_diff):
+            result = runner.invoke(
+                s3sup.scripts.s3sup.cli,
+                ['watch', '-p', project_root, '-q', '0'])
+        self.assertSuccess(result)
+        self.assertIn('Pushing again once changes settle', result.stderr)
+        self.assertNotIn('staging/robots.txt', all_bucket_keys(b))
@@ -0,0 +1,82 @@
+import io
+import os
+import gzip
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+import s3sup.compression
+from s3sup.compression import ArtifactStore, compress
+
+
+class TestCompress(unittest.TestCase):
+
+    def test_gzip_output_is_deterministic(self):
+        content = os.urandom(200000)
+        outputs = []
+        for _ in range(2):
+            out = io.BytesIO()
+            compress(io.BytesIO(content), out, 'gzip', 6)
+            outputs.append(out.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(content, gzip.decompress(outputs[0]))
+
+    def test_missing_brotli_reported(self):
+        with mock.patch.object(s3sup.compression, 'brotli', None):
+            with self.assertRaisesRegex(Exception, 'requires the brotli'):
+                s3sup.compression.check_settings('br', 11)
+
+
+class TestArtifactStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpd.name, 'app.js')
+        with open(self.source, 'wb') as f:
+            f.write(b'console.log("hello");\n' * 100)
+        self.store = ArtifactStore(self.tmpd.name)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def test_artifact_reused_until_content_changes(self):
+        path, _ = self.store.artifact(self.source, 'gzip', 9)
+        self.assertTrue(path.startswith(
+            os.path.join(self.tmpd.name, '.s3sup', 'compressed')))
+        with mock.patch.object(
+                s3sup.compression, 'compress',
+                side_effect=AssertionError('recompressed')):
+            self.assertEqual(
+                path, self.store.artifact(self.source, 'gzip', 9)[0])
+
+        self.assertNotEqual(
+            path, self.store.artifact(self.source, 'gzip', 1)[0])
+        with open(self.source, 'ab') as f:
+            f.write(b'// changed\n')
+        self.assertNotEqual(
+            path, self.store.artifact(self.source, 'gzip', 9)[0])
+        self.assertEqual(3, len(os.listdir(self.store.root)))
+
+    def test_named_after_content_hash(self):
+        path, content_hash = self.store.artifact(self.source, 'gzip', 9)
+        with open(path, 'rb') as f:
+            self.assertEqual(
+                hashlib.sha256(f.read()).hexdigest(), content_hash)
+        self.assertEqual(content_hash, os.path.basename(path))
+        self.assertEqual(
+            (path, content_hash), self.store.artifact(self.source, 'gzip', 9))
+
+    def test_unreferenced_artifacts_pruned(self):
+        old, _ = self.store.artifact(self.source, 'gzip', 9)
+        with open(self.source, 'ab') as f:
+            f.write(b'// changed\n')
+        current, current_hash = self.store.artifact(self.source, 'gzip', 9)
+        self.store.prune({current_hash})
+        self.assertFalse(os.path.exists(os.path.dirname(old)))
+        self.assertTrue(os.path.exists(current))
+        self.assertEqual(1, len(os.listdir(self.store.root)))
+
+
+if __name__ == '__main__':
+    unittest.main()
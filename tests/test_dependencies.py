@@ -0,0 +1,87 @@
+import pathlib
+import tempfile
+import unittest
+
+from s3sup.catalogue import ChangeReason
+from s3sup.dependencies import (
+    css_references, dependency_graph, html_references, resolve)
+
+
+class LocalFile:
+
+    def __init__(self, root, path):
+        self.path_local_rel = pathlib.Path(path)
+        self.path_local_abs = pathlib.Path(root).joinpath(path)
+
+
+class TestReferences(unittest.TestCase):
+
+    def test_html_references(self):
+        refs = html_references(
+            '<link rel="stylesheet" href="/css/site.css">'
+            '<img src="logo.png" srcset="logo@2x.png 2x, logo@3x.png 3x">'
+            '<div style="background: url(\'bg.jpg\')"></div>'
+            '<style>@import "print.css";</style>')
+        self.assertEqual([
+            '/css/site.css', 'logo.png', 'logo@2x.png', 'logo@3x.png',
+            'bg.jpg', 'print.css'], refs)
+
+    def test_css_references(self):
+        self.assertEqual(
+            ['a.png', 'b.woff2', 'c.svg', 'base.css'],
+            css_references(
+                'x{background:url(a.png)} @font-face{src:url("b.woff2")}'
+                " y{mask: url( 'c.svg' )} @import 'base.css';"))
+
+    def test_resolve(self):
+        self.assertEqual('css/site.css', resolve('/css/site.css', 'a/b.html'))
+        self.assertEqual('a/logo.png', resolve('logo.png?v=2', 'a/b.html'))
+        self.assertEqual('img/x y.png', resolve('../img/x%20y.png', 'a/b.css'))
+        self.assertEqual('blog/index.html', resolve('/blog/', 'index.html'))
+        self.assertIsNone(resolve('https://cdn.example.com/a.js', 'i.html'))
+        self.assertIsNone(resolve('//cdn.example.com/a.js', 'i.html'))
+        self.assertIsNone(resolve('data:image/png;base64,AAAA', 'i.html'))
+        self.assertIsNone(resolve('#top', 'i.html'))
+        self.assertIsNone(resolve('../../outside.png', 'a/b.html'))
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        files = {
+            'index.html': '<link href="css/site.css"><img src="logo.png">'
+                          '<a href="about.html">About</a>'
+                          '<script src="https://cdn.example.com/x.js">',
+            'about.html': '<img src="/logo.png">',
+            'css/site.css': 'body{background:url(../bg.jpg)}',
+            'logo.png': '',
+            'bg.jpg': ''}
+        for path, content in files.items():
+            p = pathlib.Path(self.tmpd.name).joinpath(path)
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p.write_text(content)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def item(self, cr, path):
+        return (cr, path, LocalFile(self.tmpd.name, path))
+
+    def test_assets_referenced_by_uploads(self):
+        items = [
+            self.item(ChangeReason.NEW_FILE, 'index.html'),
+            self.item(ChangeReason.CONTENT_CHANGED, 'about.html'),
+            self.item(ChangeReason.NEW_FILE, 'css/site.css'),
+            self.item(ChangeReason.NEW_FILE, 'logo.png'),
+            self.item(ChangeReason.ATTRIBUTES_CHANGED, 'bg.jpg')]
+        self.assertEqual({
+            'index.html': {'css/site.css', 'logo.png'},
+            'about.html': {'logo.png'}}, dependency_graph(items))
+
+    def test_css_depends_on_its_assets(self):
+        items = [
+            self.item(ChangeReason.NEW_FILE, 'css/site.css'),
+            self.item(ChangeReason.NEW_FILE, 'bg.jpg')]
+        self.assertEqual(
+            {'css/site.css': {'bg.jpg'}}, dependency_graph(items))
@@ -1,6 +1,14 @@
 import os
+import gzip
+import hashlib
+import tempfile
 import unittest
+import weakref
+from unittest import mock
+import s3sup.compression
 import s3sup.fileprepper
+import s3sup.hashing
+from tests.helpers import fixture_project
 
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -8,7 +16,7 @@ MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 class TestFixtureProj1(unittest.TestCase):
 
     def setUp(self):
-        self.project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        self.project_root = fixture_project(self, 'fixture_proj_1')
         self.rules = s3sup.rules.load_rules(os.path.join(
             MODULE_DIR, self.project_root, 's3sup.toml'))
 
@@ -110,3 +118,119 @@ class TestS3PathCreation(unittest.TestCase):
             '', 'disk/products.html',
             {'aws': {'s3_project_root': 'staging/v1.1'}})
         self.assertEqual('staging/v1.1/disk/products.html', fp.s3_path())
+
+
+class TestPreCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.project_root = self.tmpd.name
+        self.css = b'body { color: red; }\n' * 500
+        for name, content in (('site.css', self.css),
+                              ('logo.png', b'\x89PNG' * 500),
+                              ('old.css.gz', gzip.compress(self.css))):
+            with open(os.path.join(self.project_root, name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def prepper(self, path, conf):
+        with open(os.path.join(self.project_root, 's3sup.toml'), 'w') as f:
+            f.write('''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[[path_specific]]
+path = '.*'
+''' + conf)
+        rules = s3sup.rules.load_rules(
+            os.path.join(self.project_root, 's3sup.toml'))
+        return s3sup.fileprepper.FilePrepper(self.project_root, path, rules)
+
+    def test_not_compressed_by_default(self):
+        f = self.prepper('site.css', '')
+        self.assertIsNone(f.compression())
+        self.assertNotIn('Content-Encoding', f.attributes())
+        self.assertEqual(len(self.css), f.size())
+
+    def test_gzip(self):
+        f = self.prepper('site.css', "compress = 'gzip'")
+        self.assertEqual(('gzip', 9), f.compression())
+        self.assertEqual('gzip', f.attributes()['Content-Encoding'])
+        self.assertEqual(
+            'text/css; charset=utf-8', f.attributes()['Content-Type'])
+        with f.content_fileobj() as c:
+            compressed = c.read()
+        self.assertEqual(self.css, gzip.decompress(compressed))
+        self.assertEqual(len(compressed), f.size())
+        self.assertEqual(
+            hashlib.sha256(compressed).hexdigest(), f.content_hash())
+
+    @unittest.skipIf(
+        s3sup.compression.brotli is None, 'brotli not installed')
+    def test_brotli(self):
+        f = self.prepper('site.css', "compress = 'br'\ncompress_level = 5")
+        self.assertEqual('br', f.attributes()['Content-Encoding'])
+        with f.content_fileobj() as c:
+            self.assertEqual(
+                self.css, s3sup.compression.brotli.decompress(c.read()))
+
+    def test_artifact_not_hashed_again(self):
+        f = self.prepper('site.css', "compress = 'gzip'")
+        with mock.patch.object(
+                s3sup.hashing, 'file_hash',
+                wraps=s3sup.hashing.file_hash) as file_hash:
+            content_hash = f.content_hash()
+        # Only the original content, to look up its artifact.
+        file_hash.assert_called_once_with(f.path_local_abs)
+        self.assertEqual(f.content_path().name, content_hash)
+
+    def test_level_changes_content_hash(self):
+        f9 = self.prepper('site.css', "compress = 'gzip'")
+        f1 = self.prepper('site.css', "compress = 'gzip'\ncompress_level = 1")
+        self.assertNotEqual(f9.content_hash(), f1.content_hash())
+        self.assertEqual(f9.attributes_hash(), f1.attributes_hash())
+
+    def test_only_text_files_not_already_encoded_compressed(self):
+        for path in ('logo.png', 'old.css.gz'):
+            f = self.prepper(path, "compress = 'gzip'")
+            self.assertIsNone(f.compression())
+
+    def test_invalid_level(self):
+        f = self.prepper('site.css', "compress = 'gzip'\ncompress_level = 10")
+        with self.assertRaisesRegex(Exception, 'between 0 and 9'):
+            f.compression()
+
+
+class TestContentChanged(unittest.TestCase):
+
+    def test_modification_after_hashing_detected(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            path = os.path.join(tmpd, 'index.html')
+            with open(path, 'wb') as f:
+                f.write(b'<p>Hello</p>')
+            rules = {'aws': {'s3_bucket_name': 'www.example.com'}}
+            f = s3sup.fileprepper.FilePrepper(tmpd, 'index.html', rules)
+            f.content_hash()
+            self.assertFalse(f.content_changed())
+            with open(path, 'ab') as fh:
+                fh.write(b'<p>World</p>')
+            self.assertTrue(f.content_changed())
+
+
+class TestCaching(unittest.TestCase):
+
+    def test_released_once_used(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            with open(os.path.join(tmpd, 'index.html'), 'wb') as f:
+                f.write(b'<p>Hello</p>')
+            rules = {'aws': {'s3_bucket_name': 'www.example.com'}}
+            f = s3sup.fileprepper.FilePrepper(tmpd, 'index.html', rules)
+            f.hashes()
+            f.content_path()
+            f.compression()
+            ref = weakref.ref(f)
+            del f
+            self.assertIsNone(ref())
@@ -0,0 +1,87 @@
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import s3sup.gitstatus
+
+
+def git(root, *args):
+    subprocess.run(
+        ['git', '-C', root, '-c', 'user.name=s3sup', '-c',
+         'user.email=s3sup@example.com'] + list(args),
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@unittest.skipIf(shutil.which('git') is None, 'git not installed')
+class TestGitStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.repo = self.tmpd.name
+        self.root = os.path.join(self.repo, 'site')
+        for path in ('site/index.html', 'site/about/index.html',
+                     'site/robots.txt', 'README'):
+            self.write(path, path)
+        self.write('.gitignore', 'site/build.log\n')
+        git(self.repo, 'init', '-q')
+        git(self.repo, 'add', '-A')
+        git(self.repo, 'commit', '-q', '-m', 'First')
+        self.meta = s3sup.gitstatus.catalogue_meta(self.root)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def write(self, path, content):
+        abs_path = os.path.join(self.repo, path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        with open(abs_path, 'w') as f:
+            f.write(content)
+
+    def test_clean_work_tree(self):
+        self.assertEqual(
+            s3sup.gitstatus.head_commit(self.root),
+            self.meta[s3sup.gitstatus.COMMIT_KEY])
+        self.assertEqual('[]', self.meta[s3sup.gitstatus.DIRTY_KEY])
+        self.assertEqual(
+            {'index.html', os.path.join('about', 'index.html'),
+             'robots.txt'},
+            s3sup.gitstatus.unchanged_since(self.root, self.meta))
+
+    def test_changes_since_commit(self):
+        self.write('site/about/index.html', 'Changed')
+        git(self.repo, 'commit', '-q', '-am', 'Second')
+        self.write('site/robots.txt', 'Not committed')
+        self.write('site/new.html', 'Untracked')
+        self.write('site/build.log', 'Ignored')
+        self.write('README', 'Outside project')
+        os.remove(os.path.join(self.root, 'index.html'))
+        self.assertEqual(
+            set(), s3sup.gitstatus.unchanged_since(self.root, self.meta))
+        self.write('site/index.html', 'site/index.html')
+        self.assertEqual(
+            {'index.html'},
+            s3sup.gitstatus.unchanged_since(self.root, self.meta))
+
+    def test_changes_at_time_of_catalogue_included(self):
+        self.write('site/robots.txt', 'Not committed')
+        meta = s3sup.gitstatus.catalogue_meta(self.root)
+        self.assertEqual(['robots.txt'], json.loads(
+            meta[s3sup.gitstatus.DIRTY_KEY]))
+        self.write('site/robots.txt', 'site/robots.txt')
+        self.assertEqual(
+            {'index.html', os.path.join('about', 'index.html')},
+            s3sup.gitstatus.unchanged_since(self.root, meta))
+        s3sup.gitstatus.mark_dirty(meta, ['index.html'])
+        self.assertEqual(
+            {os.path.join('about', 'index.html')},
+            s3sup.gitstatus.unchanged_since(self.root, meta))
+
+    def test_unknown_commit_or_not_git(self):
+        meta = {s3sup.gitstatus.COMMIT_KEY: '0' * 40}
+        self.assertIsNone(s3sup.gitstatus.unchanged_since(self.root, meta))
+        self.assertIsNone(s3sup.gitstatus.unchanged_since(self.root, {}))
+        with tempfile.TemporaryDirectory() as tmpd:
+            self.assertEqual({}, s3sup.gitstatus.catalogue_meta(tmpd))
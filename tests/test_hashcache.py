@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from s3sup.hashcache import HashCache, stat_key
+
+OLD_KEY = (100, 1000000000, 42, 1000000000, '')
+
+
+class TestHashCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.root = self.tmpd.name
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def test_hashes_persisted(self):
+        c = HashCache(self.root)
+        self.assertIsNone(c.get('index.html', OLD_KEY))
+        c.put('index.html', OLD_KEY, 'abc')
+        c.save()
+        c = HashCache(self.root)
+        self.assertEqual('abc', c.get('index.html', OLD_KEY))
+
+    def test_any_stat_change_misses(self):
+        c = HashCache(self.root)
+        c.put('index.html', OLD_KEY, 'abc')
+        c.save()
+        c = HashCache(self.root)
+        for i in range(len(OLD_KEY)):
+            key = list(OLD_KEY)
+            key[i] = 'gzip-9' if i == 4 else key[i] + 1
+            self.assertIsNone(c.get('index.html', tuple(key)))
+
+    def test_recently_modified_files_not_cached(self):
+        path = os.path.join(self.root, 'index.html')
+        with open(path, 'w') as f:
+            f.write('<p>Hello</p>')
+        c = HashCache(self.root)
+        c.put('index.html', stat_key(os.stat(path)), 'abc')
+        c.save()
+        self.assertFalse(os.path.exists(c.path))
+
+    def test_rehash_ignores_cache(self):
+        c = HashCache(self.root)
+        c.put('index.html', OLD_KEY, 'abc')
+        c.save()
+        self.assertIsNone(HashCache(self.root, rehash=True).get(
+            'index.html', OLD_KEY))
+
+    def test_unseen_paths_pruned(self):
+        c = HashCache(self.root)
+        c.put('index.html', OLD_KEY, 'abc')
+        c.put('old.html', OLD_KEY, 'def')
+        c.save()
+        c = HashCache(self.root)
+        c.get('index.html', OLD_KEY)
+        c.save(prune=True)
+        c = HashCache(self.root)
+        self.assertEqual('abc', c.get('index.html', OLD_KEY))
+        self.assertIsNone(c.get('old.html', OLD_KEY))
+
+    def test_corrupt_cache_discarded(self):
+        c = HashCache(self.root)
+        c.put('index.html', OLD_KEY, 'abc')
+        c.save()
+        with open(c.path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        c = HashCache(self.root)
+        self.assertIsNone(c.get('index.html', OLD_KEY))
+        c.put('index.html', OLD_KEY, 'abc')
+        c.save()
+        self.assertEqual(
+            'abc', HashCache(self.root).get('index.html', OLD_KEY))
@@ -0,0 +1,86 @@
+import os
+import re
+import gzip
+import hashlib
+import tempfile
+import unittest
+
+import s3sup.fileprepper
+import s3sup.hashcache
+from s3sup.hashing import file_hash, hash_content
+
+RULES = {'aws': {'s3_bucket_name': 'www.example.com'}}
+
+
+class TestHashContent(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.root = self.tmpd.name
+        self.expected = {}
+        for i in range(40):
+            content = os.urandom(i * 7919)
+            path = 'f{0}.bin'.format(i)
+            with open(os.path.join(self.root, path), 'wb') as f:
+                f.write(content)
+            os.utime(os.path.join(self.root, path), (0, 0))
+            self.expected[path] = hashlib.sha256(content).hexdigest()
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def fps(self, hash_cache=None):
+        return [s3sup.fileprepper.FilePrepper(
+                    self.root, p, RULES, hash_cache=hash_cache)
+                for p in sorted(self.expected)]
+
+    def assertHashes(self, fps):
+        self.assertEqual(
+            self.expected, {fp.path: fp.content_hash() for fp in fps})
+
+    def test_file_hash(self):
+        self.assertEqual(
+            self.expected['f3.bin'],
+            file_hash(os.path.join(self.root, 'f3.bin')))
+
+    def test_engines_match_sequential(self):
+        for workers, engine in ((1, 'threads'), (8, 'threads'),
+                                (3, 'processes')):
+            fps = self.fps()
+            hash_content(fps, workers=workers, engine=engine)
+            self.assertHashes(fps)
+
+    def test_processes_only_hash_cache_misses(self):
+        cache = s3sup.hashcache.HashCache(self.root)
+        hash_content(self.fps(hash_cache=cache), workers=1)
+        cache.save()
+        with open(os.path.join(self.root, 'f5.bin'), 'ab') as f:
+            f.write(b'changed')
+        os.utime(os.path.join(self.root, 'f5.bin'), (1, 1))
+        with open(os.path.join(self.root, 'f5.bin'), 'rb') as f:
+            self.expected['f5.bin'] = hashlib.sha256(f.read()).hexdigest()
+
+        cache = s3sup.hashcache.HashCache(self.root)
+        fps = self.fps(hash_cache=cache)
+        hash_content(fps, workers=2, engine='processes')
+        self.assertHashes(fps)
+        self.assertEqual(['f5.bin'], list(cache._updated))
+
+    def test_processes_compressed_artifacts(self):
+        rules = dict(RULES, path_specific=[
+            {'path': '.*', 'path_re': re.compile('.*'), 'compress': 'gzip'}])
+        for i in range(3):
+            with open(os.path.join(self.root, 'f{0}.css'.format(i)),
+                      'wb') as f:
+                f.write(b'body { margin: 0; }\n' * (i + 1))
+        fps = [s3sup.fileprepper.FilePrepper(self.root, p, rules)
+               for p in sorted(os.listdir(self.root))
+               if not p.startswith('.')]
+        hash_content(fps, workers=2, engine='processes')
+        for fp in fps:
+            with fp.content_fileobj() as f:
+                content = f.read()
+            if fp.path.endswith('.css'):
+                gzip.decompress(content)
+            self.assertEqual(
+                hashlib.sha256(content).hexdigest(), fp.content_hash())
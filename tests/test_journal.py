@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from s3sup.catalogue import Catalogue, ChangeReason
+from s3sup.journal import Journal, fingerprint
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.remote = Catalogue()
+        self.remote.add_file('index.html', 'c1', 'a1')
+        self.remote.add_file('old.html', 'c2', 'a2')
+        self.fp = fingerprint(['www.example.com', '.s3sup.cat'], self.remote)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def test_fingerprint_depends_on_target_and_catalogue(self):
+        self.assertNotEqual(
+            self.fp, fingerprint(['other.example.com', '.s3sup.cat'],
+                                 self.remote))
+        changed = Catalogue().add_file('index.html', 'c1', 'a1')
+        self.assertNotEqual(
+            self.fp, fingerprint(['www.example.com', '.s3sup.cat'], changed))
+
+    def test_no_journal(self):
+        j = Journal(self.tmpd.name)
+        self.assertEqual({}, j.entries(self.fp))
+        cat, num = j.apply(self.remote, self.fp)
+        self.assertIs(self.remote, cat)
+        self.assertEqual(0, num)
+
+    def test_recorded_changes_applied(self):
+        j = Journal(self.tmpd.name)
+        j.start(self.fp)
+        j.record(ChangeReason.CONTENT_CHANGED, 'index.html', 'c9', 'a1')
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3')
+        j.record(ChangeReason.DELETED, 'old.html')
+        j.record(ChangeReason.DELETED, 'protected.html')
+        j.forget('protected.html')
+        j.close()
+
+        cat, num = Journal(self.tmpd.name).apply(self.remote, self.fp)
+        self.assertEqual(3, num)
+        self.assertEqual(
+            {'index.html': ('c9', 'a1'), 'new.css': ('c3', 'a3')},
+            cat.to_dict())
+        # Original catalogue untouched
+        self.assertIn('old.html', self.remote.to_dict())
+
+    def test_object_size_and_etag_applied(self):
+        j = Journal(self.tmpd.name)
+        j.start(self.fp)
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3',
+                 size=1234, etag='"e3"')
+        j.record(ChangeReason.ATTRIBUTES_CHANGED, 'index.html', 'c1', 'a9')
+        j.close()
+        cat, _ = Journal(self.tmpd.name).apply(self.remote, self.fp)
+        self.assertEqual((1234, '"e3"'), cat.get_object('new.css'))
+        self.assertEqual((None, None), cat.get_object('index.html'))
+
+    def test_journal_from_older_version_discarded(self):
+        j = Journal(self.tmpd.name)
+        j.start(self.fp)
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3')
+        j.close()
+        c = sqlite3.connect(j.path)
+        c.execute('PRAGMA user_version = 1')
+        c.close()
+        self.assertEqual({}, j.entries(self.fp))
+        j.start(self.fp)
+        self.assertEqual({}, j.entries(self.fp))
+        j.close()
+
+    def test_journal_from_other_state_discarded(self):
+        j = Journal(self.tmpd.name)
+        j.start('something else')
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3')
+        j.close()
+        self.assertEqual({}, j.entries(self.fp))
+        j.start(self.fp)
+        j.close()
+        self.assertEqual({}, j.entries(self.fp))
+
+    def test_restart_keeps_entries(self):
+        j = Journal(self.tmpd.name)
+        j.start(self.fp)
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3')
+        j.close()
+        j.start(self.fp)
+        j.record(ChangeReason.NEW_FILE, 'new.js', 'c4', 'a4')
+        j.close()
+        self.assertEqual(2, len(j.entries(self.fp)))
+
+    def test_remove(self):
+        j = Journal(self.tmpd.name)
+        j.start(self.fp)
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3')
+        j.remove()
+        self.assertEqual([], os.listdir(self.tmpd.name))
+
+    def test_corrupt_journal_ignored(self):
+        os.makedirs(os.path.dirname(Journal(self.tmpd.name).path))
+        with open(Journal(self.tmpd.name).path, 'wb') as f:
+            f.write(b'not a database')
+        j = Journal(self.tmpd.name)
+        self.assertEqual({}, j.entries(self.fp))
+        j.start(self.fp)
+        j.record(ChangeReason.NEW_FILE, 'new.css', 'c3', 'a3')
+        self.assertEqual(1, len(j.entries(self.fp)))
+        j.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
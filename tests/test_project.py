@@ -1,14 +1,27 @@
+import io
 import os
+import gzip
 import tempfile
 import unittest
 import pathlib
 import shutil
+import subprocess
 
 import boto3
 import botocore
+import click
 import moto
+from unittest import mock
 
+import s3sup.catalogue
+import s3sup.compression
+import s3sup.hashcache
+import s3sup.hashing
+import s3sup.journal
+import s3sup.transfer
+import s3sup.utils
 from s3sup.project import Project
+from tests.helpers import copy_fixture, fixture_project
 
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -20,6 +33,26 @@ def all_bucket_keys(bucket):
     return ([o.key for o in bucket.objects.all()])
 
 
+_make_api_call = botocore.client.BaseClient._make_api_call
+
+
+def _conditional_get(client, operation_name, api_params):
+    """
+    Answers GetObject with a 304 if IfNoneMatch matches the object's ETag,
+    as S3 does. moto 1.x ignores If-None-Match.
+    """
+    etag = api_params.get('IfNoneMatch')
+    if operation_name == 'GetObject' and etag is not None:
+        head = client.head_object(
+            Bucket=api_params['Bucket'], Key=api_params['Key'])
+        if head['ETag'] == etag:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': '304', 'Message': 'Not Modified'},
+                 'ResponseMetadata': {'HTTPStatusCode': 304}},
+                operation_name)
+    return _make_api_call(client, operation_name, api_params)
+
+
 class TestProject(unittest.TestCase):
 
     @moto.mock_s3
@@ -29,7 +62,7 @@ class TestProject(unittest.TestCase):
             Bucket='www.example.com',
             CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
 
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         p = Project(project_root)
         cat = p.get_remote_catalogue()
         self.assertEqual({}, cat.to_dict())
@@ -48,11 +81,394 @@ class TestProject(unittest.TestCase):
                 Key='staging/.s3sup.catalogue.csv',
                 ACL='private',
                 Body=exp_csv_f)
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         p = Project(project_root)
         cat = p.get_remote_catalogue()
         self.assertTrue('assets/logo.svg' in cat.to_dict())
 
+    @moto.mock_s3
+    def test_one_boto_session_shared_by_whole_push(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        project_root = fixture_project(self, 'fixture_proj_1')
+        p = Project(project_root, concurrency=3)
+        self.assertEqual(12, p._max_pool_connections)
+        with mock.patch(
+                'boto3.session.Session', wraps=boto3.session.Session) as s:
+            p.sync()
+        self.assertEqual(1, s.call_count)
+
+        summary = p.metrics.summary()
+        # 10 unique files, write test, catalogue and old catalogue breaker.
+        # about-us/index.html is a copy of about-us/duplicate.html.
+        self.assertEqual(13, summary['Requests by operation']['PutObject'])
+        self.assertEqual(1, summary['Requests by operation']['CopyObject'])
+        self.assertGreater(summary['S3 requests'], 14)
+
+    @moto.mock_s3
+    @mock.patch('botocore.client.BaseClient._make_api_call', _conditional_get)
+    def test_unchanged_remote_catalogue_not_downloaded(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        b = conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = os.path.join(tmpd, 'proj')
+            copy_fixture('fixture_proj_1', project_root)
+            p = Project(project_root)
+            p.sync()
+            expected = p.local_catalogue().to_dict()
+
+            def remote_catalogue():
+                with mock.patch(
+                        's3sup.catcache.CatalogueCache.put',
+                        wraps=p._cat_cache.put) as put:
+                    cat = Project(project_root).get_remote_catalogue()
+                return cat.to_dict(), put.call_count
+            self.assertEqual((expected, 0), remote_catalogue())
+
+            # Pushed from elsewhere.
+            buf = io.BytesIO()
+            cat = s3sup.catalogue.Catalogue().add_file('a.html', 'AA', 'BB')
+            cat.to_sqlite(buf)
+            b.Object('staging/.s3sup.cat').put(Body=buf.getvalue())
+            self.assertEqual(
+                ({'a.html': ('AA', 'BB')}, 1), remote_catalogue())
+            self.assertEqual(
+                ({'a.html': ('AA', 'BB')}, 0), remote_catalogue())
+
+    @moto.mock_s3
+    def test_catalogue_copy_not_shared_between_tests(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        Project(fixture_project(self, 'fixture_proj_1')).sync()
+        self.assertFalse(os.path.exists(os.path.join(
+            MODULE_DIR, 'fixture_proj_1', s3sup.utils.STATE_DIR)))
+        # A fresh copy of the same fixture downloads the catalogue itself.
+        p = Project(fixture_project(self, 'fixture_proj_1'))
+        self.assertIsNone(p._cat_cache.get())
+        with mock.patch(
+                's3sup.catcache.CatalogueCache.put',
+                wraps=p._cat_cache.put) as put:
+            p.get_remote_catalogue()
+        self.assertEqual(1, put.call_count)
+
+    def test_unchanged_files_not_hashed_again(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = os.path.join(tmpd, 'proj')
+            copy_fixture('fixture_proj_1', project_root)
+            expected = Project(project_root).local_catalogue().to_dict()
+
+            def reads(**kwargs):
+                with mock.patch(
+                        's3sup.hashing.file_hash',
+                        wraps=s3sup.hashing.file_hash) as m:
+                    cat = Project(project_root, **kwargs).local_catalogue()
+                self.assertEqual(expected, cat.to_dict())
+                return m.call_count
+            self.assertEqual(0, reads())
+            self.assertEqual(11, reads(rehash=True))
+
+            os.utime(os.path.join(project_root, 'robots.txt'), (0, 0))
+            self.assertEqual(1, reads())
+
+    def test_excluded_paths_left_out_of_catalogue(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = os.path.join(tmpd, 'proj')
+            copy_fixture('fixture_proj_1', project_root)
+            conf = pathlib.Path(project_root).joinpath('s3sup.toml')
+            conf.write_text(
+                "exclude = ['*.pdf', 'about-us/', 'assets/*']\n"
+                "include = ['logo.svg']\n" + conf.read_text())
+            paths = Project(project_root).local_catalogue().to_dict()
+        self.assertEqual([
+            'assets/logo.svg', 'examples.html.gz', 'index.html',
+            'products.html', 'robots.txt'], sorted(paths))
+
+    def git_project(self, tmpd):
+        """fixture_proj_1 committed to git and pushed, using git = true"""
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        project_root = os.path.join(tmpd, 'proj')
+        copy_fixture('fixture_proj_1', project_root)
+        conf = pathlib.Path(project_root).joinpath('s3sup.toml')
+        conf.write_text(
+            "exclude = ['.git/']\n" + conf.read_text() +
+            '\n[hashing]\ngit = true\n')
+        for args in (['init', '-q'], ['add', '-A'],
+                     ['commit', '-q', '-m', 'Site']):
+            subprocess.run(
+                ['git', '-C', project_root, '-c', 'user.name=s3sup',
+                 '-c', 'user.email=s3sup@example.com'] + args,
+                check=True, stdout=subprocess.DEVNULL)
+        Project(project_root).sync()
+        return project_root
+
+    @unittest.skipIf(shutil.which('git') is None, 'git not installed')
+    @moto.mock_s3
+    def test_git_changes_only_hashed(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.git_project(tmpd)
+
+            with open(os.path.join(project_root, 'robots.txt'), 'a') as f:
+                f.write('Disallow: /drafts/\n')
+            with open(os.path.join(project_root, 'new.html'), 'w') as f:
+                f.write('<p>New</p>')
+            with mock.patch(
+                    's3sup.hashing.file_hash',
+                    wraps=s3sup.hashing.file_hash) as m:
+                p = Project(project_root, rehash=True)
+                diff, _ = p.calculate_diff()
+            self.assertEqual(
+                ['new.html', 'robots.txt'],
+                sorted(os.path.basename(c[0][0]) for c in m.call_args_list))
+            self.assertEqual(['new.html'], diff['upload']['new_files'])
+            self.assertEqual(
+                ['robots.txt'], diff['upload']['content_changed'])
+            self.assertEqual(10, diff['num_unchanged'])
+
+    @unittest.skipIf(shutil.which('git') is None, 'git not installed')
+    @moto.mock_s3
+    def test_git_unchanged_files_kept_in_hash_cache(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            with mock.patch.object(s3sup.hashcache, 'RACY_SECONDS', -60):
+                project_root = self.git_project(tmpd)
+            cached = set(s3sup.hashcache.HashCache(project_root)._load())
+            self.assertIn('index.html', cached)
+            Project(project_root).local_catalogue()
+            self.assertEqual(
+                cached, set(s3sup.hashcache.HashCache(project_root)._load()))
+
+
+class TestProjectResumeInterruptedPush(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.project_root = os.path.join(self.tmpd.name, 'proj')
+        copy_fixture('fixture_proj_1', self.project_root)
+        self.journal_path = os.path.join(
+            self.project_root, '.s3sup', 'journal.sqlite')
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def interrupted_push(self):
+        orig_put = s3sup.transfer.S3Operations.put
+
+        def put_then_die(ops, fp):
+            if fp.path == 'products.html':
+                raise KeyboardInterrupt()
+            return orig_put(ops, fp)
+
+        p = Project(self.project_root, concurrency=1)
+        with mock.patch.object(
+                s3sup.transfer.S3Operations, 'put', put_then_die):
+            with self.assertRaises(KeyboardInterrupt):
+                p.sync()
+
+    @moto.mock_s3
+    def test_completed_changes_skipped(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        self.interrupted_push()
+        self.assertTrue(os.path.exists(self.journal_path))
+
+        p = Project(self.project_root)
+        diff, _ = p.calculate_diff()
+        # Duplicate content is copied after the phase uploading it, which
+        # never completed.
+        self.assertEqual(
+            ['about-us/index.html', 'products.html'],
+            diff['upload']['new_files'])
+        p = Project(self.project_root)
+        with mock.patch.object(
+                s3sup.journal.Journal, 'apply',
+                autospec=True, side_effect=s3sup.journal.Journal.apply) as m:
+            p.sync()
+        self.assertEqual(1, m.call_count)
+        # products.html, write test, catalogue and old catalogue breaker
+        summary = p.metrics.summary()
+        self.assertEqual(4, summary['Requests by operation']['PutObject'])
+        self.assertEqual(1, summary['Requests by operation']['CopyObject'])
+        self.assertFalse(os.path.exists(self.journal_path))
+
+        pn = Project(self.project_root)
+        diff, _ = pn.calculate_diff()
+        self.assertEqual(0, diff['num_changes'])
+        self.assertEqual(11, diff['num_unchanged'])
+        # ETags of objects uploaded before the interruption are kept too.
+        remote_cat = pn.get_remote_catalogue()
+        for path in remote_cat.paths():
+            self.assertEqual(
+                conn.Object('www.example.com', pn.file_prepper_wrapped(
+                    path).s3_path()).e_tag,
+                remote_cat.get_object(path)[1])
+
+    @moto.mock_s3
+    def test_catalogue_written_when_only_journal_remains(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        p = Project(self.project_root)
+        with mock.patch.object(
+                Project, 'write_remote_catalogue',
+                side_effect=ConnectionResetError()):
+            with self.assertRaises(ConnectionResetError):
+                p.sync()
+
+        pn = Project(self.project_root)
+        self.assertEqual(0, pn.calculate_diff()[0]['num_changes'])
+        pn.sync()
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertEqual(11, len(Project(
+            self.project_root).get_remote_catalogue().to_dict()))
+
+    @moto.mock_s3
+    def test_no_fingerprint_without_journal(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        Project(self.project_root).sync()
+        with mock.patch(
+                's3sup.journal.fingerprint',
+                wraps=s3sup.journal.fingerprint) as m:
+            Project(self.project_root).calculate_diff()
+        m.assert_not_called()
+
+    @moto.mock_s3
+    def test_failed_delete_of_file_only_in_journal(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        self.interrupted_push()
+        b = conn.Bucket('www.example.com')
+        self.assertIn('staging/robots.txt', all_bucket_keys(b))
+        os.remove(os.path.join(self.project_root, 'robots.txt'))
+
+        def refuse_deletes(ops, fps):
+            return [(fp.s3_path(), 'AccessDenied', 'Access Denied')
+                    for fp in fps]
+
+        with mock.patch.object(
+                s3sup.transfer.S3Operations, 'delete_batch', refuse_deletes):
+            Project(self.project_root).sync()
+        self.assertIn('staging/robots.txt', all_bucket_keys(b))
+        diff, _ = Project(self.project_root).calculate_diff()
+        self.assertEqual(['robots.txt'], diff['delete'])
+
+    @moto.mock_s3
+    def test_journal_ignored_if_remote_catalogue_changed(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        self.interrupted_push()
+
+        # Someone else pushes in the meantime
+        other_root = os.path.join(self.tmpd.name, 'other')
+        copy_fixture('fixture_proj_2_minimal', other_root)
+        shutil.copy(
+            os.path.join(self.project_root, 's3sup.toml'), other_root)
+        Project(other_root).sync()
+
+        p = Project(self.project_root)
+        diff, _ = p.calculate_diff(unchanged=True)
+        self.assertEqual(11, len(
+            diff['upload']['new_files'] +
+            diff['upload']['content_changed'] +
+            diff['upload']['attributes_changed'] +
+            diff['unchanged']))
+        self.assertNotIn('products.html', diff['unchanged'])
+        self.assertIn('assets/logo.svg', diff['upload']['new_files'])
+
+
+class TestProjectPathsSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.project_root = os.path.join(self.tmpd.name, 'proj')
+        copy_fixture('fixture_proj_1', self.project_root)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def path(self, rel_path):
+        return os.path.join(self.project_root, rel_path)
+
+    @moto.mock_s3
+    def test_only_given_paths_synced(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        b = conn.Bucket('www.example.com')
+        p = Project(self.project_root)
+        p.sync()
+
+        with open(self.path('products.html'), 'a') as f:
+            f.write('<p>Another product</p>')
+        with open(self.path('new.html'), 'w') as f:
+            f.write('<p>New</p>')
+        os.remove(self.path('robots.txt'))
+        os.rename(self.path('assets'), self.path('static'))
+        # Changed but not reported
+        with open(self.path('index.html'), 'a') as f:
+            f.write('<p>Unreported</p>')
+
+        with mock.patch.object(
+                p, 'get_remote_catalogue',
+                side_effect=AssertionError('downloaded again')):
+            diff, new_remote_cat = p.calculate_paths_diff(
+                ['products.html', 'new.html', 'robots.txt', 'assets',
+                 'static'])
+            self.assertEqual(
+                ['products.html'], diff['upload']['content_changed'])
+            self.assertEqual(['new.html'], diff['upload']['new_files'])
+            self.assertEqual(['robots.txt'], diff['delete'])
+            self.assertEqual(4, len(diff['moved']))
+            self.assertIn(
+                ('assets/logo.svg', 'static/logo.svg'), diff['moved'])
+            p.sync_paths_diff(diff, new_remote_cat)
+
+        keys = all_bucket_keys(b)
+        self.assertIn('staging/new.html', keys)
+        self.assertIn('staging/static/logo.svg', keys)
+        self.assertNotIn('staging/assets/logo.svg', keys)
+        self.assertNotIn('staging/robots.txt', keys)
+
+        pn = Project(self.project_root)
+        diff, _ = pn.calculate_diff()
+        self.assertEqual(
+            ['index.html'], diff['upload']['content_changed'])
+        self.assertEqual(1, diff['num_changes'])
+
+    @moto.mock_s3
+    def test_excluded_and_unchanged_paths_ignored(self):
+        conn = boto3.resource('s3', region_name='eu-west-1')
+        conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        p = Project(self.project_root)
+        p.sync()
+        os.makedirs(self.path('.s3sup'), exist_ok=True)
+        with open(self.path(os.path.join('.s3sup', 'x')), 'w') as f:
+            f.write('local state')
+        diff, _ = p.calculate_paths_diff(
+            ['robots.txt', 's3sup.toml', os.path.join('.s3sup', 'x')])
+        self.assertEqual(0, diff['num_changes'])
+        self.assertEqual(1, diff['num_unchanged'])
+
 
 class TestProjectSyncNoChanges(unittest.TestCase):
 
@@ -62,11 +478,11 @@ class TestProjectSyncNoChanges(unittest.TestCase):
         self.conn.create_bucket(
             Bucket='www.example.com',
             CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         p = Project(project_root)
         p.sync()
 
-        project_root_n = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root_n = fixture_project(self, 'fixture_proj_1')
         pn = Project(project_root_n)
         pn.sync()
 
@@ -91,7 +507,7 @@ class TestProjectSyncProjectChanges(unittest.TestCase):
         self.conn.create_bucket(
             Bucket='www.example.com',
             CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_2_minimal')
+        project_root = fixture_project(self, 'fixture_proj_2_minimal')
         p = Project(project_root)
         p.sync()
 
@@ -105,11 +521,11 @@ class TestProjectSyncProjectChanges(unittest.TestCase):
         self.conn.create_bucket(
             Bucket='www.example.com',
             CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-        project_root = os.path.join(MODULE_DIR, 'fixture_proj_1')
+        project_root = fixture_project(self, 'fixture_proj_1')
         p = Project(project_root)
         p.sync()
 
-        project_root_n = os.path.join(MODULE_DIR, 'fixture_proj_1.1')
+        project_root_n = fixture_project(self, 'fixture_proj_1.1')
         pn = Project(project_root_n)
         pn.sync()
 
@@ -147,6 +563,62 @@ class TestProjectSyncProjectChanges(unittest.TestCase):
             o.download_file(tmpp)
         os.remove(tmpp)
 
+    @moto.mock_s3
+    def test_preflight_retried_when_throttled(self):
+        self.conn = boto3.resource('s3', region_name='eu-west-1')
+        self.conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        p = Project(fixture_project(self, 'fixture_proj_1'))
+        p._retrier.sleep = lambda seconds: None
+        attempts = []
+
+        def throttle_first(params, **kwargs):
+            if params['url_path'].endswith('.s3sup.write_test'):
+                attempts.append(params['method'])
+                if len(attempts) == 1:
+                    raise botocore.exceptions.ClientError({
+                        'Error': {'Code': 'SlowDown', 'Message': 'SlowDown'},
+                        'ResponseMetadata': {'HTTPStatusCode': 503}},
+                        'PutObject')
+        rsrc, b = p._boto_bucket()
+        rsrc.meta.client.meta.events.register(
+            'before-call.s3.PutObject', throttle_first)
+        p.remote_preflight_checks()
+        self.assertEqual(['PUT', 'PUT'], attempts)
+        self.assertNotIn('staging/.s3sup.write_test', all_bucket_keys(b))
+
+    @moto.mock_s3
+    def test_failed_deletes_kept_in_catalogue(self):
+        self.conn = boto3.resource('s3', region_name='eu-west-1')
+        self.conn.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        project_root = fixture_project(self, 'fixture_proj_1')
+        p = Project(project_root)
+        p.sync()
+
+        def refuse_deletes(ops, fps):
+            return [(fp.s3_path(), 'AccessDenied', 'Access Denied')
+                    for fp in fps]
+
+        project_root_n = fixture_project(self, 'fixture_proj_1.1')
+        pn = Project(project_root_n)
+        with mock.patch.object(
+                s3sup.transfer.S3Operations, 'delete_batch', refuse_deletes):
+            pn.sync()
+
+        b = self.conn.Bucket('www.example.com')
+        self.assertIn(
+            'staging/assets/landscape.62.png', all_bucket_keys(b))
+        # Deletion is attempted again on the next push
+        pr = Project(project_root_n)
+        diff, _ = pr.calculate_diff()
+        self.assertEqual(['assets/landscape.62.png'], diff['delete'])
+        pr.sync()
+        self.assertNotIn(
+            'staging/assets/landscape.62.png', all_bucket_keys(b))
+
 
 class TestMultipleProjectConfigurations(unittest.TestCase):
 
@@ -158,10 +630,8 @@ class TestMultipleProjectConfigurations(unittest.TestCase):
         return b
 
     def create_projdir_with_conf(self, skeleton_dir_name, new_dir, config):
-        original_dir = pathlib.Path(
-            MODULE_DIR).joinpath(skeleton_dir_name).resolve()
         new_dir_path = pathlib.Path(new_dir).joinpath('proj')
-        shutil.copytree(original_dir, new_dir_path)
+        copy_fixture(skeleton_dir_name, str(new_dir_path))
         cf = pathlib.Path(new_dir_path).joinpath('s3sup.toml')
         cf.write_text(config)
         return new_dir_path
@@ -184,6 +654,375 @@ s3_bucket_name = 'www.example.com'
         o = b.Object('index.html')
         self.assertEqual('max-age=10', o.cache_control)
 
+    @moto.mock_s3
+    def test_transfer_settings(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[transfer]
+concurrency = 3
+max_inflight_mb = 1
+'''
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'skeleton_proj_1.0', tmpd, conf)
+            p = Project(project_root)
+            self.assertEqual(3, p._concurrency)
+            self.assertEqual(1024 * 1024, p._max_inflight_bytes)
+            p.sync()
+
+            # Supplied at runtime takes priority
+            p = Project(project_root, concurrency=1)
+            self.assertEqual(1, p._concurrency)
+        self.assertIn('assets/landscape.62.png', all_bucket_keys(b))
+        self.assertIn('index.html', all_bucket_keys(b))
+
+    @moto.mock_s3
+    def test_catalogue_records_object_etags(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+'''
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'skeleton_proj_1.0', tmpd, conf)
+            Project(project_root).sync()
+            cat = Project(project_root).get_remote_catalogue()
+        o = b.Object('index.html')
+        self.assertEqual(
+            (o.content_length, o.e_tag), cat.get_object('index.html'))
+
+    @moto.mock_s3
+    def test_sharded_catalogue(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[catalogue]
+shards = 4
+'''
+
+        def shard_keys():
+            return {k for k in all_bucket_keys(b)
+                    if k.startswith('.s3sup.cat.shards/')}
+
+        def run(project_root, method):
+            """Shard keys fetched, and the result of method"""
+            with mock.patch(
+                    's3sup.transfer.run_concurrently',
+                    wraps=s3sup.transfer.run_concurrently) as m:
+                result = method(Project(project_root))
+            return [k for args in m.call_args_list for k in args[0][1]], (
+                result)
+
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            expected = Project(project_root).local_catalogue().to_dict()
+            run(project_root, Project.sync)
+            first = shard_keys()
+            self.assertEqual(4, len(first))
+
+            fetched, cat = run(project_root, Project.get_remote_catalogue)
+            self.assertEqual([], fetched)
+            self.assertEqual(expected, cat.to_dict())
+
+            with open(os.path.join(project_root, 'robots.txt'), 'a') as f:
+                f.write('Disallow: /private/\n')
+            fetched, _ = run(project_root, Project.calculate_diff)
+            self.assertEqual(1, len(fetched))
+            self.assertIn(fetched[0], first)
+            Project(project_root).sync()
+            # Only the changed shard replaced.
+            second = shard_keys()
+            self.assertEqual(first - set(fetched), first & second)
+            self.assertEqual(1, len(second - first))
+
+            cat = Project(project_root).get_remote_catalogue()
+            self.assertNotEqual(
+                expected['robots.txt'], cat.get('robots.txt'))
+            # Not downloaded as it matches the local shard, but on S3 it
+            # records the ETag of the new upload.
+            shard = s3sup.catalogue.Catalogue()
+            shard.from_sqlite(
+                b.Object((second - first).pop()).get()['Body'])
+            self.assertEqual(
+                (b.Object('robots.txt').content_length,
+                 b.Object('robots.txt').e_tag),
+                shard.get_object('robots.txt'))
+
+            # A shard missing from S3 is an error, not a missing catalogue.
+            with open(os.path.join(project_root, 'robots.txt'), 'a') as f:
+                f.write('Disallow: /tmp/\n')
+            shard_key = (second - first).pop()
+            body = b.Object(shard_key).get()['Body'].read()
+            b.Object(shard_key).delete()
+            with self.assertRaisesRegex(click.ClickException, 'shard'):
+                Project(project_root).get_remote_catalogue()
+            b.Object(shard_key).put(Body=body)
+
+            # Back to a single catalogue
+            conf_path = os.path.join(project_root, 's3sup.toml')
+            with open(conf_path, 'w') as f:
+                f.write(conf.replace('shards = 4', ''))
+            with open(os.path.join(project_root, 'robots.txt'), 'a') as f:
+                f.write('Disallow: /drafts/\n')
+            Project(project_root).sync()
+            self.assertEqual(set(), shard_keys())
+            cat = Project(project_root).get_remote_catalogue()
+            self.assertEqual(
+                Project(project_root).local_catalogue().to_dict(),
+                cat.to_dict())
+
+    @moto.mock_s3
+    def test_catalogue_deltas(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[catalogue]
+deltas = true
+max_deltas = 1
+max_delta_ratio = 100
+'''
+
+        def log_keys():
+            return {k for k in all_bucket_keys(b)
+                    if k.startswith('.s3sup.cat.log/')}
+
+        def change_and_sync(project_root, line):
+            with open(os.path.join(project_root, 'robots.txt'), 'a') as f:
+                f.write(line)
+            Project(project_root).sync()
+            cat = Project(project_root).get_remote_catalogue()
+            self.assertEqual(
+                Project(project_root).local_catalogue().to_dict(),
+                cat.to_dict())
+            return cat
+
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            Project(project_root).sync()
+            base = log_keys()
+            self.assertEqual(1, len(base))
+
+            # A delta holding only the changed file is appended.
+            cat = change_and_sync(project_root, 'Disallow: /private/\n')
+            delta = log_keys() - base
+            self.assertEqual(1, len(delta))
+            changed = s3sup.catalogue.Catalogue()
+            with s3sup.catalogue.load_gzipped_sqlite(
+                    b.Object(delta.pop()).get()['Body']) as c:
+                changed.from_connection(c)
+            self.assertEqual(['robots.txt'], list(changed.paths()))
+            self.assertEqual(
+                (b.Object('robots.txt').content_length,
+                 b.Object('robots.txt').e_tag),
+                cat.get_object('robots.txt'))
+
+            # Read from the local copies, not downloaded again.
+            with mock.patch.object(
+                    Project, '_get_object', side_effect=AssertionError):
+                Project(project_root).get_remote_catalogue()
+
+            # A delta missing from S3 is an error, not a missing catalogue.
+            shutil.rmtree(os.path.join(
+                str(project_root), s3sup.utils.STATE_DIR))
+            delta_key = (log_keys() - base).pop()
+            body = b.Object(delta_key).get()['Body'].read()
+            b.Object(delta_key).delete()
+            with self.assertRaisesRegex(click.ClickException, 'delta'):
+                Project(project_root).get_remote_catalogue()
+            b.Object(delta_key).put(Body=body)
+
+            # A second delta compacts the log into a new base.
+            before = log_keys()
+            change_and_sync(project_root, 'Disallow: /drafts/\n')
+            after = log_keys()
+            self.assertEqual(1, len(after))
+            self.assertEqual(set(), before & after)
+
+            # Back to a single catalogue
+            conf_path = os.path.join(project_root, 's3sup.toml')
+            with open(conf_path, 'w') as f:
+                f.write(conf.replace('deltas = true', ''))
+            change_and_sync(project_root, 'Disallow: /tmp/\n')
+            self.assertEqual(set(), log_keys())
+
+    def test_deltas_and_shards_exclusive(self):
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[catalogue]
+deltas = true
+shards = 4
+'''
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            with self.assertRaisesRegex(click.UsageError, 'deltas'):
+                Project(project_root)
+
+    @moto.mock_s3
+    def test_deduplication_can_be_disabled(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[transfer]
+deduplicate = false
+'''
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            p = Project(project_root)
+            p.sync()
+        self.assertNotIn(
+            'CopyObject', p.metrics.summary()['Requests by operation'])
+        self.assertIn('about-us/index.html', all_bucket_keys(b))
+
+    @moto.mock_s3
+    def test_graph_scheduler(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[transfer]
+scheduler = 'graph'
+'''
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            p = Project(project_root)
+            self.assertEqual('graph', p._scheduler)
+            p.sync()
+        keys = all_bucket_keys(b)
+        self.assertIn('index.html', keys)
+        self.assertIn('assets/stylesheet.css', keys)
+        self.assertIn('about-us/duplicate.html', keys)
+
+    @moto.mock_s3
+    def test_pre_compression(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[[path_specific]]
+path = '.*'
+compress = 'gzip'
+'''
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            Project(project_root).sync()
+            store = os.path.join(str(project_root), '.s3sup', 'compressed')
+            first = set(os.listdir(store))
+            o = b.Object('assets/stylesheet.css').get()
+            self.assertEqual('gzip', o['ContentEncoding'])
+            cat = Project(project_root).get_remote_catalogue()
+            self.assertEqual(
+                (o['ContentLength'], o['ETag']),
+                cat.get_object('assets/stylesheet.css'))
+            with open(str(project_root.joinpath(
+                    'assets/stylesheet.css')), 'rb') as f:
+                self.assertEqual(f.read(), gzip.decompress(o['Body'].read()))
+            # Images are left alone
+            o = b.Object('assets/landscape.62.png').get()
+            self.assertNotIn('ContentEncoding', o)
+
+            # Changing the level means uploading again
+            project_root.joinpath('s3sup.toml').write_text(
+                conf + 'compress_level = 1\n')
+            p = Project(project_root)
+            diff, _ = p.calculate_diff(unchanged=True)
+            self.assertIn(
+                'assets/stylesheet.css', diff['upload']['content_changed'])
+            self.assertIn('assets/landscape.62.png', diff['unchanged'])
+
+            # Artifacts at the old level are pruned once pushed
+            p.sync()
+            after = set(os.listdir(store))
+            self.assertEqual(len(first), len(after))
+            self.assertEqual(set(), first & after)
+
+    @moto.mock_s3
+    def test_pre_compressed_again_after_store_deleted(self):
+        b = self.create_example_bucket()
+        conf = '''
+[aws]
+region_name = 'eu-west-1'
+s3_bucket_name = 'www.example.com'
+
+[[path_specific]]
+path = '.*'
+compress = 'gzip'
+'''
+        orig_compress = s3sup.compression.compress
+
+        def upgraded_compress(f_in, f_out, codec, level):
+            orig_compress(f_in, f_out, codec, level)
+            f_out.write(b'different')
+
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = self.create_projdir_with_conf(
+                'fixture_proj_1', tmpd, conf)
+            # Hashes cached, but nothing pushed.
+            Project(project_root).calculate_diff()
+            shutil.rmtree(os.path.join(
+                str(project_root), s3sup.utils.STATE_DIR, 'compressed'))
+            with mock.patch.object(
+                    s3sup.compression, 'compress', upgraded_compress):
+                Project(project_root).sync()
+            body = b.Object('assets/stylesheet.css').get()['Body'].read()
+            self.assertTrue(body.endswith(b'different'))
+            with mock.patch.object(
+                    s3sup.compression, 'compress', upgraded_compress):
+                diff, _ = Project(project_root).calculate_diff()
+            self.assertEqual(0, diff['num_changes'])
+
+    @moto.mock_s3
+    def test_moved_files_copied_on_s3(self):
+        b = self.create_example_bucket()
+        with tempfile.TemporaryDirectory() as tmpd:
+            project_root = os.path.join(tmpd, 'proj')
+            copy_fixture('fixture_proj_1', project_root)
+            Project(project_root).sync()
+            os.rename(os.path.join(project_root, 'assets'),
+                      os.path.join(project_root, 'static'))
+            p = Project(project_root)
+            diff, _ = p.calculate_diff()
+            self.assertEqual(4, len(diff['moved']))
+            self.assertEqual(4, diff['num_changes'])
+            p.sync()
+        ops = p.metrics.summary()['Requests by operation']
+        # Only the write test, catalogue and old catalogue breaker uploaded
+        self.assertEqual(3, ops['PutObject'])
+        self.assertEqual(4, ops['CopyObject'])
+        keys = all_bucket_keys(b)
+        self.assertIn('staging/static/logo.svg', keys)
+        self.assertNotIn('staging/assets/logo.svg', keys)
+        o = b.Object('staging/static/stylesheet.css')
+        # Attributes for the new path are applied
+        self.assertEqual('private; max-age=400', o.cache_control)
+
     @moto.mock_s3
     def test_nodelete(self):
         b = self.create_example_bucket()
@@ -282,7 +1121,7 @@ s3_project_root = ''
             project_root = self.create_projdir_with_conf(
                 'skeleton_proj_1.0', tmpd, conf)
             p = Project(project_root)
-            diff, new_remote_cat = p.calculate_diff()
+            diff, new_remote_cat = p.calculate_diff(unchanged=True)
             p.sync()
         self.assertIn('index.html', diff['unchanged'])
         self.assertIn('index.html', all_bucket_keys(b))
@@ -300,7 +1139,7 @@ class TestProjectMigrationFromCSVToSqlite(unittest.TestCase):
         self.conn.create_bucket(
             Bucket='www.example.com',
             CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-        project_root = os.path.join(MODULE_DIR, 'migration_fixture_proj_1')
+        project_root = fixture_project(self, 'migration_fixture_proj_1')
         p = Project(project_root)
         p.sync()
 
@@ -317,7 +1156,7 @@ class TestProjectMigrationFromCSVToSqlite(unittest.TestCase):
         self.assertNotIn('.s3sup.cat', all_bucket_keys(b))
         self.assertIn('.s3sup.catalogue.csv', all_bucket_keys(b))
 
-        project_root_n = os.path.join(MODULE_DIR, 'migration_fixture_proj_1.1')
+        project_root_n = fixture_project(self, 'migration_fixture_proj_1.1')
         pn = Project(project_root_n)
         pn.sync()
 
@@ -344,7 +1183,7 @@ class TestProjectMigrationFromCSVToSqlite(unittest.TestCase):
         self.conn.create_bucket(
             Bucket='www.example.com',
             CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
-        project_root = os.path.join(MODULE_DIR, 'migration_fixture_proj_1.1')
+        project_root = fixture_project(self, 'migration_fixture_proj_1.1')
         p = Project(project_root)
         p.sync()
 
@@ -360,7 +1199,7 @@ class TestProjectMigrationFromCSVToSqlite(unittest.TestCase):
         self.assertIn('.s3sup.cat', all_bucket_keys(b))
         self.assertIn('.s3sup.catalogue.csv', all_bucket_keys(b))
 
-        project_root_n = os.path.join(MODULE_DIR, 'migration_fixture_proj_1.1')
+        project_root_n = fixture_project(self, 'migration_fixture_proj_1.1')
         pn = Project(project_root_n)
         diff, new_remote_cat = pn.calculate_diff()
         self.assertEqual(0, diff['num_changes'])
@@ -0,0 +1,180 @@
+import asyncio
+import unittest
+
+import botocore.exceptions
+
+import s3sup.metrics
+from s3sup.retry import (
+    AdaptiveRateLimiter, Retrier, classify_error, key_prefix)
+
+
+def client_error(code, status=400):
+    return botocore.exceptions.ClientError({
+        'Error': {'Code': code, 'Message': code},
+        'ResponseMetadata': {'HTTPStatusCode': status}}, 'PutObject')
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestKeyPrefix(unittest.TestCase):
+
+    def test_key_prefix(self):
+        self.assertEqual('', key_prefix('index.html'))
+        self.assertEqual('assets/img', key_prefix('assets/img/logo.png'))
+
+
+class TestClassifyError(unittest.TestCase):
+
+    def test_throttling(self):
+        self.assertEqual('throttle', classify_error(client_error('SlowDown')))
+        self.assertEqual(
+            'throttle', classify_error(client_error('Unknown', 503)))
+
+    def test_transient(self):
+        self.assertEqual(
+            'transient', classify_error(client_error('InternalError', 500)))
+        self.assertEqual(
+            'transient', classify_error(ConnectionResetError('reset')))
+        self.assertEqual(
+            'transient', classify_error(
+                botocore.exceptions.EndpointConnectionError(
+                    endpoint_url='https://s3.amazonaws.com')))
+
+    def test_not_retried(self):
+        self.assertIsNone(classify_error(client_error('AccessDenied', 403)))
+        self.assertIsNone(classify_error(client_error('NoSuchKey', 404)))
+        self.assertIsNone(classify_error(ValueError('bug')))
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+
+    def test_aimd(self):
+        limiter = AdaptiveRateLimiter(max_rate=100, clock=FakeClock())
+        self.assertEqual(100, limiter.rate('a'))
+        limiter.on_throttle('a')
+        self.assertEqual(50, limiter.rate('a'))
+        limiter.on_throttle('a')
+        self.assertEqual(25, limiter.rate('a'))
+        limiter.on_success('a')
+        self.assertEqual(26, limiter.rate('a'))
+        for _ in range(200):
+            limiter.on_success('a')
+        self.assertEqual(100, limiter.rate('a'))
+
+    def test_rate_never_below_minimum(self):
+        limiter = AdaptiveRateLimiter(max_rate=10, min_rate=2)
+        for _ in range(10):
+            limiter.on_throttle('a')
+        self.assertEqual(2, limiter.rate('a'))
+
+    def test_prefixes_limited_independently(self):
+        limiter = AdaptiveRateLimiter(max_rate=100, clock=FakeClock())
+        limiter.on_throttle('hot')
+        self.assertEqual(50, limiter.rate('hot'))
+        self.assertEqual(100, limiter.rate('cold'))
+
+    def test_reserve_waits_once_bucket_empty(self):
+        clock = FakeClock()
+        limiter = AdaptiveRateLimiter(max_rate=2, min_rate=1, clock=clock)
+        self.assertEqual(0, limiter.reserve('a'))
+        self.assertEqual(0, limiter.reserve('a'))
+        self.assertAlmostEqual(0.5, limiter.reserve('a'))
+        self.assertAlmostEqual(1.0, limiter.reserve('a'))
+        clock.now = 10.0
+        self.assertEqual(0, limiter.reserve('a'))
+        self.assertEqual(0, limiter.reserve('other'))
+
+
+class TestRetrier(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.metrics = s3sup.metrics.S3Metrics()
+        self.limiter = AdaptiveRateLimiter(max_rate=1000)
+        self.retrier = Retrier(
+            max_attempts=4, limiter=self.limiter, metrics=self.metrics,
+            sleep=self.sleeps.append)
+
+    def test_throttled_request_retried(self):
+        attempts = []
+
+        def put(key):
+            attempts.append(key)
+            if len(attempts) < 3:
+                raise client_error('SlowDown', 503)
+            return 'ok'
+
+        self.assertEqual('ok', self.retrier.call('img', put, 'img/a.png'))
+        self.assertEqual(3, len(attempts))
+        self.assertEqual(2, len(self.sleeps))
+        self.assertLess(self.limiter.rate('img'), 1000)
+        self.assertEqual(1000, self.limiter.rate(''))
+        self.assertEqual({'throttle': 2}, dict(self.metrics.retries))
+
+    def test_gives_up_after_max_attempts(self):
+        attempts = []
+
+        def put():
+            attempts.append(1)
+            raise ConnectionResetError('reset')
+
+        with self.assertRaises(ConnectionResetError):
+            self.retrier.call('', put)
+        self.assertEqual(4, len(attempts))
+
+    def test_permanent_errors_not_retried(self):
+        attempts = []
+
+        def put():
+            attempts.append(1)
+            raise client_error('AccessDenied', 403)
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.retrier.call('', put)
+        self.assertEqual(1, len(attempts))
+        self.assertEqual([], self.sleeps)
+
+    def test_backoff_capped(self):
+        retrier = Retrier(base_delay=1, max_delay=5)
+        for _ in range(100):
+            self.assertLessEqual(retrier.backoff(1), 1)
+            self.assertLessEqual(retrier.backoff(10), 5)
+
+    def test_call_async(self):
+        async_sleeps = []
+
+        async def fake_sleep(s):
+            async_sleeps.append(s)
+
+        attempts = []
+
+        async def put():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise client_error('InternalError', 500)
+            return 'ok'
+
+        retrier = Retrier(async_sleep=fake_sleep)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                'ok', loop.run_until_complete(retrier.call_async('', put)))
+        finally:
+            loop.close()
+        self.assertEqual(2, len(attempts))
+        self.assertEqual(1, len(async_sleeps))
+
+    def test_max_attempts_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            Retrier(max_attempts=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
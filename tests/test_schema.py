@@ -31,6 +31,54 @@ class ValidatePreserveDeletedFiles(BaseSchemaTestCase):
         self.assertInvalid({"preserve_deleted_files": 1})
 
 
+class ValidateExcludeInclude(BaseSchemaTestCase):
+
+    def test_valid_use_cases(self):
+        self.assertValid({"exclude": []})
+        self.assertValid({
+            "exclude": [".*", "node_modules/", "**/*.map"],
+            "include": [".well-known/"]})
+
+    def test_invalid_values(self):
+        self.assertInvalid({"exclude": ".git/"})
+        self.assertInvalid({"exclude": [""]})
+        self.assertInvalid({"include": [1]})
+
+
+class ValidateTransfer(BaseSchemaTestCase):
+
+    def test_not_required(self):
+        self.assertValid({})
+
+    def test_can_be_empty_object(self):
+        self.assertValid({"transfer": {}})
+
+    def test_valid_use_cases(self):
+        self.assertValid({"transfer": {"concurrency": 32}})
+        self.assertValid({"transfer": {
+            "concurrency": 1, "max_inflight_mb": 512}})
+        self.assertValid({"transfer": {"transport": "asyncio"}})
+        self.assertValid({"transfer": {
+            "multipart_threshold_mb": 100, "multipart_chunksize_mb": 8,
+            "multipart_concurrency": 8}})
+        self.assertValid({"transfer": {
+            "max_attempts": 3, "max_requests_per_second": 100}})
+        self.assertValid({"transfer": {"deduplicate": False}})
+
+    def test_invalid_values(self):
+        self.assertInvalid({"transfer": {"concurrency": 0}})
+        self.assertInvalid({"transfer": {"concurrency": "10"}})
+        self.assertInvalid({"transfer": {"max_inflight_mb": 0}})
+        self.assertInvalid({"transfer": {"unknown": 1}})
+        self.assertInvalid({"transfer": {"transport": "carrier-pigeon"}})
+        self.assertInvalid({"transfer": {"multipart_threshold_mb": 1}})
+        self.assertInvalid({"transfer": {"multipart_chunksize_mb": 4}})
+        self.assertInvalid({"transfer": {"multipart_chunksize_mb": 6000}})
+        self.assertInvalid({"transfer": {"max_attempts": 0}})
+        self.assertInvalid({"transfer": {"deduplicate": "no"}})
+        self.assertInvalid({"transfer": {"max_requests_per_second": 0}})
+
+
 class ValidateMimetypeOverrides(BaseSchemaTestCase):
 
     def test_not_required(self):
@@ -0,0 +1,71 @@
+import io
+import unittest
+
+from s3sup.catalogue import Catalogue, load_gzipped_sqlite
+import s3sup.shards
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.cat = Catalogue()
+        for i in range(200):
+            self.cat.add_file(
+                'dir{0}/page{1}.html'.format(i % 7, i), 'C{0}'.format(i),
+                'A{0}'.format(i % 3), size=i)
+        self.cat.meta['git_commit'] = 'abc123'
+
+    def test_partition_covers_every_file(self):
+        parts = s3sup.shards.partition(self.cat, 8)
+        self.assertEqual(8, len(parts))
+        merged = {}
+        for i, part in parts.items():
+            for p in part.paths():
+                self.assertEqual(i, s3sup.shards.shard_of(p, 8))
+            merged.update(part.to_dict())
+        self.assertEqual(self.cat.to_dict(), merged)
+        self.assertEqual((3, None), parts[
+            s3sup.shards.shard_of('dir3/page3.html', 8)].get_object(
+                'dir3/page3.html'))
+
+    def test_digests_only_change_for_touched_shards(self):
+        before = s3sup.shards.shard_digests(self.cat, 8)
+        parts = s3sup.shards.partition(self.cat, 8)
+        self.assertEqual(before, {
+            i: s3sup.shards.shard_digests(part, 8)[i]
+            for i, part in parts.items()})
+        self.cat.add_file('dir1/page1.html', 'changed', 'A1')
+        after = s3sup.shards.shard_digests(self.cat, 8)
+        self.assertEqual(
+            [s3sup.shards.shard_of('dir1/page1.html', 8)],
+            [i for i in before if before[i] != after[i]])
+
+    def test_manifest_round_trip(self):
+        manifest, parts = s3sup.shards.Manifest.for_catalogue(
+            self.cat, 4, 'staging/.s3sup.cat')
+        self.assertEqual(set(parts), set(manifest.shards))
+        digest, key = manifest.shards[2]
+        self.assertEqual(
+            'staging/.s3sup.cat.shards/00002-' + digest[:16], key)
+        buf = io.BytesIO()
+        manifest.to_sqlite(buf)
+        with load_gzipped_sqlite(io.BytesIO(buf.getvalue())) as c:
+            self.assertTrue(s3sup.shards.is_manifest(c))
+            read = s3sup.shards.Manifest.from_connection(c)
+        self.assertEqual(4, read.num_shards)
+        self.assertEqual(manifest.shards, read.shards)
+        self.assertEqual({'git_commit': 'abc123'}, read.meta)
+        self.assertEqual(set(), read.changed(
+            s3sup.shards.shard_digests(self.cat, 4)))
+
+    def test_catalogue_is_not_manifest(self):
+        buf = io.BytesIO()
+        self.cat.to_sqlite(buf)
+        with load_gzipped_sqlite(io.BytesIO(buf.getvalue())) as c:
+            self.assertFalse(s3sup.shards.is_manifest(c))
+
+    def test_older_s3sup_refuses_manifest(self):
+        buf = io.BytesIO()
+        s3sup.shards.Manifest(4).to_sqlite(buf)
+        with self.assertRaisesRegex(Exception, 'Upgrade to latest s3sup'):
+            Catalogue().from_sqlite(io.BytesIO(buf.getvalue()))
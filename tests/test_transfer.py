@@ -0,0 +1,490 @@
+import os
+import hashlib
+import base64
+import tempfile
+import threading
+import time
+import unittest
+
+import boto3
+import click
+import moto
+
+from s3sup.catalogue import ChangeReason
+from s3sup.retry import Retrier
+from s3sup.transfer import (
+    Executor, S3Operations, ServerSideCopy, deduplicate, multipart_part_size,
+    sha256_checksum, transfer_size, MB)
+from tests.helpers import FakeFilePrepper, make_phase
+
+os.environ['AWS_ACCESS_KEY_ID'] = 'FOO'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'BAR'
+# moto stores bodies sent with a trailing payload checksum (aws-chunked) as
+# is, so botocore only adds checksums where an operation requires them.
+os.environ['AWS_REQUEST_CHECKSUM_CALCULATION'] = 'when_required'
+
+
+class RecordingOperation:
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.max_inflight = 0
+        self.inflight_bytes = 0
+        self.max_inflight_bytes = 0
+        self.events = []
+
+    def __call__(self, cr, fp):
+        with self.lock:
+            self.inflight += 1
+            self.inflight_bytes += fp.size()
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            self.max_inflight_bytes = max(
+                self.max_inflight_bytes, self.inflight_bytes)
+            self.events.append(('start', fp.path))
+        time.sleep(self.delay)
+        with self.lock:
+            self.inflight -= 1
+            self.inflight_bytes -= fp.size()
+            self.events.append(('end', fp.path))
+
+
+class TestExecutor(unittest.TestCase):
+
+    def test_phases_do_not_overlap(self):
+        op = RecordingOperation()
+        phases = [
+            make_phase(ChangeReason.NEW_FILE, ['a.png', 'b.png', 'c.png']),
+            make_phase(ChangeReason.NEW_FILE, ['index.html', 'about.html']),
+            make_phase(ChangeReason.DELETED, ['old.html'])]
+        Executor(op, concurrency=4).run(phases)
+        order = [p for ev, p in op.events]
+        last_asset_end = max(
+            i for i, (ev, p) in enumerate(op.events)
+            if ev == 'end' and p.endswith('.png'))
+        first_html_start = min(
+            i for i, (ev, p) in enumerate(op.events)
+            if ev == 'start' and p.endswith('.html') and p != 'old.html')
+        self.assertLess(last_asset_end, first_html_start)
+        self.assertEqual('old.html', order[-1])
+        self.assertGreater(op.max_inflight, 1)
+
+    def test_concurrency_limit_respected(self):
+        op = RecordingOperation()
+        phases = [make_phase(
+            ChangeReason.NEW_FILE, ['{0}.png'.format(i) for i in range(20)])]
+        Executor(op, concurrency=3).run(phases)
+        self.assertEqual(3, op.max_inflight)
+
+    def test_inflight_bytes_limit_respected(self):
+        op = RecordingOperation()
+        phases = [make_phase(
+            ChangeReason.NEW_FILE, ['{0}.png'.format(i) for i in range(10)],
+            size=100)]
+        Executor(op, concurrency=8, max_inflight_bytes=250).run(phases)
+        self.assertEqual(200, op.max_inflight_bytes)
+
+    def test_file_larger_than_byte_budget_still_uploaded(self):
+        op = RecordingOperation()
+        phases = [make_phase(ChangeReason.NEW_FILE, ['huge.mp4'], size=1000)]
+        Executor(op, concurrency=8, max_inflight_bytes=10).run(phases)
+        self.assertEqual([('start', 'huge.mp4'), ('end', 'huge.mp4')],
+                         op.events)
+
+    def test_on_done_called_for_every_item(self):
+        op = RecordingOperation(delay=0)
+        phases = [
+            make_phase(ChangeReason.ATTRIBUTES_CHANGED, ['a.css']),
+            make_phase(ChangeReason.NEW_FILE, ['b.png', 'c.png'])]
+        done = []
+        Executor(op, concurrency=2).run(phases, on_done=done.append)
+        self.assertEqual(
+            ['a.css', 'b.png', 'c.png'], sorted(p for _, p, _ in done))
+
+    def test_failure_stops_later_phases(self):
+        calls = []
+
+        def op(cr, fp):
+            calls.append(fp.path)
+            if fp.path == 'broken.png':
+                raise RuntimeError('S3 said no')
+
+        phases = [
+            make_phase(ChangeReason.NEW_FILE, ['broken.png']),
+            make_phase(ChangeReason.NEW_FILE, ['index.html'])]
+        with self.assertRaisesRegex(RuntimeError, 'S3 said no'):
+            Executor(op, concurrency=2).run(phases)
+        self.assertNotIn('index.html', calls)
+
+    def test_deletes_sent_in_batches(self):
+        batches = []
+
+        class BatchingOperation(RecordingOperation):
+            def delete_batch(self, fps):
+                batches.append([fp.path for fp in fps])
+                return [(fp.s3_path(), 'AccessDenied', 'Access Denied')
+                        for fp in fps if fp.path == 'keep/1500.html']
+
+        class KeyedFilePrepper(FakeFilePrepper):
+            def s3_path(self):
+                return self.path
+
+        paths = ['keep/{0}.html'.format(i) for i in range(2500)]
+        phases = [[(ChangeReason.DELETED, p, KeyedFilePrepper(p))
+                   for p in paths]]
+        done = []
+        failures = Executor(BatchingOperation(), concurrency=2).run(
+            phases, on_done=done.append)
+        self.assertEqual([1000, 1000, 500], [len(b) for b in batches])
+        self.assertEqual(paths, sorted(
+            sum(batches, []), key=lambda p: int(p[5:-5])))
+        self.assertEqual(2500, len(done))
+        self.assertEqual(1, len(failures))
+        (cr, p, _), code, msg = failures[0]
+        self.assertEqual('keep/1500.html', p)
+        self.assertEqual('AccessDenied', code)
+
+    def test_dependencies_finish_before_dependents_start(self):
+        op = RecordingOperation()
+        phases = [make_phase(ChangeReason.NEW_FILE, [
+            'index.html', 'about.html', 'site.css', 'logo.png', 'big.jpg'])]
+        dependencies = {
+            'index.html': {'site.css', 'logo.png'},
+            'site.css': {'big.jpg'},
+            'about.html': {'contact.html'}}
+        Executor(op, concurrency=4).run(phases, dependencies=dependencies)
+        events = op.events
+        for p, deps in dependencies.items():
+            start = events.index(('start', p))
+            for d in deps & {'site.css', 'logo.png', 'big.jpg'}:
+                self.assertLess(events.index(('end', d)), start)
+        self.assertLess(
+            events.index(('start', 'about.html')),
+            events.index(('end', 'big.jpg')))
+
+    def test_dependency_cycle_does_not_stall(self):
+        op = RecordingOperation(delay=0)
+        phases = [make_phase(ChangeReason.NEW_FILE, ['a.css', 'b.css'])]
+        Executor(op, concurrency=4).run(
+            phases, dependencies={'a.css': {'b.css'}, 'b.css': {'a.css'}})
+        self.assertEqual(
+            [('start', 'a.css'), ('end', 'a.css'),
+             ('start', 'b.css'), ('end', 'b.css')], op.events)
+
+    def test_concurrency_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            Executor(RecordingOperation(), concurrency=0)
+
+
+class TestDeduplicate(unittest.TestCase):
+
+    def setUp(self):
+        self.hashes = {
+            'a/jquery.js': 'h1', 'b/jquery.js': 'h1', 'c/jquery.js': 'h1',
+            'logo.png': 'h2', 'index.html': 'h3', 'copy.html': 'h1',
+            'same.css': 'h4'}
+
+    def phase(self, cr, paths):
+        return [(cr, p, KeyedFilePrepper(p)) for p in paths]
+
+    def summarise(self, phases):
+        return [[(p, getattr(fp, 'source_key', None)) for _, p, fp in phase]
+                for phase in phases]
+
+    def test_duplicates_copied_after_upload(self):
+        phases = [
+            self.phase(ChangeReason.NEW_FILE, [
+                'a/jquery.js', 'b/jquery.js', 'logo.png', 'c/jquery.js']),
+            self.phase(ChangeReason.NEW_FILE, ['index.html', 'copy.html'])]
+        deduped = deduplicate(phases, self.hashes.get)
+        self.assertEqual([
+            [('a/jquery.js', None), ('logo.png', None)],
+            [('b/jquery.js', 'a/jquery.js'), ('c/jquery.js', 'a/jquery.js')],
+            [('index.html', None), ('copy.html', 'a/jquery.js')]],
+            self.summarise(deduped))
+
+    def test_duplicates_depend_on_upload_when_scheduling_by_graph(self):
+        phases = [self.phase(ChangeReason.NEW_FILE, [
+            'a/jquery.js', 'b/jquery.js', 'index.html'])]
+        dependencies = {'index.html': {'b/jquery.js'}}
+        deduped = deduplicate(
+            phases, self.hashes.get, dependencies=dependencies)
+        self.assertEqual([
+            [('a/jquery.js', None), ('b/jquery.js', 'a/jquery.js'),
+             ('index.html', None)]],
+            self.summarise(deduped))
+        self.assertEqual({
+            'index.html': {'b/jquery.js'},
+            'b/jquery.js': {'a/jquery.js'}}, dependencies)
+
+    def test_existing_content_copied_in_same_phase(self):
+        phases = [
+            self.phase(ChangeReason.ATTRIBUTES_CHANGED, ['same.css']),
+            self.phase(ChangeReason.CONTENT_CHANGED, ['logo.png']),
+            self.phase(ChangeReason.DELETED, ['old.png'])]
+        deduped = deduplicate(
+            phases, self.hashes.get, existing={'h2': 'img/logo.png'})
+        self.assertEqual([
+            [('same.css', None)],
+            [('logo.png', 'img/logo.png')],
+            [('old.png', None)]],
+            self.summarise(deduped))
+        self.assertEqual(
+            0, transfer_size(ChangeReason.CONTENT_CHANGED, deduped[1][0][2]))
+
+
+class KeyedFilePrepper(FakeFilePrepper):
+
+    def s3_path(self):
+        return self.path
+
+
+class LocalFilePrepper:
+
+    def __init__(self, path, abs_path):
+        self.path = path
+        self.abs_path = abs_path
+        self.hashed = None
+
+    def content_hash(self):
+        if self.hashed is None:
+            with open(self.abs_path, 'rb') as f:
+                self.hashed = (
+                    hashlib.sha256(f.read()).hexdigest(), self.size())
+        return self.hashed[0]
+
+    def content_changed(self):
+        self.content_hash()
+        return self.size() != self.hashed[1]
+
+    def s3_path(self):
+        return self.path
+
+    def size(self):
+        return os.path.getsize(self.abs_path)
+
+    def content_fileobj(self):
+        return open(self.abs_path, 'rb')
+
+    def attributes_as_boto_args(self):
+        return {'ACL': 'public-read', 'ContentType': 'video/mp4'}
+
+
+class TestMultipartPartSize(unittest.TestCase):
+
+    def test_configured_chunksize_used_when_possible(self):
+        self.assertEqual(16 * MB, multipart_part_size(100 * MB, 16 * MB))
+        self.assertEqual(
+            16 * MB, multipart_part_size(10000 * 16 * MB, 16 * MB))
+
+    def test_part_size_grows_to_stay_within_part_limit(self):
+        size = 10000 * 16 * MB + 1
+        ps = multipart_part_size(size, 16 * MB)
+        self.assertEqual(17 * MB, ps)
+        self.assertLessEqual(-(-size // ps), 10000)
+
+
+class TestS3OperationsMultipart(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.abs_path = os.path.join(self.tmpd.name, 'video.mp4')
+        self.content = os.urandom(11 * MB + 123)
+        with open(self.abs_path, 'wb') as f:
+            f.write(self.content)
+        self.fp = LocalFilePrepper('media/video.mp4', self.abs_path)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def create_client(self):
+        client = boto3.client('s3', region_name='eu-west-1')
+        client.create_bucket(
+            Bucket='www.example.com',
+            CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        return client
+
+    def put_source(self, client, key):
+        """
+        Seed an object with an explicit payload checksum, so what moto stores
+        does not depend on botocore's default checksum behaviour.
+        """
+        client.put_object(
+            Bucket='www.example.com', Key=key, Body=self.content,
+            ChecksumSHA256=base64.b64encode(
+                hashlib.sha256(self.content).digest()).decode('ascii'),
+            ContentType='application/octet-stream')
+
+    @moto.mock_s3
+    def test_large_file_uploaded_in_parts(self):
+        client = self.create_client()
+        part_numbers = []
+        orig_upload_part = client.upload_part
+
+        def upload_part(**kwargs):
+            part_numbers.append(kwargs['PartNumber'])
+            return orig_upload_part(**kwargs)
+        client.upload_part = upload_part
+
+        ops = S3Operations(
+            client, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB, multipart_concurrency=3)
+        ops(ChangeReason.NEW_FILE, self.fp)
+        self.assertEqual([1, 2, 3], sorted(part_numbers))
+        o = client.get_object(Bucket='www.example.com', Key='media/video.mp4')
+        self.assertEqual(self.content, o['Body'].read())
+        self.assertEqual('video/mp4', o['ContentType'])
+
+    @moto.mock_s3
+    def test_small_file_uploaded_in_one_request(self):
+        client = self.create_client()
+        ops = S3Operations(client, 'www.example.com')
+        ops(ChangeReason.NEW_FILE, self.fp)
+        uploads = client.list_multipart_uploads(Bucket='www.example.com')
+        self.assertNotIn('Uploads', uploads)
+        o = client.get_object(Bucket='www.example.com', Key='media/video.mp4')
+        self.assertEqual(self.content, o['Body'].read())
+
+    @moto.mock_s3
+    def test_payload_checksums_sent(self):
+        client = self.create_client()
+        checksums = []
+        for method in ('put_object', 'upload_part'):
+            def recording(orig=getattr(client, method), **kwargs):
+                checksums.append((kwargs['Body'], kwargs['ChecksumSHA256']))
+                return orig(**kwargs)
+            setattr(client, method, recording)
+
+        S3Operations(client, 'www.example.com')(
+            ChangeReason.NEW_FILE, self.fp)
+        S3Operations(
+            client, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB)(ChangeReason.NEW_FILE, self.fp)
+        self.assertEqual(4, len(checksums))
+        for body, checksum in checksums:
+            self.assertEqual(sha256_checksum(body), checksum)
+
+    @moto.mock_s3
+    def test_file_changed_since_hashing_not_uploaded(self):
+        client = self.create_client()
+        self.fp.content_hash()
+        with open(self.abs_path, 'ab') as f:
+            f.write(b'more')
+        with self.assertRaisesRegex(click.FileError, 'changed during'):
+            S3Operations(client, 'www.example.com')(
+                ChangeReason.NEW_FILE, self.fp)
+        ops = S3Operations(
+            client, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB)
+        with self.assertRaisesRegex(click.FileError, 'changed during'):
+            ops(ChangeReason.NEW_FILE, self.fp)
+        uploads = client.list_multipart_uploads(Bucket='www.example.com')
+        self.assertEqual([], uploads.get('Uploads', []))
+        self.assertNotIn(
+            'Contents', client.list_objects_v2(Bucket='www.example.com'))
+
+    @moto.mock_s3
+    def test_failed_part_retried_on_its_own(self):
+        client = self.create_client()
+        attempts = []
+        orig_upload_part = client.upload_part
+
+        def flaky_upload_part(**kwargs):
+            attempts.append(kwargs['PartNumber'])
+            if kwargs['PartNumber'] == 2 and attempts.count(2) == 1:
+                raise ConnectionResetError('Connection reset by peer')
+            return orig_upload_part(**kwargs)
+        client.upload_part = flaky_upload_part
+
+        ops = S3Operations(
+            client, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB,
+            retrier=Retrier(max_attempts=3, sleep=lambda s: None))
+        ops(ChangeReason.NEW_FILE, self.fp)
+        self.assertEqual([1, 2, 2, 3], sorted(attempts))
+        o = client.get_object(Bucket='www.example.com', Key='media/video.mp4')
+        self.assertEqual(self.content, o['Body'].read())
+
+    @moto.mock_s3
+    def test_upload_aborted_when_part_keeps_failing(self):
+        client = self.create_client()
+
+        attempts = []
+
+        def broken_upload_part(**kwargs):
+            attempts.append(kwargs['PartNumber'])
+            raise ConnectionResetError('Connection reset by peer')
+        client.upload_part = broken_upload_part
+
+        ops = S3Operations(
+            client, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB,
+            retrier=Retrier(max_attempts=3, sleep=lambda s: None))
+        with self.assertRaises(ConnectionResetError):
+            ops(ChangeReason.NEW_FILE, self.fp)
+        self.assertEqual(3, attempts.count(1))
+        uploads = client.list_multipart_uploads(Bucket='www.example.com')
+        self.assertEqual([], uploads.get('Uploads', []))
+
+    @moto.mock_s3
+    def test_server_side_copy(self):
+        client = self.create_client()
+        self.put_source(client, 'media/original.mp4')
+        ops = S3Operations(client, 'www.example.com')
+        ops(ChangeReason.NEW_FILE,
+            ServerSideCopy(self.fp, 'media/original.mp4'))
+        o = client.get_object(Bucket='www.example.com', Key='media/video.mp4')
+        self.assertEqual(self.content, o['Body'].read())
+        self.assertEqual('video/mp4', o['ContentType'])
+
+    @moto.mock_s3
+    def test_large_object_attributes_changed_using_multipart_copy(self):
+        client = self.create_client()
+        self.put_source(client, 'media/video.mp4')
+        ranges = []
+        orig_upload_part_copy = client.upload_part_copy
+
+        def upload_part_copy(**kwargs):
+            ranges.append(kwargs['CopySourceRange'])
+            return orig_upload_part_copy(**kwargs)
+        client.upload_part_copy = upload_part_copy
+
+        ops = S3Operations(
+            client, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB, multipart_concurrency=3)
+        ops(ChangeReason.ATTRIBUTES_CHANGED, self.fp)
+        size = len(self.content)
+        self.assertEqual([
+            'bytes=0-{0}'.format(5 * MB - 1),
+            'bytes={0}-{1}'.format(10 * MB, size - 1),
+            'bytes={0}-{1}'.format(5 * MB, 10 * MB - 1)], sorted(ranges))
+        o = client.get_object(Bucket='www.example.com', Key='media/video.mp4')
+        self.assertEqual(self.content, o['Body'].read())
+        self.assertEqual('video/mp4', o['ContentType'])
+
+    @moto.mock_s3
+    def test_delete_batch(self):
+        client = self.create_client()
+        for k in ('a.html', 'b/c.html'):
+            client.put_object(Bucket='www.example.com', Key=k, Body=b'x')
+        ops = S3Operations(client, 'www.example.com')
+        failures = ops.delete_batch([
+            LocalFilePrepper('a.html', None),
+            LocalFilePrepper('b/c.html', None)])
+        self.assertEqual([], failures)
+        self.assertNotIn(
+            'Contents', client.list_objects_v2(Bucket='www.example.com'))
+
+    def test_inflight_bytes_capped_for_multipart(self):
+        ops = S3Operations(
+            None, 'www.example.com', multipart_threshold=5 * MB,
+            multipart_chunksize=5 * MB, multipart_concurrency=1)
+        self.assertEqual(5 * MB, ops.inflight_bytes(
+            ChangeReason.NEW_FILE, self.fp))
+        self.assertEqual(0, ops.inflight_bytes(
+            ChangeReason.DELETED, self.fp))
+
+
+if __name__ == '__main__':
+    unittest.main()
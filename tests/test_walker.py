@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from s3sup.walker import PathFilter, walk, walked
+
+
+class TestPathFilter(unittest.TestCase):
+
+    def assertExcluded(self, pf, path, is_dir=False):
+        self.assertTrue(pf.excluded(path, is_dir=is_dir), path)
+
+    def assertNotExcluded(self, pf, path, is_dir=False):
+        self.assertFalse(pf.excluded(path, is_dir=is_dir), path)
+
+    def test_name_matches_at_any_depth(self):
+        pf = PathFilter(['*.swp', 'node_modules', '.DS_Store'])
+        self.assertExcluded(pf, '.index.html.swp')
+        self.assertExcluded(pf, 'assets/.site.css.swp')
+        self.assertExcluded(pf, 'node_modules', is_dir=True)
+        self.assertExcluded(pf, 'js/node_modules', is_dir=True)
+        self.assertExcluded(pf, 'a/b/.DS_Store')
+        self.assertNotExcluded(pf, 'index.html')
+        self.assertNotExcluded(pf, 'swp/index.html')
+
+    def test_patterns_with_slash_are_anchored(self):
+        pf = PathFilter(['/drafts', 'assets/*.psd'])
+        self.assertExcluded(pf, 'drafts', is_dir=True)
+        self.assertNotExcluded(pf, 'blog/drafts', is_dir=True)
+        self.assertExcluded(pf, 'assets/logo.psd')
+        self.assertNotExcluded(pf, 'assets/img/logo.psd')
+        self.assertNotExcluded(pf, 'old/assets/logo.psd')
+
+    def test_double_star_crosses_directories(self):
+        pf = PathFilter(['assets/**/*.map', 'build/**'])
+        self.assertExcluded(pf, 'assets/app.js.map')
+        self.assertExcluded(pf, 'assets/js/vendor/app.js.map')
+        self.assertNotExcluded(pf, 'app.js.map')
+        self.assertExcluded(pf, 'build/a/b.html')
+
+    def test_directory_only_patterns(self):
+        pf = PathFilter(['.git/', 'tmp[0-9]/'])
+        self.assertExcluded(pf, '.git', is_dir=True)
+        self.assertExcluded(pf, 'tmp1', is_dir=True)
+        self.assertNotExcluded(pf, '.git')
+        self.assertNotExcluded(pf, 'tmpx', is_dir=True)
+
+    def test_include_overrides_exclude(self):
+        pf = PathFilter(['.*'], include=['.well-known/', '.htaccess'])
+        self.assertExcluded(pf, '.git', is_dir=True)
+        self.assertNotExcluded(pf, '.well-known', is_dir=True)
+        self.assertNotExcluded(pf, '.htaccess')
+        self.assertExcluded(pf, '.env')
+
+
+class TestWalk(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.root = self.tmpd.name
+        for path in ('index.html', 's3sup.toml', 'about/index.html',
+                     'about/s3sup.toml', '.s3sup/journal.sqlite',
+                     '.git/objects/ab/cdef', 'node_modules/x/index.js',
+                     'assets/.site.css.swp', 'assets/site.css'):
+            abs_path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+            with open(abs_path, 'w') as f:
+                f.write(path)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def test_all_files_found(self):
+        found = dict(walk(self.root))
+        self.assertEqual({
+            'index.html', 'about/index.html', '.git/objects/ab/cdef',
+            'node_modules/x/index.js', 'assets/.site.css.swp',
+            'assets/site.css'}, set(found))
+        self.assertEqual(
+            len('assets/site.css'), found['assets/site.css'].st_size)
+
+    def test_excluded_directories_not_descended_into(self):
+        pf = PathFilter(['.git/', 'node_modules/', '*.swp'])
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            found = [p for p, _ in walk(self.root, pf)]
+        self.assertEqual(
+            ['about/index.html', 'assets/site.css', 'index.html'],
+            sorted(found))
+        scanned = {os.path.relpath(c[0][0], self.root)
+                   for c in scandir.call_args_list}
+        self.assertEqual({'.', 'about', 'assets'}, scanned)
+
+    def test_walk_from_subdirectory(self):
+        self.assertEqual(
+            ['assets/.site.css.swp', 'assets/site.css'],
+            sorted(p for p, _ in walk(self.root, top='assets')))
+
+    def test_walked_agrees_with_walk(self):
+        pf = PathFilter(['.git/', 'node_modules/', '*.swp'])
+        found = {p for p, _ in walk(self.root, pf)}
+        for path in ('index.html', 's3sup.toml', 'about/index.html',
+                     'about/s3sup.toml', '.s3sup/journal.sqlite',
+                     '.git/objects/ab/cdef', 'node_modules/x/index.js',
+                     'assets/.site.css.swp', 'assets/site.css'):
+            self.assertEqual(path in found, walked(path, pf), path)
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import click
+
+import s3sup.watch
+from s3sup.watch import Debouncer, Watcher
+
+
+class TestDebouncer(unittest.TestCase):
+
+    def test_batch_waits_for_quiet_period(self):
+        d = Debouncer(quiet_seconds=0.2)
+        d.add('index.html')
+        start = time.monotonic()
+        t = threading.Timer(0.1, d.add, ['about.html'])
+        t.start()
+        self.assertEqual({'index.html', 'about.html'}, d.batch(timeout=5))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        t.join()
+
+    def test_batch_ready_after_max_delay(self):
+        d = Debouncer(quiet_seconds=10, max_delay_seconds=0.1)
+        d.add('index.html')
+        self.assertEqual({'index.html'}, d.batch(timeout=5))
+
+    def test_batch_times_out_empty(self):
+        d = Debouncer(quiet_seconds=0)
+        self.assertEqual(set(), d.batch(timeout=0.05))
+        d.add('index.html')
+        self.assertEqual({'index.html'}, d.batch(timeout=0.05))
+        self.assertEqual(set(), d.batch(timeout=0.05))
+
+
+class TestWatcherWithoutWatchdog(unittest.TestCase):
+
+    def test_usage_error(self):
+        with mock.patch.object(s3sup.watch, 'watchdog', None):
+            with self.assertRaises(click.UsageError):
+                Watcher('.')
+
+
+class Event:
+
+    def __init__(self, event_type, src_path, dest_path='',
+                 is_directory=False):
+        self.event_type = event_type
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.is_directory = is_directory
+
+
+@unittest.skipUnless(
+    s3sup.watch.available(), 'watchdog needed for filesystem events')
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpd = tempfile.TemporaryDirectory()
+        self.root = self.tmpd.name
+        self.debouncer = Debouncer(quiet_seconds=0.2)
+
+    def tearDown(self):
+        self.tmpd.cleanup()
+
+    def path(self, rel_path):
+        return os.path.join(self.root, rel_path)
+
+    def test_events_filtered(self):
+        w = Watcher(self.root, debouncer=self.debouncer)
+        w.on_event(Event('opened', self.path('index.html')))
+        w.on_event(Event('modified', self.path('assets'), is_directory=True))
+        w.on_event(Event('modified', self.path('.s3sup/hashcache.sqlite')))
+        w.on_event(Event('modified', self.root, is_directory=True))
+        self.assertEqual(set(), self.debouncer.batch(timeout=0.3))
+        w.on_event(Event('moved', self.path('assets'), self.path('static'),
+                         is_directory=True))
+        w.on_event(Event('created', self.path('index.html')))
+        self.assertEqual(
+            {'assets', 'static', 'index.html'},
+            self.debouncer.batch(timeout=1))
+
+    def test_file_changes_batched(self):
+        with Watcher(self.root, debouncer=self.debouncer) as w:
+            os.makedirs(self.path('about'))
+            for name in ('index.html', os.path.join('about', 'index.html')):
+                with open(self.path(name), 'w') as f:
+                    f.write('<p>Hello</p>')
+            batch = next(w.batches())
+        self.assertIn('index.html', batch)
+        self.assertIn(os.path.join('about', 'index.html'), batch)